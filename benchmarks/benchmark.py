@@ -0,0 +1,237 @@
+"""
+
+ Benchmark of every stage of the pipeline on synthetic data
+
+ Each stage is run on synthetic data (see modules/synthetic.py) at several
+ scales, and its wall time and peak memory (as seen by tracemalloc, which
+ includes numpy arrays) are recorded. Results are saved as json so that they
+ can be compared against a baseline to catch performance regressions
+
+ Usage (from the root of the repository):
+   python benchmarks/benchmark.py --scales 1k 10k --output bench.json
+   python benchmarks/benchmark.py --scales 1k --compare bench.json
+
+ Synthetic data and intermediate files are written to a temporary directory
+
+"""
+## Packages
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import scipy.cluster.hierarchy as sch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import modules.synthetic as synthetic
+import modules.getconnectivity as getconnectivity
+import modules.getmorphology as getmorphology
+import modules.synapsestore as synapsestore
+import modules.utility as utility
+import modules.visualize as visualize
+
+# number of cells (and of synapses for calcrawdepth) at each scale
+scales = {
+    '1k':   {'n_cells': 1000,   'n_synapses': 1000000},
+    '10k':  {'n_cells': 10000,  'n_synapses': 10000000},
+    '100k': {'n_cells': 100000, 'n_synapses': 50000000},
+}
+
+# above these sizes the stage is skipped (Ward needs n^2 memory, UMAP is slow)
+limits = {'linkage': 30000, 'showUMAPscatter2D': 20000}
+
+stages = ('calcrawdepth','connectivity','loadlobulamodel','calcmorphology',
+          'linkage','sortmatrixbylabel','showsortedmatrix','showUMAPscatter2D',
+          'plotmeanbycluster','meanscatterwitherror')
+
+morphologykwargs = {'ub': '500', 'lb': '50', 'landmarkname': 'LT1', 'synapseType': 'pre',
+                    'minD': -20, 'maxD': 50, 'binSize': 5, 'showModel': 0}
+
+
+# Run func(), return its output, wall time and peak memory (MB)
+def measure(func):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    out = func()
+    seconds = time.perf_counter()-start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return out, seconds, peak/1e6
+
+
+# Run all the requested stages at one scale
+def runscale(scalename, stagelist, repeat):
+    scale = scales[scalename]
+    n_cells = scale['n_cells']
+    results = []
+
+    # one synthetic dataset per scale
+    synthetic.usesyntheticdata(n_cells=n_cells)
+    synthetic.makedatadirs()
+
+    def record(stage, func, n):
+        if stage not in stagelist:
+            return None
+        if stage in limits and n > limits[stage]:
+            results.append({'stage': stage, 'scale': scalename, 'n': n, 'status': 'skipped'})
+            print('  %-20s skipped (n=%d is above the limit)' % (stage, n))
+            return None
+        times = []
+        peaks = []
+        for rr in range(repeat):
+            out, seconds, peak = measure(func)
+            times.append(seconds)
+            peaks.append(peak)
+            plt.close('all')
+        results.append({'stage': stage, 'scale': scalename, 'n': n, 'status': 'ok',
+                        'seconds': min(times), 'peak_mb': max(peaks)})
+        print('  %-20s %9.3f s %9.1f MB' % (stage, min(times), max(peaks)))
+        return out
+
+    # 1. depth of raw synapse coordinates
+    rng = np.random.default_rng(0)
+    landmark = pd.DataFrame(rng.normal(size=(20000,3))*[3000,2000,300]+20000, columns=['x','y','z'])
+    pca, modelcoeff = fitmodel(landmark)
+    xyz = pd.DataFrame((rng.normal(size=(scale['n_synapses'],3))*[3000,2000,300]+20000).astype(np.int32),
+                       columns=['x','y','z'])
+    record('calcrawdepth', lambda: utility.calcrawdepth(pca, modelcoeff, xyz), scale['n_synapses'])
+    del xyz
+
+    # 2. connectivity assembly (queries answered by the synthetic server)
+    connectivity = record('connectivity', lambda: getconnectivity.getconnectivityfromserver(**morphologykwargs)[0], n_cells)
+
+    # 3. lobula model (synapses are downloaded and the model is fitted and saved
+    # before timing, so this times loading the saved model)
+    def fitlandmark():
+        return getmorphology.loadlobulamodel(landmarkname='LT1', showModel=0)
+    if 'loadlobulamodel' in stagelist:
+        fitlandmark()
+    record('loadlobulamodel', fitlandmark, n_cells)
+
+    # 4. morphology (this includes fitting the landmark, but synapses are
+    # downloaded into the store before timing; recalculateMorphology makes sure
+    # the matrices are calculated rather than read from the cache)
+    def runmorphology():
+        return getmorphology.getmorphology(recalculateMorphology=1, **morphologykwargs)
+    if 'calcmorphology' in stagelist:
+        runmorphology()
+    morphology = record('calcmorphology', runmorphology, n_cells)
+
+    # feature matrix and clusters for the remaining stages
+    if connectivity is None:
+        connectivity = getconnectivity.getconnectivityfromserver(**morphologykwargs)[0]
+    if morphology is None:
+        morphology = runmorphology()
+    # data columns follow bodyId (lists read from csv start with an index column)
+    mat_con = connectivity.iloc[:,connectivity.columns.get_loc('bodyId')+1:].to_numpy()
+    mat_dep = morphology[0].iloc[:,morphology[0].columns.get_loc('bodyId')+1:].to_numpy()
+    mat_spr = morphology[1].iloc[:,morphology[1].columns.get_loc('bodyId')+1:].to_numpy()
+    mat_all = np.concatenate((mat_con/np.sum(np.var(mat_con,axis=0))*5,
+                              mat_dep/np.sum(np.var(mat_dep,axis=0))*3,
+                              mat_spr/np.sum(np.var(mat_spr,axis=0))),axis=1)
+    clabel = (np.arange(len(mat_all)) % 40)+1
+
+    # 5. clustering
+    linkage = record('linkage', lambda: sch.linkage(mat_all, method='ward', metric='euclidean'), n_cells)
+    if linkage is not None:
+        clabel = sch.fcluster(linkage, 40, criterion='maxclust')
+
+    # 6. post-processing and visualization
+    record('sortmatrixbylabel', lambda: utility.sortmatrixbylabel(mat_con, clabel), n_cells)
+    record('showsortedmatrix', lambda: visualize.showsortedmatrix(mat_dep, clabel), n_cells)
+    # without the embedding cache, so that every run times UMAP itself
+    record('showUMAPscatter2D', lambda: visualize.showUMAPscatter2D(mat_all, clabel, umapCache=0), n_cells)
+    record('plotmeanbycluster', lambda: visualize.plotmeanbycluster(mat_dep, clabel), n_cells)
+    record('meanscatterwitherror', lambda: visualize.meanscatterwitherror(mat_spr, clabel), n_cells)
+    return results
+
+
+# PCA + quadric model of a landmark without going through files
+def fitmodel(landmark):
+    from sklearn.decomposition import PCA
+    XYZ = landmark[['x','y','z']].to_numpy()*8/1000
+    pca = PCA(n_components=3)
+    PCs = pca.fit_transform(XYZ)
+    A = np.array([PCs[:,0]*0+1, PCs[:,0], PCs[:,1], PCs[:,0]**2, PCs[:,1]**2, PCs[:,0]*PCs[:,1]]).T
+    modelcoeff = np.linalg.lstsq(A, PCs[:,2], rcond=None)[0]
+    return pca, modelcoeff
+
+
+# Compare results against a baseline, return the number of regressions
+def compare(results, baseline, tolerance):
+    base = {(r['stage'], r['scale']): r for r in baseline['results'] if r['status']=='ok'}
+    n_regression = 0
+    print('%-20s %-6s %10s %10s %8s %10s %10s' % ('stage','scale','base (s)','now (s)','ratio','base (MB)','now (MB)'))
+    for r in results:
+        key = (r['stage'], r['scale'])
+        if r['status']!='ok' or key not in base:
+            continue
+        ratio = r['seconds']/max(base[key]['seconds'],1e-9)
+        memratio = r['peak_mb']/max(base[key]['peak_mb'],1e-9)
+        flag = ''
+        if ratio > 1+tolerance or memratio > 1+tolerance:
+            flag = '  <-- regression'
+            n_regression += 1
+        print('%-20s %-6s %10.3f %10.3f %8.2f %10.1f %10.1f%s' % (r['stage'], r['scale'], base[key]['seconds'],
+              r['seconds'], ratio, base[key]['peak_mb'], r['peak_mb'], flag))
+    return n_regression
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the lobula clustering pipeline on synthetic data')
+    parser.add_argument('--scales', nargs='+', default=['1k'], choices=list(scales))
+    parser.add_argument('--stages', nargs='+', default=list(stages), choices=list(stages))
+    parser.add_argument('--repeat', type=int, default=1, help='runs per stage (the fastest one is reported)')
+    parser.add_argument('--output', default='bench_output.json', help='json file to save the results in')
+    parser.add_argument('--compare', default=None, help='baseline json file to compare the results against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slowdown before flagging a regression')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    baselinefile = os.path.abspath(args.compare) if args.compare else None
+    results = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            for scalename in args.scales:
+                print('Scale', scalename, scales[scalename])
+                # separate data folders for each scale
+                os.makedirs(os.path.join(workdir, scalename))
+                os.chdir(os.path.join(workdir, scalename))
+                synapsestore.closestore()
+                results.extend(runscale(scalename, args.stages, args.repeat))
+        finally:
+            os.chdir(cwd)
+
+    report = {'meta': {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'pandas': pd.__version__,
+                       'machine': platform.machine(),
+                       'cpus': os.cpu_count()},
+              'results': results}
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('Saved results to', output)
+
+    if baselinefile:
+        with open(baselinefile) as f:
+            baseline = json.load(f)
+        n_regression = compare(results, baseline, args.tolerance)
+        if n_regression:
+            print(n_regression, 'regression(s) found')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""
+
+ Approximate Ward clustering for large numbers of cells
+
+ sch.linkage(method='ward') needs O(n^2) memory and time, which is fine for a
+ few thousand cells but not for 100k+. Here the cells are first over-clustered
+ into a few thousand micro-clusters with mini-batch k-means, then Ward
+ linkage is run on the micro-cluster centroids, weighted by the number of
+ cells in each of them. The linkage is in the scipy format (with micro-clusters
+ as leaves), so dendrogram() works on it, and cells get the cluster of their
+ micro-cluster when the tree is cut
+
+ compareexact() reports the agreement (adjusted Rand index) with exact Ward on
+ data small enough for exact Ward
+
+"""
+## Packages
+import numpy as np
+import pandas as pd
+import scipy.cluster.hierarchy as sch
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.metrics import adjusted_rand_score
+import modules.instrument as instrument
+
+
+# Over-cluster cells into n_micro micro-clusters, return the micro-cluster of
+# every cell, centroids and the number of cells in each micro-cluster
+def microclusters(mat_all,**kwargs):
+    if 'n_micro' in kwargs:
+        n_micro = kwargs.get('n_micro')
+    else:
+        n_micro = 2000
+    if 'seed' in kwargs:
+        seed = kwargs.get('seed')
+    else:
+        seed = 0
+    if 'batchSize' in kwargs:
+        batchSize = kwargs.get('batchSize')
+    else:
+        batchSize = 4096
+
+    if n_micro >= mat_all.shape[0]:
+        # few enough cells: every cell is its own micro-cluster (exact Ward)
+        return np.arange(mat_all.shape[0]), np.asarray(mat_all), np.ones(mat_all.shape[0], dtype=np.int64)
+    kmeans = MiniBatchKMeans(n_clusters=n_micro, batch_size=batchSize, n_init=3, random_state=seed)
+    assignment = kmeans.fit_predict(mat_all)
+    counts = np.bincount(assignment, minlength=n_micro)
+    # drop micro-clusters that ended up empty
+    used = np.flatnonzero(counts)
+    relabel = np.full(n_micro, -1)
+    relabel[used] = np.arange(len(used))
+    return relabel[assignment], kmeans.cluster_centers_[used], counts[used]
+
+
+# Ward linkage of points with weights (e.g. centroids and sizes of clusters)
+# in the scipy format, computed with the nearest neighbor chain algorithm
+# Memory is O(n*features), so this works on many more points than sch.linkage
+# With unit weights, this gives the same tree as sch.linkage(method='ward')
+def weightedward(points,weights):
+    n = points.shape[0]
+    centroids = np.array(points, dtype=np.float64)
+    sizes = np.array(weights, dtype=np.float64)
+    active = np.ones(n, dtype=bool)
+    # merges made by the algorithm (not in the order of height)
+    merges = np.zeros((max(n-1,0),3))
+    n_merge = 0
+    chain = []
+    while n_merge < n-1:
+        if not chain:
+            chain.append(np.flatnonzero(active)[0])
+        a = chain[-1]
+        # Ward distance from a to all the other active clusters
+        d2 = np.sum((centroids-centroids[a])**2,axis=1)*(2*sizes*sizes[a]/(sizes+sizes[a]))
+        d2[~active] = np.inf
+        d2[a] = np.inf
+        # prefer the previous element of the chain in ties, so the chain terminates
+        b = np.argmin(d2)
+        if len(chain)>1 and d2[chain[-2]] <= d2[b]:
+            b = chain[-2]
+        if len(chain)>1 and b == chain[-2]:
+            # a and b are reciprocal nearest neighbors: merge them into a
+            chain.pop()
+            chain.pop()
+            merges[n_merge] = (a, b, np.sqrt(d2[b]))
+            n_merge += 1
+            total = sizes[a]+sizes[b]
+            centroids[a] = (centroids[a]*sizes[a]+centroids[b]*sizes[b])/total
+            sizes[a] = total
+            active[b] = False
+        else:
+            chain.append(b)
+    return tolinkage(merges, n)
+
+
+# Sort merges by height and relabel clusters the way scipy does (new clusters
+# get n, n+1, ... in the order they are made). The last column counts leaves,
+# as scipy requires, not their weights
+def tolinkage(merges,n):
+    order = np.argsort(merges[:,2], kind='stable')
+    # union-find over the original points
+    parent = np.arange(2*n-1)
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+    count = np.zeros(2*n-1)
+    count[:n] = 1
+    Z = np.zeros((n-1,4))
+    for ii, mm in enumerate(order):
+        ca = find(int(merges[mm,0]))
+        cb = find(int(merges[mm,1]))
+        new = n+ii
+        parent[ca] = new
+        parent[cb] = new
+        count[new] = count[ca]+count[cb]
+        Z[ii] = (min(ca,cb), max(ca,cb), merges[mm,2], count[new])
+    return Z
+
+
+# Approximate Ward linkage of the cells (rows of mat_all). Returns the linkage
+# of the micro-clusters and the micro-cluster of every cell
+@instrument.timed('approxlinkage')
+def approxlinkage(mat_all,**kwargs):
+    if 'n_micro' in kwargs:
+        n_micro = kwargs.get('n_micro')
+    else:
+        n_micro = 2000
+    kwargs['n_micro'] = n_micro
+    print('Approximate Ward clustering of',mat_all.shape[0],'cells via',min(n_micro,mat_all.shape[0]),'micro-clusters...')
+    assignment, centroids, counts = microclusters(mat_all, **kwargs)
+    linkage = weightedward(centroids, counts)
+    return linkage, assignment
+
+
+# Cut an approximate linkage into (at most) n_cluster clusters, label every cell
+def approxfcluster(linkage,assignment,n_cluster):
+    microlabel = sch.fcluster(linkage, n_cluster, criterion='maxclust')
+    return microlabel[assignment]
+
+
+# Agreement between the approximate and exact Ward clusters at every k
+# (exact Ward is only run up to exactLimit cells; pass linkage and assignment
+# to reuse an existing approximate tree)
+def compareexact(mat_all,klist,**kwargs):
+    if 'exactLimit' in kwargs:
+        exactLimit = kwargs.get('exactLimit')
+    else:
+        exactLimit = 30000
+    if mat_all.shape[0] > exactLimit:
+        print('Too many cells for exact Ward (',mat_all.shape[0],'>',exactLimit,'), skipping comparison')
+        return None
+    exact = sch.linkage(mat_all, method='ward', metric='euclidean')
+    if 'linkage' in kwargs and 'assignment' in kwargs:
+        approx = kwargs.get('linkage')
+        assignment = kwargs.get('assignment')
+    else:
+        approx, assignment = approxlinkage(mat_all, **kwargs)
+    rows = []
+    for k in np.atleast_1d(klist):
+        ari = adjusted_rand_score(sch.fcluster(exact, k, criterion='maxclust'),
+                                  approxfcluster(approx, assignment, k))
+        rows.append({'k': int(k), 'ARI': ari})
+        print('k =',int(k),' ARI between approximate and exact Ward:',ari)
+    return pd.DataFrame(rows)
@@ -0,0 +1,180 @@
+"""
+
+ Artifact cache
+
+ Every saved artifact (bodyId lists, connectivity matrices, landmark synapses,
+ depth/spread matrices) is registered in a manifest (data/manifest.json) under
+ a key made from the hash of all the parameters it was generated from (plus the
+ dataset version). Modules look artifacts up by their parameters instead of
+ asking which file to load, so runs do not need any input from the command line
+
+ Artifacts saved before the manifest existed are adopted the first time they
+ are looked up, provided that their file name encodes the same parameters and
+ that no manifest entry already records the file (see adoptable())
+
+ Least recently used artifacts are removed when the cache grows over the limits
+ set with configure(maxBytes=..., maxEntries=...)
+
+"""
+## Packages
+import hashlib
+import json
+import os
+import threading
+import time
+import modules.datadir as datadir
+import modules.instrument as instrument
+import modules.matrixfile as matrixfile
+import modules.neuprintclient as neuprintclient
+
+# eviction limits (0 or None: no limit)
+settings = {'maxBytes': None, 'maxEntries': None}
+
+_lock = threading.Lock()
+
+
+def configure(**kwargs):
+    for key in kwargs:
+        if key not in settings:
+            raise KeyError('Unknown cache setting: '+key)
+    settings.update(kwargs)
+
+
+# numbers are hashed as floats, so that e.g. minD=-20 and minD=-20.0 share a key
+def normalize(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return value
+    if isinstance(value, (list, tuple)):
+        return [normalize(v) for v in value]
+    return value
+
+
+def makekey(kind, params):
+    keyparams = {key: normalize(value) for key, value in params.items()}
+    keyparams['kind'] = kind
+    keyparams['dataset'] = neuprintclient.settings['dataset']
+    keystr = json.dumps(keyparams, sort_keys=True)
+    return kind+'_'+hashlib.sha1(keystr.encode()).hexdigest()[:16]
+
+
+# the manifest lives in the data folder (see modules/datadir.py)
+def manifestpath():
+    return datadir.datapath('manifest.json')
+
+
+def loadmanifest():
+    manifestFile = manifestpath()
+    if os.path.exists(manifestFile):
+        with open(manifestFile) as f:
+            return json.load(f)
+    return {}
+
+
+def savemanifest(manifest):
+    manifestFile = manifestpath()
+    os.makedirs(os.path.dirname(manifestFile), exist_ok=True)
+    tmpfile = manifestFile+'.tmp'
+    with open(tmpfile,'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmpfile, manifestFile)
+
+
+# Return the path of the artifact generated from params, or None (cache miss)
+# If the manifest does not know it but a file named adopt exists (e.g. saved
+# before the manifest existed), that file is registered and returned. adopt
+# can also be a list of names the file may have, the first one found is used.
+# Files are adopted only for the dataset all of them were made from
+def lookup(kind, params, adopt=None):
+    key = makekey(kind, params)
+    with _lock:
+        manifest = loadmanifest()
+        entry = manifest.get(key)
+        if entry is not None and os.path.exists(entry['path']):
+            entry['accessed'] = time.time()
+            savemanifest(manifest)
+            print('Cache hit for '+kind+': '+entry['path'])
+            instrument.cachehit(kind)
+            return entry['path']
+        if entry is not None:
+            # the file was removed by hand
+            del manifest[key]
+            savemanifest(manifest)
+    candidates = [adopt] if isinstance(adopt, str) else list(adopt or [])
+    for path in candidates:
+        if adoptable(path, manifest):
+            register(kind, params, path)
+            print('Cache hit for '+kind+' (adopted): '+path)
+            instrument.cachehit(kind)
+            return path
+    print('Cache miss for '+kind)
+    instrument.cachemiss(kind)
+    return None
+
+
+# A file can be adopted if it exists, the current dataset is the one all the
+# files saved before the manifest were made from, no manifest entry already
+# records it (e.g. under another dataset), and its sidecar (binary matrices,
+# see modules/matrixfile.py), if any, names the same dataset
+def adoptable(path, manifest):
+    if not os.path.exists(path) or neuprintclient.settings['dataset']!='hemibrain:v1.2.1':
+        return False
+    if any(os.path.normpath(entry['path'])==os.path.normpath(path) for entry in manifest.values()):
+        return False
+    sidecar = matrixfile.sidecarpath(path)
+    if path.endswith('.npz') and os.path.exists(sidecar):
+        with open(sidecar) as f:
+            if json.load(f).get('dataset') != neuprintclient.settings['dataset']:
+                return False
+    return True
+
+
+# Register a saved artifact, then evict old ones if the cache is over the limits
+def register(kind, params, path):
+    key = makekey(kind, params)
+    now = time.time()
+    with _lock:
+        manifest = loadmanifest()
+        manifest[key] = {'kind': kind, 'params': params, 'path': path,
+                         'dataset': neuprintclient.settings['dataset'],
+                         'bytes': os.path.getsize(path), 'created': now, 'accessed': now}
+        savemanifest(manifest)
+    evict(keep=key)
+    return key
+
+
+# Remove least recently used artifacts until the cache is within the limits
+def evict(keep=None, **kwargs):
+    maxBytes = kwargs.get('maxBytes', settings['maxBytes'])
+    maxEntries = kwargs.get('maxEntries', settings['maxEntries'])
+    if not maxBytes and not maxEntries:
+        return []
+    removed = []
+    with _lock:
+        manifest = loadmanifest()
+        order = sorted(manifest, key=lambda key: manifest[key]['accessed'])
+        total = sum(entry['bytes'] for entry in manifest.values())
+        for key in order:
+            if (not maxBytes or total <= maxBytes) and (not maxEntries or len(manifest) <= maxEntries):
+                break
+            if key == keep:
+                continue
+            entry = manifest.pop(key)
+            total -= entry['bytes']
+            if os.path.exists(entry['path']):
+                os.remove(entry['path'])
+            # metadata sidecar of binary matrices (see modules/matrixfile.py)
+            sidecar = matrixfile.sidecarpath(entry['path'])
+            if entry['path'].endswith('.npz') and os.path.exists(sidecar):
+                os.remove(sidecar)
+            removed.append(entry['path'])
+        savemanifest(manifest)
+    for path in removed:
+        print('Evicted from the cache: '+path)
+    return removed
@@ -0,0 +1,79 @@
+"""
+
+ Concurrent download engine
+
+ Runs many Cypher queries against neuPrint with a bounded number of them in
+ flight at the same time, so that downloads are limited by bandwidth rather
+ than by the round-trip time of each query.
+
+ The event loop hands each query to a worker thread with its own neuPrint
+ client (see neuprintclient.py), all sharing the same connection pool, retry
+ and rate-limit settings. Results are returned in the order of the queries
+ regardless of the order in which they complete.
+
+"""
+## Packages
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import modules.neuprintclient as neuprintclient
+
+
+# Run a list of Cypher queries with at most n_concurrent of them in flight
+# and return the resulting dataframes in the order of the queries
+# If provided, callback(ii, df) is called as soon as the ii-th query is done.
+# Callbacks run one at a time in the event loop, so they can safely write caches
+def fetchall(queries,**kwargs):
+    if 'n_concurrent' in kwargs:
+        n_concurrent = kwargs.get('n_concurrent')
+    else:
+        n_concurrent = 8
+
+    if 'callback' in kwargs:
+        callback = kwargs.get('callback')
+    else:
+        callback = None
+
+    return runasync(fetchallasync(list(queries), n_concurrent, callback))
+
+
+async def fetchallasync(queries,n_concurrent,callback):
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(n_concurrent)
+
+    with ThreadPoolExecutor(max_workers=n_concurrent) as executor:
+        async def fetchone(ii,q):
+            async with semaphore:
+                df = await loop.run_in_executor(executor, fetchquery, q)
+            if callback is not None:
+                callback(ii, df)
+            return df
+        results = await asyncio.gather(*[fetchone(ii,q) for ii,q in enumerate(queries)])
+    return results
+
+
+def fetchquery(q):
+    c = neuprintclient.getclient()
+    return c.fetch_custom(q)
+
+
+# Run a coroutine to completion, also from environments where an event loop is
+# already running (e.g. IPython/Spyder consoles)
+def runasync(coroutine):
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    result = {}
+    def runinthread():
+        try:
+            result['value'] = asyncio.run(coroutine)
+        except BaseException as ex:
+            result['error'] = ex
+    thread = threading.Thread(target=runinthread)
+    thread.start()
+    thread.join()
+    if 'error' in result:
+        raise result['error']
+    return result['value']
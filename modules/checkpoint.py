@@ -0,0 +1,106 @@
+"""
+
+ Checkpoints of long calculations over a list of cells
+
+ Calculations done on a list of bodyIds chunk by chunk (connectivity queries,
+ morphology shards) save the results of finished chunks every few chunks as a
+ part file under data/checkpoint/<kind>_<hash>/. Parts are written to a
+ temporary file and renamed, so a part is either complete or absent, also when
+ the run is killed. The folder is named after a hash of the bodyIds and the
+ parameters, so running the same calculation again finds the parts, skips the
+ chunks saved in them and reports what was skipped. The folder is removed once
+ all the chunks are done
+
+"""
+## Packages
+import glob
+import hashlib
+import json
+import os
+import shutil
+import threading
+import numpy as np
+import modules.datadir as datadir
+import modules.instrument as instrument
+import modules.neuprintclient as neuprintclient
+
+
+class Checkpoint:
+    # every: number of finished chunks kept in memory before a part is written
+    def __init__(self, kind, bodyids, params, every=10):
+        self.kind = kind
+        self.folder = datadir.datapath('checkpoint', kind+'_'+checkpointkey(kind, bodyids, params))
+        self.every = max(int(every), 1)
+        self.done = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        for path in sorted(glob.glob(os.path.join(self.folder,'part_*.npz'))):
+            self.done.update(readpart(path))
+        self.n_part = len(glob.glob(os.path.join(self.folder,'part_*.npz')))
+
+    # Report the chunks found in the checkpoint (of n_chunk, holding n_cell cells)
+    def report(self, n_chunk, n_cell=None):
+        if self.done:
+            text = 'Resuming '+self.kind+' from '+self.folder+': '+str(len(self.done))+' of '+str(n_chunk)+' chunks'
+            if n_cell is not None:
+                text += ' ('+str(n_cell)+' cells)'
+            print(text+' are already done and skipped')
+            instrument.count('resumedChunks.'+self.kind, len(self.done))
+
+    # Results of a finished chunk (a dict of arrays); saved every few chunks
+    def add(self, chunk, **arrays):
+        with self.lock:
+            self.pending[int(chunk)] = arrays
+            if len(self.pending) >= self.every:
+                self.flushlocked()
+
+    def flush(self):
+        with self.lock:
+            self.flushlocked()
+
+    def flushlocked(self):
+        if not self.pending:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        path = os.path.join(self.folder, 'part_%05d.npz' % self.n_part)
+        arrays = {'c'+str(chunk)+'_'+name: value for chunk, values in self.pending.items() for name, value in values.items()}
+        arrays['chunks'] = np.array(sorted(self.pending), dtype=np.int64)
+        with open(path+'.tmp', 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(path+'.tmp', path)
+        self.n_part += 1
+        self.done.update(self.pending)
+        self.pending = {}
+
+    # Results of all the finished chunks, saved or not, by chunk index
+    def results(self):
+        with self.lock:
+            out = dict(self.done)
+            out.update(self.pending)
+        return out
+
+    # Remove the checkpoint (once the calculation is complete)
+    def remove(self):
+        with self.lock:
+            self.pending = {}
+            self.done = {}
+        if os.path.exists(self.folder):
+            shutil.rmtree(self.folder)
+
+
+# Hash of the kind of calculation, bodyIds (in order), parameters and dataset
+def checkpointkey(kind, bodyids, params):
+    sha = hashlib.sha1(json.dumps({'kind': kind, 'params': params,
+                                   'dataset': neuprintclient.settings['dataset']}, sort_keys=True).encode())
+    sha.update(np.ascontiguousarray(np.asarray(bodyids, dtype=np.int64)).tobytes())
+    return sha.hexdigest()[:16]
+
+
+# Chunks saved in a part file: {chunk index: {name: array}}
+def readpart(path):
+    out = {}
+    with np.load(path) as saved:
+        for chunk in saved['chunks']:
+            prefix = 'c'+str(int(chunk))+'_'
+            out[int(chunk)] = {key[len(prefix):]: saved[key] for key in saved.files if key.startswith(prefix)}
+    return out
@@ -0,0 +1,70 @@
+"""
+
+ Read the analysis parameters from a config file (config.ini by default)
+
+ loadconfig() returns a dict of sections, each a dict of parameters. Values are
+ converted to int/float where possible, and comma separated values to tuples.
+ applyconfig() passes the neuPrint, cache, instrumentation and synthetic data
+ settings on to the modules they belong to, and switches matplotlib to a non-interactive backend
+ in the figure export mode
+
+"""
+## Packages
+import configparser
+import os
+import matplotlib
+import modules.artifactcache as artifactcache
+import modules.instrument as instrument
+import modules.neuprintclient as neuprintclient
+import modules.synthetic as synthetic
+
+
+def parsevalue(value):
+    if ',' in value:
+        return tuple(parsevalue(v.strip()) for v in value.split(',') if v.strip())
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    return value
+
+
+def loadconfig(path='config.ini'):
+    if not os.path.exists(path):
+        raise FileNotFoundError('Config file '+path+' not found')
+    parser = configparser.ConfigParser(inline_comment_prefixes=('#',';'))
+    parser.optionxform = str # keep the case of parameter names (e.g. minD)
+    parser.read(path)
+    cfg = {}
+    for section in parser.sections():
+        cfg[section] = {key: parsevalue(value.replace('\n',' ')) for key, value in parser[section].items()}
+    return cfg
+
+
+def applyconfig(cfg):
+    if 'neuprint' in cfg:
+        neuprintkwargs = {key: value for key, value in cfg['neuprint'].items() if key in neuprintclient.settings}
+        neuprintclient.configure(**neuprintkwargs)
+    if 'cache' in cfg:
+        artifactcache.configure(**cfg['cache'])
+    if 'instrument' in cfg:
+        instrument.configure(**cfg['instrument'])
+    if 'synthetic' in cfg and cfg['synthetic'].get('use_synthetic'):
+        synthetic.usesyntheticdata(**{key: value for key, value in cfg['synthetic'].items() if key != 'use_synthetic'})
+        synthetic.makedatadirs()
+    if 'figures' in cfg and cfg['figures'].get('export'):
+        # no window is opened (e.g. on nodes without a display)
+        matplotlib.use('Agg')
+
+
+# Keyword arguments for the data loading functions (getconnectivity,
+# getmorphology, ...) made from the data, morphology and neuprint sections
+def datakwargs(cfg):
+    kwargs = {}
+    kwargs.update(cfg.get('data', {}))
+    kwargs.update(cfg.get('morphology', {}))
+    for key in ('n_concurrent','n_workers'):
+        if key in cfg.get('neuprint', {}):
+            kwargs[key] = cfg['neuprint'][key]
+    return kwargs
@@ -0,0 +1,28 @@
+"""
+
+ Folder of the saved data
+
+ All the data the modules download, calculate and save (bodyId lists,
+ connectivity, synapses, landmark, morphology, the manifest of the artifact
+ cache, checkpoints, results) live under one root folder, ./data by default.
+ Runs on the synthetic dataset use ./data/synthetic instead (see
+ modules/synthetic.py), so they never overwrite data of the real dataset
+
+"""
+## Packages
+import os
+
+# default settings
+settings = {'root': os.path.join('.','data')}
+
+
+def configure(**kwargs):
+    for key in kwargs:
+        if key not in settings:
+            raise KeyError('Unknown data folder setting: '+key)
+    settings.update(kwargs)
+
+
+# Path of a file or folder under the data root, e.g. datapath('depth', filename)
+def datapath(*parts):
+    return os.path.join(settings['root'], *parts)
@@ -0,0 +1,128 @@
+"""
+
+ Depth engine: lobula layer depth of synapses from raw coordinate arrays
+
+ Works on (N, 3) coordinate buffers (int32 as saved in the synapse store, or
+ float) in chunks of fixed size, writing into preallocated outputs. The unit
+ conversion (8 nm px to microns), PCA projection and quadric model are applied
+ to one chunk at a time using a few reusable buffers, so memory stays bounded
+ however many synapses there are. Calculations can be done in float32
+
+ calcdepth() takes a coordinate array (or memmap), calcdepthcells() reads the
+ synapses of a list of cells straight from the memory-mapped synapse store
+
+"""
+## Packages
+import numpy as np
+import modules.synapsestore as synapsestore
+
+
+# Depth (deviation from the quadric model along PC3) and PCs of synapses at xyz
+# Returns rawdepth (N,) and PCs (N,3) (PCs is None with returnPCs=0)
+def calcdepth(xyz,pca,coeff,**kwargs):
+    # number of synapses processed at once
+    if 'chunkSize' in kwargs:
+        chunkSize = kwargs.get('chunkSize')
+    else:
+        chunkSize = 1<<20
+    if 'dtype' in kwargs:
+        dtype = np.dtype(kwargs.get('dtype'))
+    else:
+        dtype = np.dtype(np.float64)
+    if 'returnPCs' in kwargs:
+        returnPCs = kwargs.get('returnPCs')
+    else:
+        returnPCs = 1
+
+    n = xyz.shape[0]
+    rawdepth = kwargs.get('out', None)
+    if rawdepth is None:
+        rawdepth = np.empty(n, dtype=dtype)
+    PCs = np.empty((n,3), dtype=dtype) if returnPCs else None
+    engine = makeengine(pca, coeff, dtype, min(chunkSize,max(n,1)))
+    for start in range(0, n, chunkSize):
+        stop = min(n, start+chunkSize)
+        engine(xyz[start:stop], rawdepth[start:stop], None if PCs is None else PCs[start:stop])
+    return rawdepth, PCs
+
+
+# Depth and PCs of the synapses of many cells, read from the synapse store
+# (cells are concatenated in the order of bodyids). Also returns the number of
+# synapses of each cell (0 for cells missing from the store)
+def calcdepthcells(bodyids,synapseType,pca,coeff,**kwargs):
+    if 'chunkSize' in kwargs:
+        chunkSize = kwargs.get('chunkSize')
+    else:
+        chunkSize = 1<<20
+    if 'dtype' in kwargs:
+        dtype = np.dtype(kwargs.get('dtype'))
+    else:
+        dtype = np.dtype(np.float64)
+
+    # zero-copy views into the memory-mapped segments
+    arrays = [synapsestore.getsynapsearray(bodyid, synapseType) for bodyid in bodyids]
+    n_syn = np.array([0 if xyz is None else len(xyz) for xyz in arrays], dtype=np.int64)
+    n = int(np.sum(n_syn))
+    rawdepth = np.empty(n, dtype=dtype)
+    PCs = np.empty((n,3), dtype=dtype)
+    engine = makeengine(pca, coeff, dtype, min(chunkSize,max(n,1)))
+
+    # gather cells into a chunk buffer, run the engine whenever it is full
+    chunk = np.empty((min(chunkSize,max(n,1)),3), dtype=np.int32)
+    filled = 0
+    written = 0
+    for xyz in arrays:
+        pos = 0
+        while xyz is not None and pos < len(xyz):
+            take = min(len(xyz)-pos, len(chunk)-filled)
+            chunk[filled:filled+take] = xyz[pos:pos+take]
+            filled += take
+            pos += take
+            if filled == len(chunk):
+                engine(chunk, rawdepth[written:written+filled], PCs[written:written+filled])
+                written += filled
+                filled = 0
+    if filled:
+        engine(chunk[:filled], rawdepth[written:written+filled], PCs[written:written+filled])
+    return rawdepth, PCs, n_syn
+
+
+# Function calculating depth/PCs of one chunk of coordinates into the given
+# outputs, with the model folded into a few constants and reusable buffers
+def makeengine(pca,coeff,dtype,chunkSize):
+    if getattr(pca, 'whiten', False):
+        raise ValueError('Whitened PCA is not supported')
+    mean = np.asarray(pca.mean_, dtype=dtype)
+    componentsT = np.ascontiguousarray(np.asarray(pca.components_, dtype=dtype).T)
+    c0, c1, c2, c3, c4, c5 = [dtype.type(c) for c in np.ravel(coeff)]
+    XYZ = np.empty((chunkSize,3), dtype=dtype)
+    PCbuf = np.empty((chunkSize,3), dtype=dtype)
+    t1 = np.empty(chunkSize, dtype=dtype)
+    t2 = np.empty(chunkSize, dtype=dtype)
+
+    def engine(xyz,rawdepth,PCs):
+        m = xyz.shape[0]
+        X = XYZ[:m]
+        # 8 nm px to microns (x*8/1000 = x/125), then PCA
+        np.divide(xyz, 125, out=X, casting='unsafe')
+        X -= mean
+        P = PCbuf[:m] if PCs is None else PCs
+        np.matmul(X, componentsT, out=P)
+        # quadric model: c0 + PC1*(c1 + c3*PC1 + c5*PC2) + PC2*(c2 + c4*PC2)
+        PC1 = P[:,0]
+        PC2 = P[:,1]
+        a = t1[:m]
+        b = t2[:m]
+        np.multiply(PC1, c3, out=a)
+        a += c1
+        np.multiply(PC2, c5, out=b)
+        a += b
+        a *= PC1
+        np.multiply(PC2, c4, out=b)
+        b += c2
+        b *= PC2
+        a += b
+        a += c0
+        # depth is the deviation from the predicted PC3
+        np.subtract(P[:,2], a, out=rawdepth)
+    return engine
@@ -0,0 +1,189 @@
+"""
+
+ Out-of-core assembly of the feature matrix used for clustering
+
+ The connectivity, depth and spread matrices are streamed from their files (csv
+ or npz, see modules/matrixfile.py) in chunks of rows into one preallocated float32 memmap (mat_all), instead of
+ loading them as DataFrames, converting them to float64, making normalized
+ copies and concatenating them. The total dispersion of each block (sum of the
+ column variances) is accumulated in the same pass, then the normalization and
+ weighting are applied in place, so peak memory stays near one copy of mat_all
+
+ Unnormalized values are never recovered from mat_all (dividing float32
+ values by the scale is not exact). Narrow blocks (depth, spread) are kept as
+ they were read, and columns or per-cluster sums of wide blocks (connectivity)
+ are read again from their file, a chunk of rows at a time (see rawblock and
+ groupsums)
+
+ mat_all is saved in a file of its own for every process, removed when the
+ process exits, so that concurrent runs do not overwrite each other's matrix
+
+"""
+## Packages
+import atexit
+import os
+import numpy as np
+from scipy import sparse
+import modules.datadir as datadir
+import modules.instrument as instrument
+import modules.matrixfile as matrixfile
+
+blocknames = ('connectivity','depth','spread')
+
+
+# Combine running (count, mean, M2) column statistics with those of a new chunk
+# (Chan et al.'s parallel variance algorithm, stable for large counts)
+def updatestats(stats,chunk):
+    n_a, mean_a, M2_a = stats
+    n_b = chunk.shape[0]
+    if n_b == 0:
+        return stats
+    mean_b = np.mean(chunk, axis=0)
+    M2_b = np.sum((chunk-mean_b)**2, axis=0)
+    n = n_a+n_b
+    delta = mean_b-mean_a
+    mean = mean_a+delta*n_b/n
+    M2 = M2_a+M2_b+delta**2*n_a*n_b/n
+    return n, mean, M2
+
+
+# Stream the matrices in paths (connectivity, depth, spread files) into a
+# float32 memmap, normalized by their total dispersion and weighted by
+# data_weight. Returns the memmap and a dict describing it (see rawblock)
+@instrument.timed('assemblefeatures')
+def assemblefeatures(paths,data_weight,**kwargs):
+    # number of rows read at once
+    if 'chunkSize' in kwargs:
+        chunkSize = kwargs.get('chunkSize')
+    else:
+        chunkSize = 2000
+    if 'outfile' in kwargs:
+        outfile = kwargs.get('outfile')
+    else:
+        outfile = datadir.datapath('features','mat_all_'+str(os.getpid())+'.dat')
+        atexit.register(removefile, outfile)
+    if 'dtype' in kwargs:
+        dtype = np.dtype(kwargs.get('dtype'))
+    else:
+        dtype = np.dtype(np.float32)
+    # blocks with at most this many columns are also kept unnormalized in memory
+    if 'rawColumns' in kwargs:
+        rawColumns = kwargs.get('rawColumns')
+    else:
+        rawColumns = 64
+
+    print('Assembling the feature matrix from',len(paths),'files...')
+    headers = [matrixfile.readheader(path) for path in paths]
+    n_row = headers[0][2]
+    if any(header[2]!=n_row for header in headers):
+        raise ValueError('Feature matrices have different numbers of cells')
+
+    # column range of each block in mat_all
+    columns = []
+    start = 0
+    for header, datastart, _ in headers:
+        columns.append((start, start+len(header)-datastart))
+        start += len(header)-datastart
+    n_col = start
+
+    os.makedirs(os.path.dirname(outfile), exist_ok=True)
+    # (the memmap itself, not a view of it, so that worker processes can open
+    # the file again; see modules/figureexport.py)
+    mat_all = np.memmap(outfile, dtype=dtype, mode='w+', shape=(n_row,max(n_col,1)))
+    if n_col == 0:
+        mat_all = mat_all[:,:0]
+    bodyids = np.zeros(n_row, dtype=np.int64)
+
+    # one pass over each file: copy rows in and accumulate column statistics
+    disp = []
+    sums = []
+    raw = []
+    for bb, path in enumerate(paths):
+        header, datastart, _ = headers[bb]
+        c0, c1 = columns[bb]
+        stats = (0, np.zeros(c1-c0), np.zeros(c1-c0))
+        rawvalues = np.zeros((n_row,c1-c0)) if c1-c0 <= rawColumns else None
+        total = np.zeros(c1-c0)
+        row = 0
+        for chunkids, values in matrixfile.readchunks(path, chunkSize):
+            if bb == 0:
+                bodyids[row:row+len(chunkids)] = chunkids
+            elif not np.array_equal(bodyids[row:row+len(chunkids)], chunkids):
+                raise ValueError('Feature matrices are based on different lists of cells: '+path)
+            mat_all[row:row+len(chunkids),c0:c1] = values
+            if rawvalues is not None:
+                rawvalues[row:row+len(chunkids)] = values
+            stats = updatestats(stats, values)
+            total += np.sum(values, axis=0)
+            row += len(chunkids)
+        # population variance (np.var default)
+        disp.append(np.sum(stats[2]/max(stats[0],1)))
+        sums.append(total)
+        raw.append(rawvalues)
+
+    # normalize and weight in place, a chunk of rows at a time
+    scales = [w/d for w, d in zip(data_weight, disp)]
+    for row in range(0, n_row, chunkSize):
+        for (c0, c1), scale in zip(columns, scales):
+            mat_all[row:row+chunkSize,c0:c1] *= scale
+    mat_all.flush()
+
+    info = {'bodyId': bodyids,
+            'labels': [header[datastart:] for header, datastart, _ in headers],
+            'columns': columns,
+            'dispersion': disp,
+            'scales': scales,
+            'sums': sums,
+            'raw': raw,
+            'paths': list(paths),
+            'chunkSize': chunkSize}
+    for name, d in zip(blocknames, disp):
+        print('total dispersion of '+name+' ', d)
+    return mat_all, info
+
+
+# Unnormalized values of one block (0: connectivity, 1: depth, 2: spread),
+# optionally only some of its columns. Narrow blocks come from memory, wide
+# ones are read from their file (ask for the columns needed only)
+def rawblock(mat_all,info,block,cols=None):
+    if info['raw'][block] is not None:
+        values = info['raw'][block]
+        return values.copy() if cols is None else values[:,np.asarray(cols)]
+    c0, c1 = info['columns'][block]
+    cols = np.arange(c1-c0) if cols is None else np.asarray(cols)
+    values = np.zeros((len(info['bodyId']),len(cols)))
+    row = 0
+    for chunkids, chunk in matrixfile.readchunks(info['paths'][block], info['chunkSize']):
+        values[row:row+len(chunkids)] = chunk[:,cols]
+        row += len(chunkids)
+    return values
+
+
+# Sum and mean of the unnormalized values of one block (optionally only some
+# of its columns) for each label, reduced a chunk of rows at a time, so that
+# wide blocks are never held in memory. Returns a dict with labels, counts,
+# sum and mean (as utility.groupstats)
+def groupsums(info,block,label,cols=None):
+    label = np.asarray(label)
+    labels, inverse = np.unique(label, return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(labels))
+    c0, c1 = info['columns'][block]
+    cols = np.arange(c1-c0) if cols is None else np.asarray(cols)
+    total = np.zeros((len(labels),len(cols)))
+    if info['raw'][block] is not None:
+        chunks = [(np.arange(len(label)), info['raw'][block])]
+    else:
+        chunks = matrixfile.readchunks(info['paths'][block], info['chunkSize'])
+    row = 0
+    for chunkids, chunk in chunks:
+        n = len(chunkids)
+        # (labels x rows) indicator matrix times the rows of the chunk
+        indicator = sparse.csr_matrix((np.ones(n), (inverse[row:row+n], np.arange(n))), shape=(len(labels),n))
+        total += indicator @ chunk[:,cols]
+        row += n
+    return {'labels': labels, 'counts': counts, 'sum': total, 'mean': total/counts[:,None]}
+
+
+def removefile(path):
+    if os.path.exists(path):
+        os.remove(path)
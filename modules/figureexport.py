@@ -0,0 +1,225 @@
+"""
+
+ Headless figure export
+
+ A figure is given as a job (name, function, args, kwargs), the function
+ drawing the figure and returning it (see modules/figures.py). In export mode
+ the figures are rendered on the non-interactive Agg backend in worker
+ processes and saved as outdir/<name>.<format> for every format (png, pdf,
+ svg, ...), and no window is opened. Otherwise they are drawn and shown as
+ before with plt.show()
+
+ Every exported figure is stamped with a hash of the source of its function,
+ of the modules drawing the figures (modules/figures.py, visualize.py,
+ utility.py) and of its arguments (outdir/figures.json). Figures whose stamp
+ did not change and whose files exist are not rendered again
+
+ Arguments that are memmaps (e.g. the feature matrix, see modules/features.py)
+ are sent to the worker processes as their file name, dtype and shape, and
+ opened again there instead of being copied
+
+"""
+## Packages
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import inspect
+import json
+import mmap
+import os
+import pickle
+import numpy as np
+import matplotlib.pyplot as plt
+import modules.datadir as datadir
+import modules.figures as figures
+import modules.instrument as instrument
+import modules.neuprintclient as neuprintclient
+import modules.utility as utility
+import modules.visualize as visualize
+
+# modules whose source is part of every stamp (figure functions call into them)
+stampmodules = (figures, visualize, utility)
+
+stampfile = 'figures.json'
+
+
+# Draw the figures and show them, or export them (export=1, see exportfigures
+# for the other parameters)
+def showorexport(jobs,**kwargs):
+    if 'export' in kwargs:
+        export = kwargs.pop('export')
+    else:
+        export = 0
+    if export:
+        return exportfigures(jobs, **kwargs)
+    for name, func, args, fkwargs in jobs:
+        func(*args, **fkwargs)
+    plt.show()
+    return []
+
+
+# Render the figures whose inputs changed in n_workers processes and save them
+# in outdir. Returns the paths of the files written
+@instrument.timed('exportfigures')
+def exportfigures(jobs,**kwargs):
+    if 'outdir' in kwargs:
+        outdir = kwargs.get('outdir')
+    else:
+        outdir = datadir.datapath('figures')
+    if 'formats' in kwargs:
+        formats = kwargs.get('formats')
+    else:
+        formats = ('png',)
+    if 'n_workers' in kwargs:
+        n_workers = kwargs.get('n_workers')
+    else:
+        n_workers = 1
+    if 'dpi' in kwargs:
+        dpi = kwargs.get('dpi')
+    else:
+        dpi = 150
+    # render every figure even if its stamp did not change
+    if 'force' in kwargs:
+        force = kwargs.get('force')
+    else:
+        force = 0
+    if isinstance(formats, str):
+        formats = (formats,)
+
+    setheadless()
+    os.makedirs(outdir, exist_ok=True)
+    stamppath = os.path.join(outdir, stampfile)
+    stamps = readstamps(stamppath)
+    todo = []
+    for name, func, args, fkwargs in jobs:
+        stamp = figurestamp(func, args, fkwargs)
+        done = all(os.path.exists(os.path.join(outdir,name+'.'+fmt)) for fmt in formats)
+        if force or not done or stamps.get(name) != stamp:
+            todo.append((name, func, args, fkwargs, stamp))
+    print('Exporting',len(todo),'of',len(jobs),'figures to',outdir,
+          '('+str(len(jobs)-len(todo))+' unchanged)')
+
+    written = []
+    try:
+        if n_workers>1 and len(todo)>1:
+            with ProcessPoolExecutor(max_workers=min(n_workers,len(todo)), initializer=initexportworker,
+                                     initargs=(dict(datadir.settings), neuprintclient.settings['dataset'])) as executor:
+                futures = [executor.submit(renderfigure, name, func, packargs(args), packargs(fkwargs), outdir, formats, dpi)
+                           for name, func, args, fkwargs, _ in todo]
+                for (name, _, _, _, stamp), future in zip(todo, futures):
+                    written += future.result()
+                    stamps[name] = stamp
+        else:
+            for name, func, args, fkwargs, stamp in todo:
+                written += renderfigure(name, func, args, fkwargs, outdir, formats, dpi)
+                stamps[name] = stamp
+    finally:
+        # keep the stamps of the figures saved so far, even if one failed
+        writestamps(stamppath, stamps)
+    for path in written:
+        print('Saved',path)
+    return written
+
+
+# Switch matplotlib to the Agg backend (plt.show() then does nothing)
+def setheadless():
+    plt.switch_backend('Agg')
+
+
+# Worker processes use the data folder and dataset of the calling process
+# (spawned workers on Windows/macOS start with the defaults), so that e.g.
+# UMAP embeddings of the synthetic dataset are cached with it
+def initexportworker(datasettings,dataset):
+    setheadless()
+    datadir.configure(**datasettings)
+    neuprintclient.configure(dataset=dataset)
+
+
+# Draw one figure and save it in every format. Files are written under a
+# temporary name first, so an interrupted export never leaves a partial file
+def renderfigure(name,func,args,kwargs,outdir,formats,dpi):
+    fig = func(*unpackargs(args), **unpackargs(kwargs))
+    paths = []
+    for fmt in formats:
+        path = os.path.join(outdir, name+'.'+fmt)
+        fig.savefig(path+'.tmp', format=fmt, dpi=dpi)
+        os.replace(path+'.tmp', path)
+        paths.append(path)
+    plt.close(fig)
+    return paths
+
+
+# Hash of everything a figure is made from: the source of the function drawing
+# it, of the modules it calls into, and its arguments
+def figurestamp(func,args,kwargs):
+    sha = hashlib.sha1(inspect.getsource(func).encode())
+    for module in stampmodules:
+        sha.update(inspect.getsource(module).encode())
+    hashvalue(sha, list(args))
+    hashvalue(sha, kwargs)
+    return sha.hexdigest()
+
+
+def hashvalue(sha,value):
+    if isinstance(value, np.ndarray) and value.dtype != object:
+        sha.update(visualize.matrixhash(value).encode())
+    elif isinstance(value, (list,tuple)):
+        sha.update(b'[')
+        for item in value:
+            hashvalue(sha, item)
+        sha.update(b']')
+    elif isinstance(value, dict):
+        sha.update(b'{')
+        for key in sorted(value):
+            sha.update(str(key).encode())
+            hashvalue(sha, value[key])
+        sha.update(b'}')
+    else:
+        sha.update(pickle.dumps(value, protocol=4))
+
+
+# A memmap sent to a worker process by its file instead of its contents
+class MemmapArg:
+    def __init__(self, array):
+        self.filename = array.filename
+        self.dtype = array.dtype.str
+        self.shape = array.shape
+        self.offset = array.offset
+
+    def open(self):
+        return np.memmap(self.filename, dtype=self.dtype, mode='r', shape=self.shape, offset=self.offset)
+
+
+# Replace memmaps (opened on a whole file, not views of one) in the arguments
+# of a figure by MemmapArg, and back
+def packargs(value):
+    if isinstance(value, np.memmap) and isinstance(value.base, mmap.mmap) and value.filename:
+        value.flush()
+        return MemmapArg(value)
+    if isinstance(value, (list,tuple)):
+        return type(value)(packargs(item) for item in value)
+    if isinstance(value, dict):
+        return {key: packargs(item) for key, item in value.items()}
+    return value
+
+
+def unpackargs(value):
+    if isinstance(value, MemmapArg):
+        return value.open()
+    if isinstance(value, (list,tuple)):
+        return type(value)(unpackargs(item) for item in value)
+    if isinstance(value, dict):
+        return {key: unpackargs(item) for key, item in value.items()}
+    return value
+
+
+def readstamps(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def writestamps(path,stamps):
+    with open(path+'.tmp', 'w') as f:
+        json.dump(stamps, f, indent=1, sort_keys=True)
+    os.replace(path+'.tmp', path)
@@ -0,0 +1,129 @@
+"""
+
+ Figures of lobulaclustering.py (Fig. 3, Fig. 5, Appendix) and
+ morphology_validation.py (Fig. 2)
+
+ Each function takes the data a figure needs, draws it and returns the figure,
+ so that the scripts can either show them or have them rendered and saved by
+ modules/figureexport.py (in worker processes, hence module-level functions)
+
+"""
+## Packages
+import numpy as np
+import matplotlib.pyplot as plt
+import scipy.cluster.hierarchy as sch
+import modules.visualize as visualize
+
+
+## Clustering (lobulaclustering.py)
+
+# Dendrogram of cells of interest, truncated at n_cluster leaves (Fig. 3A)
+def dendrogramfigure(linkage,n_cluster):
+    fig, ax = plt.subplots()
+    sch.dendrogram(linkage, truncate_mode='lastp', p=n_cluster, ax=ax)
+    ax.set_title('Dendrogram of cells of interest (Fig. 3A)')
+    return fig
+
+
+# Feature matrix sorted by cluster (Fig. 3B-D)
+def sortedmatrixfigure(mat,clabel,title,xlabel,ylabel=None,**kwargs):
+    fig, ax = visualize.showsortedmatrix(mat,clabel,**kwargs)
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    if ylabel is not None:
+        ax.set_ylabel(ylabel)
+    return fig
+
+
+# Clusters in the UMAP space (Fig. 3E)
+def umapfigure(mat_all,clabel,umapkwargs):
+    fig, ax = visualize.showUMAPscatter2D(mat_all,clabel,**umapkwargs)
+    ax.set_title('UMAP on the concatenated weighted feature matrix (Fig. 3E)')
+    ax.set_xlabel('UMAP1')
+    ax.set_ylabel('UMAP2')
+    return fig
+
+
+# Mean depth profile of each cluster (Appendix Figs)
+def meandepthfigure(mat_dep,clabel):
+    fig, ax = visualize.plotmeanbycluster(mat_dep, clabel)
+    ax.set_title('Mean synapse per depth bin for each cluster (Appendix Figs)')
+    ax.set_xlabel('#Depth bin')
+    ax.set_ylabel('#synapses')
+    return fig
+
+
+# Mean spread profile of each cluster (Appendix Figs)
+def meanspreadfigure(mat_spr,clabel):
+    fig, ax = visualize.meanscatterwitherror(mat_spr,clabel)
+    ax[0].set_title('synapse spread (Appendix Figs)')
+    ax[0].set_xlabel('spread along PC1 (um)')
+    ax[0].set_ylabel('spread along PC2 (um)')
+    ax[1].set_xlabel('spread along PC2 (um)')
+    ax[1].set_ylabel('spread along PC3 (um)')
+    return fig
+
+
+# Pie charts of the inputs to each LC type from the clusters (Fig. 5A)
+def LCpiefigure(norm_con_LC_byCluster,LC_list,clusters):
+    fig, ax = plt.subplots(3,7)
+    for i in range(3):
+        for j in range(7):
+            ax[i,j].set_title(LC_list[i*7+j])
+            visualize.showsortedpiechart(norm_con_LC_byCluster[:,i*7+j],
+                                         cutoff=0.05,
+                                         labels=clusters,
+                                         ax=ax[i,j])
+    fig.suptitle('LP/LPLC inputs by cell of interest clusters (Fig. 5A)')
+    return fig
+
+
+# Dendrogram of LC types by their inputs from the clusters (Fig. 5B)
+def LCdendrogramfigure(linkage_reverse,LC_list):
+    fig, ax = plt.subplots()
+    sch.dendrogram(linkage_reverse, labels=LC_list, ax=ax)
+    ax.set_title('Clustering of LC/LPLCs by their connectivity to cell of interest clusters (Fig. 5B)')
+    return fig
+
+
+# Inputs to LC types from the clusters, LC types in the dendrogram order (Fig. 5B)
+def LCmatrixfigure(norm_con_LC_byCluster,LC_list,out_ind,n_cluster):
+    fig, ax = plt.subplots()
+    im = ax.imshow(norm_con_LC_byCluster[:,out_ind].T)
+    ax.set_xticks(np.arange(n_cluster))
+    ax.set_xticklabels(np.arange(n_cluster)+1)
+    ax.set_xlabel('cluster')
+    ax.set_yticks(np.arange(len(LC_list)))
+    ax.set_yticklabels(LC_list[out_ind])
+    ax.set_title('Normalized mean LP/LPLC inputs by cell of interest clusters (Fig. 5B)')
+    fig.colorbar(im,ax=ax)
+    return fig
+
+
+## Validation (morphology_validation.py)
+
+# Mean normalized innervation depth per cell type (Fig. 2B)
+def typedepthfigure(mean_dep,ctlist):
+    fig, ax, im = visualize.showmatrix(mean_dep.T,cmapname='GnBu')
+    ax.set_yticks(np.arange(15)-0.5)
+    ax.set_yticklabels(np.arange(-20,55,5))
+    ax.set_xticks(np.arange(len(ctlist)))
+    ax.set_xticklabels(ctlist,rotation=45,ha='right')
+    ax.set_ylabel('innervation depth (um)')
+    fig.suptitle('Fig. 2B')
+    fig.colorbar(im,ax=ax)
+    return fig
+
+
+# Cell-averaged spread features against each other, with SEM (Fig. 2C/D)
+def typespreadfigure(mean_spr,sem_spr,ctlist):
+    fig, ax = plt.subplots(1,2)
+    fig.suptitle('Fig. 2C/D')
+    for ii in range(2):
+        ax[ii].errorbar(mean_spr[:,ii],mean_spr[:,ii+1],xerr=sem_spr[:,ii],yerr=sem_spr[:,ii+1],fmt='none')
+        ax[ii].scatter(mean_spr[:,ii],mean_spr[:,ii+1])
+        for jj in range(len(ctlist)):
+            ax[ii].text(mean_spr[jj,ii],mean_spr[jj,ii+1],ctlist[jj])
+            ax[ii].set_xlabel('spread along PC#'+str(ii+1)+' um')
+            ax[ii].set_ylabel('spread along PC#'+str(ii+2)+' um')
+    return fig
@@ -2,20 +2,42 @@
 
  Get bodyId of lobula neurons of interest by
 
- - reading csv if it has already been saved
+ - reading csv if it has already been saved (see artifactcache.py)
  - running neuprint query if not
 
 """
 
 ## Packages
-from neuprint import Client
 import pandas as pd
 import numpy as np
 import os
 import glob
+import modules.artifactcache as artifactcache
+import modules.datadir as datadir
+import modules.instrument as instrument
+import modules.neuprintclient as neuprintclient
 import modules.utility as utility
 
+@instrument.timed('getbodyids')
 def getbodyids(**kwargs):
+    # just making explicit what is being called...
+    print('Running getbodyids...')
+
+    # If the parameters defining the list are provided (celltype, or ub/lb),
+    # look the list up in the cache and fetch it only if it is missing
+    if 'celltype' in kwargs or ('ub' in kwargs and 'lb' in kwargs):
+        path = artifactcache.lookup('bodyidlist', bodyidparams(**kwargs),
+                                    adopt=datadir.datapath('bodyidlist',bodyidfilename(**kwargs)))
+        if path:
+            bodyidlist = pd.read_csv(path)
+            _, filename = os.path.split(path)
+        elif 'celltype' in kwargs:
+            bodyidlist, filename = getbodyids_singletype(**kwargs)
+        else:
+            bodyidlist, filename = getbodyidsfromservertypenull(**kwargs)
+        return bodyidlist, filename
+
+    # Otherwise, ask which of the saved lists to use
      # load relevant kwarg
      # provide some non-existent filename when downloading new bodyid
     if 'filename' in kwargs:
@@ -23,11 +45,8 @@ def getbodyids(**kwargs):
     else:
         filename = ''
 
-    # just making explicit what is being called...
-    print('Running getbodyids...')
-
     # Check if we already have fetched bodyids from hemibrain
-    bodyidlistlist = glob.glob('.\\data\\bodyidlist\\*.csv')
+    bodyidlistlist = glob.glob(datadir.datapath('bodyidlist','*.csv'))
     newlist = [listname for listname in bodyidlistlist if filename in listname]
 
     # If they exist, ask if we want to read them
@@ -47,6 +66,27 @@ def getbodyids(**kwargs):
         bodyidlist, filename = getbodyidsfromservertypenull(**kwargs)
     return bodyidlist, filename
 
+# Parameters that define a list of bodyIds (used as the cache key)
+def bodyidparams(**kwargs):
+    if 'celltype' in kwargs:
+        if 'synapseType' in kwargs:
+            synapseType = kwargs.get('synapseType')
+        else:
+            synapseType = 'post'
+        return {'celltype': kwargs.get('celltype'), 'synapseType': synapseType}
+    return {'ub': kwargs.get('ub'), 'lb': kwargs.get('lb')}
+
+# Name of the file a list of bodyIds is saved as
+# Lists of a cell type name the synapse type, except for postsynapses (the
+# default), whose files keep the name used by earlier versions
+def bodyidfilename(**kwargs):
+    if 'celltype' in kwargs:
+        synapseType = bodyidparams(**kwargs)['synapseType']
+        if synapseType == 'post':
+            return 'bodyidlist_'+kwargs.get('celltype')+'.csv'
+        return 'bodyidlist_'+kwargs.get('celltype')+'_'+synapseType+'.csv'
+    return 'typenullbodyidlist_ub'+str(kwargs.get('ub'))+'_lb'+str(kwargs.get('lb'))+'.csv'
+
 
 def getbodyidsfromservertypenull(**kwargs):
     # check if upper/lower bounds of synapse numbers are provided as kwargs
@@ -62,10 +102,7 @@ def getbodyidsfromservertypenull(**kwargs):
     # which we will analyze by running clustering
     print('Will fetch bodyids from neuPrint')
     # Connect to the server
-    f = open("authtoken","r")
-    tokenstr = f.read()
-    c = Client('neuprint.janelia.org', dataset='hemibrain:v1.2.1', token=tokenstr)
-    c.fetch_version()
+    c = neuprintclient.getclient()
 
     # ask upper/lower bounds of the synapse counts (if not provided)
     if not 'ub' in locals():
@@ -82,8 +119,9 @@ def getbodyidsfromservertypenull(**kwargs):
 
     bodyidlist = c.fetch_custom(q)
     print('Found',len(bodyidlist),'cells without labels. Saving...')
-    filename = 'typenullbodyidlist_ub'+ub+'_lb'+lb+'.csv'
-    bodyidlist.to_csv('./data/bodyidlist/'+filename);
+    filename = bodyidfilename(ub=ub,lb=lb)
+    bodyidlist.to_csv(datadir.datapath('bodyidlist',filename));
+    artifactcache.register('bodyidlist', bodyidparams(ub=ub,lb=lb), datadir.datapath('bodyidlist',filename))
     return bodyidlist, filename
 
 # This is only for validation and will be called directly from scripts
@@ -107,10 +145,7 @@ def getbodyids_singletype(**kwargs):
     print('Fetching bodyIds from the server...')
 
     # Connect to the server
-    f = open("authtoken","r")
-    tokenstr = f.read()
-    c = Client('neuprint.janelia.org', dataset='hemibrain:v1.2.1', token=tokenstr)
-    c.fetch_version()
+    c = neuprintclient.getclient()
 
     # Define query
     q = """\
@@ -121,6 +156,7 @@ def getbodyids_singletype(**kwargs):
 
     bodyidlist = c.fetch_custom(q)
     print('Found',len(bodyidlist),celltype,'. Saving...')
-    filename = 'bodyidlist_'+celltype+'.csv'
-    bodyidlist.to_csv('./data/bodyidlist/'+filename);
+    filename = bodyidfilename(celltype=celltype,synapseType=synapseType)
+    bodyidlist.to_csv(datadir.datapath('bodyidlist',filename));
+    artifactcache.register('bodyidlist', bodyidparams(celltype=celltype,synapseType=synapseType), datadir.datapath('bodyidlist',filename))
     return bodyidlist, filename
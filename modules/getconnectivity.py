@@ -5,26 +5,54 @@
 """
 
 ## Packages
-from neuprint import Client
 import pandas as pd
 import numpy as np
+from scipy import sparse
 import os
 import glob
+import modules.neuprintclient as neuprintclient
+import modules.artifactcache as artifactcache
+import modules.asyncfetch as asyncfetch
+import modules.checkpoint as checkpoint
+import modules.datadir as datadir
 import modules.getbodyids as getbodyids
+import modules.incremental as incremental
+import modules.instrument as instrument
+import modules.matrixfile as matrixfile
 import modules.utility as utility
 
+@instrument.timed('getconnectivity')
 def getconnectivity(**kwargs):
     # load relevant kwarg
     if 'filename' in kwargs:
         filename = kwargs.get('filename')
     else:
         filename = ''
+    # with readMatrix=0, saved matrices are not read (None is returned with the
+    # file name), e.g. to stream them with features.assemblefeatures
+    if 'readMatrix' in kwargs:
+        readMatrix = kwargs.get('readMatrix')
+    else:
+        readMatrix = 1
 
     # just making explicit what is being called...
     print('Running getconnectivity...')
 
-    # First, list the existing connectivity matrices
-    connectivitylist = glob.glob('.\\data\\connectivity\\connectivity_*.csv')
+    # If the parameters defining the bodyId list are provided, look the matrix
+    # up in the cache and calculate it only if it is missing
+    if 'celltype' in kwargs or ('ub' in kwargs and 'lb' in kwargs):
+        path = artifactcache.lookup('connectivity', getbodyids.bodyidparams(**kwargs),
+                                    adopt=datadir.datapath('connectivity','connectivity_'+getbodyids.bodyidfilename(**kwargs)))
+        if path:
+            connectivity = matrixfile.readmatrix(path) if readMatrix else None
+            _, filename = os.path.split(path)
+        else:
+            connectivity, filename = getconnectivityfromserver(**kwargs)
+        return connectivity, filename
+
+    # Otherwise, list the existing connectivity matrices
+    connectivitylist = sorted(glob.glob(datadir.datapath('connectivity','connectivity_*.csv'))+
+                              glob.glob(datadir.datapath('connectivity','connectivity_*.npz')))
     # find ones that contain the specified filename
     newlist = [cons for cons in connectivitylist if filename in cons]
 
@@ -32,10 +60,10 @@ def getconnectivity(**kwargs):
     ind = 0
     if newlist:
         print('Found saved connectivity matrices with the specified filename:')
-        utility.print_indexed(connectivitylist)
+        utility.print_indexed(newlist)
         ind = int(input('Which one do you want to load? (enter -1 to create a new connectivity matrix): '))
         if not ind<0:
-            connectivity = pd.read_csv(newlist[ind])
+            connectivity = matrixfile.readmatrix(newlist[ind])
             _, filename = os.path.split(newlist[ind])
 
     # if saved id list doesn't exist (or if you just want a new one), load them from neuprint
@@ -44,27 +72,122 @@ def getconnectivity(**kwargs):
     return connectivity, filename
 
 def getconnectivityfromserver(**kwargs):
+    # With incremental=1, rows of cells already in a saved connectivity matrix
+    # are reused and only the other cells are fetched (see modules/incremental.py)
+    if 'incremental' in kwargs:
+        incrementalFlag = kwargs.get('incremental')
+    else:
+        incrementalFlag = 0
+    # file format of the saved matrix: csv or npz (binary, see modules/matrixfile.py)
+    if 'matrixFormat' in kwargs:
+        matrixFormat = kwargs.get('matrixFormat')
+    else:
+        matrixFormat = 'csv'
+
+    basepath = None
+    if incrementalFlag and ('celltype' in kwargs or ('ub' in kwargs and 'lb' in kwargs)):
+        bodyidlist, filename = getbodyids.getbodyids(**kwargs)
+        basepath, baseids = incremental.findbase('connectivity', bodyidlist['bodyId'].to_numpy(),
+                                                 getbodyids.bodyidparams(**kwargs))
+
+    if basepath:
+        newfilename = os.path.basename(matrixfile.matrixpath('connectivity_'+filename, matrixFormat))
+        connectivity = updateconnectivity(bodyidlist, basepath, **kwargs)
+        incremental.writetombstones(datadir.datapath('connectivity',newfilename),
+                                    np.setdiff1d(baseids, bodyidlist['bodyId'].to_numpy()), basepath)
+    else:
+        # fetch connectivity as a sparse matrix and turn it into the dense
+        # dataframe (bodyId + one column per downstream type) we save and use
+        mat, typeindex, bodyidlist, filename = getsparseconnectivityfromserver(**kwargs)
+        connectivity = sparsetodataframe(mat, typeindex, bodyidlist)
+        newfilename = os.path.basename(matrixfile.matrixpath('connectivity_'+filename, matrixFormat))
+
+    matrixfile.savematrix(connectivity, datadir.datapath('connectivity',newfilename), matrixFormat=matrixFormat, sparse=1,
+                          kind='connectivity', params=getbodyids.bodyidparams(**kwargs))
+    if 'celltype' in kwargs or ('ub' in kwargs and 'lb' in kwargs):
+        artifactcache.register('connectivity', getbodyids.bodyidparams(**kwargs), datadir.datapath('connectivity',newfilename))
+    return connectivity, newfilename
+
+# Connectivity of the cells in bodyidlist, reusing the rows of the saved
+# matrix at basepath and fetching only the cells that are not in it
+def updateconnectivity(bodyidlist,basepath,**kwargs):
+    base = incremental.readrows(basepath)
+    newcells = bodyidlist[~bodyidlist['bodyId'].isin(base.index)]
+    print('Fetching connectivity of',len(newcells),'new cells...')
+    tables = [base]
+    if len(newcells):
+        mat, typeindex = fetchsparseconnectivity(newcells.reset_index(drop=True), **kwargs)
+        tables.append(pd.DataFrame(mat.toarray(), columns=typeindex, index=newcells['bodyId'].to_numpy()))
+    # types only the dropped cells connect to end up as empty columns
+    return incremental.mergerows(tables, bodyidlist, fill=0, dropEmpty=True)
+
+def getsparseconnectivityfromserver(**kwargs):
 
     # just making explicit what is being called...
     print('Running getconnectivityfromserver...')
     print('Newly calculating a connectivity matrix!')
 
-    # Connect to the neuPrint server
-    f = open("authtoken","r")
-    tokenstr = f.read()
-    c = Client('neuprint.janelia.org', dataset='hemibrain:v1.2.1', token=tokenstr)
-    c.fetch_version()
-
     # Get bodyidlist either from the folder or from neuprint
     bodyidlist, filename = getbodyids.getbodyids(**kwargs)
 
-    # we create the output dataframe by appending new columns to the bodyidlist
-    # which should already be a pandas dataframe
-    connectivity = bodyidlist
+    mat, typeindex = fetchsparseconnectivity(bodyidlist, **kwargs)
+    return mat, typeindex, bodyidlist, filename
+
+# Fetch connectivity of the cells in bodyidlist to downstream types, return it
+# as a sparse matrix (cells x types) and the list of types
+@instrument.timed('fetchconnectivity')
+def fetchsparseconnectivity(bodyidlist,**kwargs):
+    # Connect to the neuPrint server
+    c = neuprintclient.getclient()
+
+    # By default, connectivity of many cells is fetched and summed by type on
+    # the server in a single query. Set bulk=0 to go back to cell-by-cell query
+    if 'bulk' in kwargs:
+        bulk = kwargs.get('bulk')
+    else:
+        bulk = 1
+
+    # number of bodyIds sent to the server in one bulk query
+    if 'chunkSize' in kwargs:
+        chunkSize = kwargs.get('chunkSize')
+    else:
+        chunkSize = 100
+
+    # number of bulk queries kept in flight at the same time
+    if 'n_concurrent' in kwargs:
+        n_concurrent = kwargs.get('n_concurrent')
+    else:
+        n_concurrent = 1
+
+    # save fetched chunks every checkpointEvery chunks, so that an interrupted
+    # run resumes where it stopped (see modules/checkpoint.py)
+    if 'checkpoint' in kwargs:
+        checkpointFlag = kwargs.get('checkpoint')
+    else:
+        checkpointFlag = 1
+    if 'checkpointEvery' in kwargs:
+        checkpointEvery = kwargs.get('checkpointEvery')
+    else:
+        checkpointEvery = 10
+
+    if bulk:
+        rows, types, weights = getconnectivitybulk(c, bodyidlist, chunkSize, n_concurrent=n_concurrent,
+                                                   checkpoint=checkpointFlag, checkpointEvery=checkpointEvery)
+    else:
+        rows, types, weights = getconnectivitypercell(c, bodyidlist)
+
+    return buildsparseconnectivity(rows, types, weights, len(bodyidlist))
+
+# Original cell-by-cell version: one query per bodyId, summation done locally
+# Returns (row, type, weight) triplets
+def getconnectivitypercell(c,bodyidlist):
+    rows = []
+    types = []
+    weights = []
 
     # Go through all the bodyids and get connections
+    progress = instrument.Progress('Connectivity', len(bodyidlist))
     for ii in range(len(bodyidlist)):
-        if ii%20==0: print('Working on cell #'+str(ii))
         thisId = bodyidlist.bodyId[ii]
         q = """\
             MATCH (a:Neuron)-[w:ConnectsTo]->(b:Neuron)
@@ -72,17 +195,115 @@ def getconnectivityfromserver(**kwargs):
             RETURN DISTINCT b.bodyId as bodyId, b.type as type, w.weight as w
             """ % thisId
         df = c.fetch_custom(q)
-        # Find unique cell types in the output
-        types = df.type.unique()
-        for thisType in types:
-            # Ignore un-labeled downstream neurons
-            if thisType is not None:
-                # calculate the total weight
-                thisCon = np.sum(df.loc[df["type"]==thisType].w)
-                # Register this into the output df
-                if thisType not in connectivity.columns:
-                    connectivity[thisType] = np.zeros(len(connectivity))
-                connectivity.at[ii, thisType] = thisCon
-    newfilename = 'connectivity_'+filename
-    connectivity.to_csv('./data/connectivity/'+newfilename)
-    return connectivity, newfilename
+        # Ignore un-labeled downstream neurons
+        df = df[df['type'].notna()]
+        # calculate the total weight for each type (keeping the order we meet them)
+        thisCon = df.groupby('type', sort=False)['w'].sum()
+        rows.extend([ii]*len(thisCon))
+        types.extend(thisCon.index)
+        weights.extend(thisCon.to_numpy())
+        progress.update()
+    return rows, types, weights
+
+# Bulk version: UNWIND a chunk of bodyIds into one query and let the server
+# sum the weights by (bodyId, downstream type), dropping unlabeled partners
+# With checkpoint=1, chunks already fetched by an interrupted run are skipped
+# Returns (row, type, weight) triplets
+def getconnectivitybulk(c,bodyidlist,chunkSize,**kwargs):
+    # with n_concurrent>1, several chunks are fetched concurrently
+    if 'n_concurrent' in kwargs:
+        n_concurrent = kwargs.get('n_concurrent')
+    else:
+        n_concurrent = 1
+    if 'checkpoint' in kwargs:
+        checkpointFlag = kwargs.get('checkpoint')
+    else:
+        checkpointFlag = 0
+    if 'checkpointEvery' in kwargs:
+        checkpointEvery = kwargs.get('checkpointEvery')
+    else:
+        checkpointEvery = 10
+
+    bodyids = bodyidlist['bodyId'].to_numpy()
+
+    # one query per chunk of bodyIds
+    queries = []
+    starts = range(0,len(bodyids),chunkSize)
+    chunkcells = [min(start+chunkSize,len(bodyids))-start for start in starts]
+    for start in starts:
+        thisChunk = ','.join(str(bodyid) for bodyid in bodyids[start:start+chunkSize])
+        q = """\
+            UNWIND [%s] AS thisId
+            MATCH (a:Neuron)-[w:ConnectsTo]->(b:Neuron)
+            WHERE a.bodyId=thisId AND b.type IS NOT NULL
+            RETURN a.bodyId as bodyId, b.type as type, sum(w.weight) as w
+            """ % thisChunk
+        queries.append(q)
+
+    # chunks fetched before (by a run that was interrupted)
+    saved = None
+    todo = list(range(len(queries)))
+    if checkpointFlag:
+        saved = checkpoint.Checkpoint('connectivity', bodyids, {'chunkSize': chunkSize}, every=checkpointEvery)
+        done = saved.results()
+        todo = [ii for ii in todo if ii not in done]
+        saved.report(len(queries), sum(chunkcells[ii] for ii in done))
+
+    # fetch (bodyId, type, weight) rows chunk by chunk
+    progress = instrument.Progress('Connectivity', sum(chunkcells[ii] for ii in todo))
+    def chunkdone(ii,df):
+        if saved is not None:
+            saved.add(ii, bodyId=df['bodyId'].to_numpy(dtype=np.int64),
+                      type=df['type'].to_numpy(dtype=str), w=df['w'].to_numpy())
+        progress.update(chunkcells[ii])
+    fetched = {}
+    try:
+        if n_concurrent>1 and len(todo)>1:
+            print('Fetching',len(todo),'chunks of cells with',n_concurrent,'concurrent queries...')
+            dfs = asyncfetch.fetchall([queries[ii] for ii in todo], n_concurrent=n_concurrent,
+                                      callback=lambda jj, df: chunkdone(todo[jj], df))
+            fetched = dict(zip(todo, dfs))
+        else:
+            for ii in todo:
+                fetched[ii] = c.fetch_custom(queries[ii])
+                chunkdone(ii, fetched[ii])
+    except BaseException:
+        # keep what was fetched for the next run
+        if saved is not None:
+            saved.flush()
+        raise
+    if saved is not None:
+        # chunks in the checkpoint come back as arrays, in the order of the chunks
+        for ii, arrays in saved.results().items():
+            if ii not in fetched:
+                fetched[ii] = pd.DataFrame({'bodyId': arrays['bodyId'], 'type': arrays['type'].astype(object), 'w': arrays['w']})
+        saved.remove()
+    dflist = [fetched[ii] for ii in range(len(queries))]
+    if dflist:
+        df = pd.concat(dflist, ignore_index=True)
+    else:
+        df = pd.DataFrame(columns=['bodyId','type','w'])
+
+    # convert bodyIds into row indices of bodyidlist, and order the triplets
+    # by row so downstream types are indexed in the order we first meet them
+    rowind = pd.Index(bodyids).get_indexer(df['bodyId'])
+    order = np.argsort(rowind, kind='stable')
+    return rowind[order], df['type'].to_numpy()[order], df['w'].to_numpy()[order]
+
+# Given (row, type, weight) triplets, create a sparse CSR matrix of
+# (cells x downstream types) at once. Types are indexed in the order they first
+# appear, and weights of duplicated (row, type) pairs are summed
+def buildsparseconnectivity(rows,types,weights,n_rows):
+    typecodes, typeindex = pd.factorize(pd.Series(types, dtype=object))
+    mat = sparse.csr_matrix((np.asarray(weights, dtype=float),
+                             (np.asarray(rows, dtype=np.int64), typecodes)),
+                            shape=(n_rows, len(typeindex)))
+    mat.sum_duplicates()
+    return mat, list(typeindex)
+
+# Turn the sparse connectivity matrix into the dense dataframe used for
+# clustering (columns of bodyidlist followed by one column per type)
+def sparsetodataframe(mat,typeindex,bodyidlist):
+    table = pd.DataFrame(mat.toarray(), columns=typeindex, index=bodyidlist.index)
+    connectivity = pd.concat([bodyidlist, table], axis=1)
+    return connectivity
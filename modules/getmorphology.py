@@ -7,21 +7,31 @@
 
 """
 ## Packages
-from neuprint import Client
 import pandas as pd
 import numpy as np
 import os
 import glob
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 from sklearn.decomposition import PCA
 ## My own modules
+import modules.artifactcache as artifactcache
+import modules.checkpoint as checkpoint
+import modules.datadir as datadir
+import modules.neuprintclient as neuprintclient
 import modules.getbodyids as getbodyids
+import modules.incremental as incremental
+import modules.instrument as instrument
+import modules.matrixfile as matrixfile
+import modules.depthengine as depthengine
 import modules.getsynapses as getsynapses
 import modules.visualize as visualize
 import modules.utility as utility
 
 # Return morphology (depth + spread) dataframes -- either saved or new
+@instrument.timed('getmorphology')
 def getmorphology(**kwargs):
     # You can specify a substring of filename to automatically select saved
     # morphology data -- provide nonexistent name to calculate something anew
@@ -37,17 +47,47 @@ def getmorphology(**kwargs):
 
     # sometimes you might want to try different binning parameters for morphology
     # with the same bodyId list. Use this flag for such cases
-    if 'recaluculateMorphology' in kwargs:
+    if 'recalculateMorphology' in kwargs:
         recalcFlag = kwargs.get('recalculateMorphology')
     else:
         recalcFlag = 0
+    # with readMatrix=0, saved matrices are not read (None is returned with the
+    # file name), e.g. to stream them with features.assemblefeatures
+    if 'readMatrix' in kwargs:
+        readMatrix = kwargs.get('readMatrix')
+    else:
+        readMatrix = 1
 
     # just making explicit what is being called...
     print('Running getmorphology...')
 
-    # First, list the existing morphology matrices
+    # If all the parameters defining the morphology matrices are provided,
+    # look them up in the cache and calculate them only if they are missing
+    params = morphologyparams(**kwargs)
+    if params is not None:
+        path = None
+        if not recalcFlag:
+            path = artifactcache.lookup('depth', params,
+                                        adopt=[datadir.datapath('depth','depth_'+name) for name in morphologyfilenames(**kwargs)])
+        spreadpath = None
+        if path:
+            # spread is saved next to depth, in the same format
+            spreadpath = datadir.datapath('spread','spread'+os.path.basename(path)[5:])
+        if path and os.path.exists(spreadpath) and not readMatrix:
+            depth, spread = None, None
+            _, depth_filename = os.path.split(path)
+        elif path and os.path.exists(spreadpath):
+            depth = matrixfile.readmatrix(path)
+            spread = matrixfile.readmatrix(spreadpath)
+            _, depth_filename = os.path.split(path)
+        else:
+            depth, spread, depth_filename = calcmorphology(**kwargs)
+        return depth, spread, depth_filename
+
+    # Otherwise, list the existing morphology matrices
     # assumption is that depth/spread matrices are generated as pairs
-    depthlist = glob.glob('.\\data\\depth\\depth_*.csv')
+    depthlist = sorted(glob.glob(datadir.datapath('depth','depth_*.csv'))+
+                       glob.glob(datadir.datapath('depth','depth_*.npz')))
 
     # take the ones whose name contains the specified filename
     newlist = [file for file in depthlist if filename in file and landmarkname in file]
@@ -59,17 +99,56 @@ def getmorphology(**kwargs):
         utility.print_indexed(newlist)
         ind = int(input('Select which one you want to use (enter -1 to make a new one) : '))
         if not ind<0:
-            depth = pd.read_csv(newlist[ind])
+            depth = matrixfile.readmatrix(newlist[ind])
             _, depth_filename = os.path.split(newlist[ind])
-            spread = pd.read_csv('./data/spread/spread'+depth_filename[5:])
+            spread = matrixfile.readmatrix(datadir.datapath('spread','spread'+depth_filename[5:]))
 
-    if ind<0 or not newlist:
+    if ind<0 or not newlist or recalcFlag:
         # if not calculate anew
         print('Morphology dataset with the specified filename does not exist.')
         depth, spread, depth_filename = calcmorphology(**kwargs)
     return depth, spread, depth_filename
 
+# Parameters that define a pair of depth/spread matrices (used as the cache
+# key), or None if some of them are not provided
+def morphologyparams(**kwargs):
+    if not ('celltype' in kwargs or ('ub' in kwargs and 'lb' in kwargs)):
+        return None
+    for key in ('landmarkname','minD','maxD','binSize'):
+        if key not in kwargs:
+            return None
+    params = getbodyids.bodyidparams(**kwargs)
+    if 'synapseType' in kwargs:
+        params['synapseType'] = kwargs.get('synapseType')
+    else:
+        params['synapseType'] = 'pre'
+    for key in ('landmarkname','minD','maxD','binSize'):
+        params[key] = kwargs.get(key)
+    return params
+
+# Name of the depth/spread files (after 'depth_' or 'spread_')
+def morphologyfilename(**kwargs):
+    if 'synapseType' in kwargs:
+        synapseType = kwargs.get('synapseType')
+    else:
+        synapseType = 'pre'
+    return (kwargs.get('landmarkname')+'_'+synapseType+'_minD'+str(kwargs.get('minD'))+
+            '_maxD'+str(kwargs.get('maxD'))+'_bin'+str(kwargs.get('binSize'))+'_'+getbodyids.bodyidfilename(**kwargs))
+
+# Names a depth/spread file made with these parameters may have: the current
+# one, and the one with the bins written as floats (earlier versions asked for
+# them interactively, e.g. minD-20.0_maxD50.0_bin5.0)
+def morphologyfilenames(**kwargs):
+    names = [morphologyfilename(**kwargs)]
+    floatkwargs = dict(kwargs)
+    for key in ('minD','maxD','binSize'):
+        floatkwargs[key] = float(kwargs.get(key))
+    if morphologyfilename(**floatkwargs) not in names:
+        names.append(morphologyfilename(**floatkwargs))
+    return names
+
 # Calculate morphology given bodyId list
+@instrument.timed('calcmorphology')
 def calcmorphology(**kwargs):
     # load relevant kwarg
     # Synapse type to use
@@ -95,6 +174,24 @@ def calcmorphology(**kwargs):
     # load PC coefficients and surface model
     pca, modelcoeff, landmarkname = loadlobulamodel(**kwargs)
 
+    # With incremental=1, rows of cells already in saved depth/spread matrices
+    # (same landmark, synapse type and bins) are reused and only the other
+    # cells are calculated (see modules/incremental.py)
+    if 'incremental' in kwargs:
+        incrementalFlag = kwargs.get('incremental')
+    else:
+        incrementalFlag = 0
+    basepath = None
+    params = morphologyparams(**kwargs)
+    if incrementalFlag and params is not None:
+        match = {key: params[key] for key in ('synapseType','landmarkname','minD','maxD','binSize')}
+        basepath, baseids = incremental.findbase('depth', bodyidlist['bodyId'].to_numpy(), params, match=match)
+    fulllist = bodyidlist
+    if basepath:
+        # only calculate the cells missing from the saved matrices
+        bodyidlist = bodyidlist[~bodyidlist['bodyId'].isin(baseids)].reset_index(drop=True)
+        print('Calculating morphology of',len(bodyidlist),'new cells...')
+
     # prepare output structure (we build this by appending columns to bodyidlist)
     depth = bodyidlist.copy()
     spread = bodyidlist.copy()
@@ -108,37 +205,275 @@ def calcmorphology(**kwargs):
         binSize = float(input('Enter depth bin size (in microns): '))
     binEdges = np.arange(minD,maxD+binSize,binSize)
 
-    # add columns
-    for b in range(len(binEdges)-1):
-        depth['bin'+str(b)] = np.zeros(len(spread))
+    # By default, histograms and spreads of all the cells are calculated at
+    # once. Set batch=0 to go back to the cell-by-cell calculation
+    if 'batch' in kwargs:
+        batch = kwargs.get('batch')
+    else:
+        batch = 1
+
+    # number of worker processes to share the calculation with (1: no parallelization)
+    if 'n_workers' in kwargs:
+        n_workers = kwargs.get('n_workers')
+    else:
+        n_workers = 1
 
-    spread['SD1'] = np.zeros(len(spread))
-    spread['SD2'] = np.zeros(len(spread))
-    spread['SD3'] = np.zeros(len(spread))
+    # number of synapse queries kept in flight at the same time
+    if 'n_concurrent' in kwargs:
+        n_concurrent = kwargs.get('n_concurrent')
+    else:
+        n_concurrent = 1
+
+    # calculate the cells in shards and save finished shards, so that an
+    # interrupted run resumes where it stopped (see modules/checkpoint.py)
+    # Lists of at most maxShardSize cells are calculated at once, as one shard
+    # would hold all of them anyway
+    if 'checkpoint' in kwargs:
+        checkpointFlag = kwargs.get('checkpoint')
+    else:
+        checkpointFlag = 1
+    sharded = batch and (n_workers>1 or (checkpointFlag and len(bodyidlist)>maxShardSize))
 
     # go through the bodyid list and load synapses
     print('Calculating morphological metrics. This could take a while...')
-    for thisId in bodyidlist['bodyId']:
-        # load synapses
-        synapses = getsynapses.getsynapses(thisId,synapseType)
-        # calculate PCs and depth
-        rawdepth, PCs = utility.calcrawdepth(pca, modelcoeff, synapses)
-        # calculate depth histogram
+    if sharded:
+        # download synapses of the missing cells; shards read them from the store
+        getsynapses.downloadsynapses(bodyidlist['bodyId'].to_list(),synapseType,n_concurrent=n_concurrent)
+    else:
+        # load (or download, many cells at a time) synapses of all the cells
+        synapselist = getsynapses.getsynapses_bulk(bodyidlist['bodyId'].to_list(),synapseType,n_concurrent=n_concurrent)
+
+    if batch:
+        if sharded:
+            hist, sd = calcmorphologyparallel(pca, modelcoeff, bodyidlist['bodyId'].to_list(), synapseType, binEdges, n_workers,
+                                              checkpoint=checkpointFlag, params=params)
+        else:
+            hist, sd = calcmorphologybatch(pca, modelcoeff, synapselist, binEdges)
+        # add columns
         for b in range(len(binEdges)-1):
-            depth.loc[depth['bodyId']==thisId,'bin'+str(b)] = np.sum(np.logical_and(rawdepth<binEdges[b+1], rawdepth>binEdges[b]))
-        spread.loc[spread['bodyId']==thisId,'SD1'] = np.std(PCs[:,0])
-        spread.loc[spread['bodyId']==thisId,'SD2'] = np.std(PCs[:,1])
-        spread.loc[spread['bodyId']==thisId,'SD3'] = np.std(PCs[:,2])
-
-    # save as csv
+            depth['bin'+str(b)] = hist[:,b].astype(float)
+        spread['SD1'] = sd[:,0]
+        spread['SD2'] = sd[:,1]
+        spread['SD3'] = sd[:,2]
+    else:
+        # add columns
+        for b in range(len(binEdges)-1):
+            depth['bin'+str(b)] = np.zeros(len(spread))
+
+        spread['SD1'] = np.zeros(len(spread))
+        spread['SD2'] = np.zeros(len(spread))
+        spread['SD3'] = np.zeros(len(spread))
+
+        progress = instrument.Progress('Morphology', len(bodyidlist))
+        for thisId, synapses in zip(bodyidlist['bodyId'], synapselist):
+            # calculate PCs and depth
+            rawdepth, PCs = utility.calcrawdepth(pca, modelcoeff, synapses)
+            # calculate depth histogram
+            for b in range(len(binEdges)-1):
+                depth.loc[depth['bodyId']==thisId,'bin'+str(b)] = np.sum(np.logical_and(rawdepth<binEdges[b+1], rawdepth>binEdges[b]))
+            spread.loc[spread['bodyId']==thisId,'SD1'] = np.std(PCs[:,0])
+            spread.loc[spread['bodyId']==thisId,'SD2'] = np.std(PCs[:,1])
+            spread.loc[spread['bodyId']==thisId,'SD3'] = np.std(PCs[:,2])
+            progress.update()
+
+    # save as csv, or in the binary format with matrixFormat='npz' (depth
+    # histograms as unsigned integers, spread as float32; see modules/matrixfile.py)
+    if 'matrixFormat' in kwargs:
+        matrixFormat = kwargs.get('matrixFormat')
+    else:
+        matrixFormat = 'csv'
     filename_postfix = landmarkname+'_'+synapseType+'_minD'+str(minD)+'_maxD'+str(maxD)+'_bin'+str(binSize)+'_'+filename
-
-    depth.to_csv('./data/depth/depth_'+filename_postfix)
-    spread.to_csv('./data/spread/spread_'+filename_postfix)
+    filename_postfix = matrixfile.matrixpath(filename_postfix, matrixFormat)
+
+    if basepath:
+        # put the reused and new rows together in the order of the full list
+        _, basefilename = os.path.split(basepath)
+        spreadbasepath = datadir.datapath('spread','spread'+basefilename[5:])
+        newdepth = depth.iloc[:,depth.columns.get_loc('bodyId')+1:].set_axis(depth['bodyId'].to_numpy())
+        newspread = spread.iloc[:,spread.columns.get_loc('bodyId')+1:].set_axis(spread['bodyId'].to_numpy())
+        depth = incremental.mergerows([incremental.readrows(basepath), newdepth], fulllist)
+        spread = incremental.mergerows([incremental.readrows(spreadbasepath), newspread], fulllist)
+        dropped = np.setdiff1d(baseids, fulllist['bodyId'].to_numpy())
+        incremental.writetombstones(datadir.datapath('depth','depth_'+filename_postfix), dropped, basepath)
+        incremental.writetombstones(datadir.datapath('spread','spread_'+filename_postfix), dropped, spreadbasepath)
+
+    matrixfile.savematrix(depth, datadir.datapath('depth','depth_'+filename_postfix), matrixFormat=matrixFormat,
+                          kind='depth', params=params)
+    matrixfile.savematrix(spread, datadir.datapath('spread','spread_'+filename_postfix), matrixFormat=matrixFormat,
+                          dtype='float32', kind='spread', params=params)
+    if params is not None:
+        artifactcache.register('spread', params, datadir.datapath('spread','spread_'+filename_postfix))
+        artifactcache.register('depth', params, datadir.datapath('depth','depth_'+filename_postfix))
     return depth, spread, 'depth_'+filename_postfix
 
 
+# Calculate depth histograms and spreads of many cells at once
+# All the synapses are concatenated with a vector telling which cell they come
+# from, so depth is calculated once, histograms are counted with one bincount
+# over (cell, bin), and spreads are reduced for groups of cells at once
+@instrument.timed('calcmorphologybatch')
+def calcmorphologybatch(pca,modelcoeff,synapselist,binEdges):
+    n_cell = len(synapselist)
+    n_bin = len(binEdges)-1
+    n_syn = np.array([len(synapses) for synapses in synapselist])
+
+    # calculate PCs and depth of all the synapses
+    XYZ = np.concatenate([synapses[['x','y','z']].to_numpy() for synapses in synapselist]+[np.empty((0,3),dtype=np.int32)])
+    if len(XYZ)==0:
+        return np.zeros((n_cell,n_bin),dtype=np.int64), np.full((n_cell,3),np.nan)
+    rawdepth, PCs = depthengine.calcdepth(XYZ, pca, modelcoeff)
+    return summarizemorphology(rawdepth, PCs, n_syn, binEdges)
+
+# Depth histograms and spreads of cells, given depth and PCs of their synapses
+# (concatenated cell by cell) and the number of synapses of each cell
+def summarizemorphology(rawdepth,PCs,n_syn,binEdges):
+    n_cell = len(n_syn)
+    n_bin = len(binEdges)-1
+    cellind = np.repeat(np.arange(n_cell), n_syn)
+
+    # depth histogram: synapses strictly between two edges are counted
+    # searchsorted gives binEdges[b-1] < depth <= binEdges[b], then we drop
+    # synapses sitting exactly on the upper edge
+    b = np.searchsorted(binEdges, rawdepth, side='left')
+    valid = np.logical_and(b>=1, b<=n_bin)
+    valid[valid] = rawdepth[valid] < binEdges[b[valid]]
+    hist = np.bincount(cellind[valid]*n_bin+b[valid]-1, minlength=n_cell*n_bin).reshape(n_cell,n_bin)
+
+    # spread: SD of the PCs of each cell
+    # cells with the same number of synapses are stacked into a 2D array and
+    # reduced together, which gives exactly the same numbers as np.std per cell
+    sd = np.full((n_cell,3),np.nan)
+    start = np.cumsum(n_syn)-n_syn
+    for thisN in np.unique(n_syn[n_syn>0]):
+        thiscell = np.where(n_syn==thisN)[0]
+        rowind = start[thiscell,None]+np.arange(thisN)
+        for k in range(3):
+            sd[thiscell,k] = np.std(PCs[rowind,k],axis=1)
+    return hist, sd
+
+
+# largest number of cells calculated (and checkpointed) as one shard
+maxShardSize = 5000
+
+
+# Parallel version of calcmorphologybatch: the bodyId list is split into shards
+# that are processed by a pool of worker processes. Each worker reads synapses
+# from the synapse store by itself, and receives the lobula model only once
+# (through the initializer). Results are merged in the order of bodyids
+# With n_workers=1, shards are calculated in this process
+# With checkpoint=1, every finished shard is saved, and shards saved by an
+# interrupted run (with the same cells and params) are skipped
+# Note: on platforms that spawn worker processes (e.g. Windows), the calling
+# script has to be protected by if __name__ == '__main__'
+def calcmorphologyparallel(pca,modelcoeff,bodyids,synapseType,binEdges,n_workers,**kwargs):
+    # number of cells per task (by default, about 4 tasks per worker, and at
+    # most maxShardSize cells so that checkpoints are frequent enough)
+    if 'shardSize' in kwargs:
+        shardSize = kwargs.get('shardSize')
+    else:
+        shardSize = min(maxShardSize, max(1, int(np.ceil(len(bodyids)/(n_workers*4)))))
+    if 'checkpoint' in kwargs:
+        checkpointFlag = kwargs.get('checkpoint')
+    else:
+        checkpointFlag = 0
+    # parameters identifying the calculation in the checkpoint (besides the
+    # cells, synapse type, bins and the lobula model)
+    if 'params' in kwargs:
+        params = kwargs.get('params')
+    else:
+        params = None
+
+    shards = [bodyids[start:start+shardSize] for start in range(0,len(bodyids),shardSize)]
+    saved = None
+    todo = list(range(len(shards)))
+    if checkpointFlag:
+        checkpointparams = {'params': params, 'synapseType': synapseType, 'shardSize': shardSize,
+                            'binEdges': np.asarray(binEdges, dtype=float).tolist(),
+                            'model': np.concatenate([np.ravel(pca.mean_), np.ravel(pca.components_), np.ravel(modelcoeff)]).tolist()}
+        saved = checkpoint.Checkpoint('morphology', bodyids, checkpointparams, every=1)
+        done = saved.results()
+        todo = [ii for ii in todo if ii not in done]
+        saved.report(len(shards), sum(len(shards[ii]) for ii in done))
+
+    print('Calculating morphology of',sum(len(shards[ii]) for ii in todo),'cells with',n_workers,'workers...')
+    progress = instrument.Progress('Morphology', sum(len(shards[ii]) for ii in todo))
+    results = {}
+    def sharddone(ii,result):
+        results[ii] = result
+        if saved is not None:
+            saved.add(ii, hist=result[0], sd=result[1])
+        progress.update(len(shards[ii]))
+    if n_workers>1 and len(todo)>1:
+        # the data folder is passed on, as spawned workers (Windows/macOS) start
+        # with the default one (e.g. not that of the synthetic dataset)
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=initmorphologyworker,
+                                 initargs=(pca, modelcoeff, synapseType, binEdges, dict(datadir.settings))) as executor:
+            for ii, result in zip(todo, executor.map(calcmorphologyshard, [shards[ii] for ii in todo])):
+                sharddone(ii, result)
+    else:
+        initmorphologyworker(pca, modelcoeff, synapseType, binEdges)
+        try:
+            for ii in todo:
+                sharddone(ii, calcmorphologyshard(shards[ii]))
+        finally:
+            _worker.clear()
+    if saved is not None:
+        for ii, arrays in saved.results().items():
+            if ii not in results:
+                results[ii] = (arrays['hist'], arrays['sd'])
+        saved.remove()
+    results = [results[ii] for ii in range(len(shards))]
+
+    n_bin = len(binEdges)-1
+    hist = np.concatenate([result[0] for result in results]+[np.zeros((0,n_bin),dtype=np.int64)])
+    sd = np.concatenate([result[1] for result in results]+[np.zeros((0,3))])
+    return hist, sd
+
+# lobula model and parameters shared by all the tasks of a worker process
+_worker = {}
+
+def initmorphologyworker(pca,modelcoeff,synapseType,binEdges,datasettings=None):
+    if datasettings is not None:
+        datadir.configure(**datasettings)
+    _worker['pca'] = pca
+    _worker['modelcoeff'] = modelcoeff
+    _worker['synapseType'] = synapseType
+    _worker['binEdges'] = binEdges
+
+def calcmorphologyshard(bodyids):
+    # synapses are read from the store straight into the depth engine
+    rawdepth, PCs, n_syn = depthengine.calcdepthcells(bodyids, _worker['synapseType'], _worker['pca'], _worker['modelcoeff'])
+    return summarizemorphology(rawdepth, PCs, n_syn, _worker['binEdges'])
+
+
+# Download postsynapses of the landmark cell type and save them
+@instrument.timed('downloadlandmark')
+def downloadlandmark(landmarkname):
+    # Type in the cell type to use
+    print('Downloading '+landmarkname+' synapses...')
+
+    # Connect to the neuPrint server
+    c = neuprintclient.getclient()
+
+    # define query
+    q = """\
+        MATCH (a:Neuron)-[:Contains]->(:SynapseSet)-[:Contains]->(s:Synapse)
+        WHERE a.type='%s' AND s.type='post' AND s.`LO(R)`
+        RETURN DISTINCT s.location.x as x, s.location.y as y, s.location.z as z
+        """ % landmarkname
+
+    # run the query
+    landmark = c.fetch_custom(q)
+    landmark.to_csv(datadir.datapath('landmark',landmarkname+'.csv'))
+    artifactcache.register('landmark', {'landmarkname': landmarkname}, datadir.datapath('landmark',landmarkname+'.csv'))
+    return landmark
+
+
 # Load (or download) saved synapses, run PCA, and fit a surface
+# The fitted model is saved next to the landmark synapses (keyed by the
+# landmark name and a hash of its synapse file), so later runs load it
+# instead of fitting it again
+@instrument.timed('loadlobulamodel')
 def loadlobulamodel(**kwargs):
     # load relevant kwarg
     if 'landmarkname' in kwargs:
@@ -151,49 +486,81 @@ def loadlobulamodel(**kwargs):
     else:
         showModel = 1
 
+    # With streamFit=1, the model is fitted reading landmark synapses from the
+    # file fitChunkSize rows at a time, in constant memory (for very large
+    # landmarks, e.g. several cell types combined)
+    if 'streamFit' in kwargs:
+        streamFit = kwargs.get('streamFit')
+    else:
+        streamFit = 0
+    if 'fitChunkSize' in kwargs:
+        fitChunkSize = kwargs.get('fitChunkSize')
+    else:
+        fitChunkSize = 1000000
+
     # just making explicit what is being called...
     print('Running loadlobulamodel...')
 
-    # See existing "landmark" synapse directories
-    landmarklist = glob.glob('./data/landmark/*.csv')
-    newlist = [landmark for landmark in landmarklist if landmarkname in landmark]
-
-    ind = 0
-    if newlist:
-        print('Found landmark data matching the landmarkname provided')
-        utility.print_indexed(landmarklist)
-        ind = int(input('Enter which one to use (type -1 if you want to try new cell): '))
-        if not ind<0:
-            landmark = pd.read_csv(newlist[ind])
-            _, filename = os.path.split(newlist[ind])
-            landmarkname = filename[:-4] # keep the name of the cell
-
-    # if there is nothing saved or if you want to try a new landmark
-    if ind<0 or not newlist:
-        # in case nothing was saved and nothing was specified, ask here
-        if not landmarkname:
+    # If the landmark is specified, look its synapses up in the cache and
+    # download them only if they are missing
+    landmark = None
+    if landmarkname:
+        landmarkpath = artifactcache.lookup('landmark', {'landmarkname': landmarkname},
+                                            adopt=datadir.datapath('landmark',landmarkname+'.csv'))
+        if not landmarkpath:
+            landmark = downloadlandmark(landmarkname)
+            landmarkpath = datadir.datapath('landmark',landmarkname+'.csv')
+    else:
+        # See existing "landmark" synapse directories
+        landmarklist = glob.glob(datadir.datapath('landmark','*.csv'))
+
+        ind = 0
+        if landmarklist:
+            print('Found saved landmark data')
+            utility.print_indexed(landmarklist)
+            ind = int(input('Enter which one to use (type -1 if you want to try new cell): '))
+            if not ind<0:
+                landmarkpath = landmarklist[ind]
+                _, filename = os.path.split(landmarklist[ind])
+                landmarkname = filename[:-4] # keep the name of the cell
+
+        # if there is nothing saved or if you want to try a new landmark
+        if ind<0 or not landmarklist:
+            # in case nothing was saved and nothing was specified, ask here
             landmarkname = input('Enter the name of cell type you want to use as a landmark: ')
+            landmark = downloadlandmark(landmarkname)
+            landmarkpath = datadir.datapath('landmark',landmarkname+'.csv')
+
+    # Look the fitted model up by the landmark name and the hash of its synapses
+    datahash = landmarkhash(landmarkpath)
+    modelparams = {'landmarkname': landmarkname, 'landmarkhash': datahash}
+    modelpath = artifactcache.lookup('lobulamodel', modelparams)
+    if modelpath:
+        pca, modelcoeff, r2 = readlobulamodel(modelpath)
+    else:
+        if streamFit:
+            pca, modelcoeff, r2 = fitlobulamodelstreaming(landmarkpath, fitChunkSize)
+        else:
+            if landmark is None:
+                landmark = pd.read_csv(landmarkpath)
+            pca, modelcoeff, r2 = fitlobulamodel(landmark)
+        modelpath = datadir.datapath('landmark','model_'+landmarkname+'_'+datahash+'.npz')
+        savelobulamodel(modelpath, pca, modelcoeff, r2, datahash)
+        artifactcache.register('lobulamodel', modelparams, modelpath)
 
-        # Type in the cell type to use
-        print('Downloading '+landmarkname+' synapses...')
-
-        # Connect to the neuPrint server
-        f = open("authtoken","r")
-        tokenstr = f.read()
-        c = Client('neuprint.janelia.org', dataset='hemibrain:v1.2.1', token=tokenstr)
-        c.fetch_version()
+    # show goodness of fit
+    print('R2 of the lobula model was: ',r2)
 
-        # define query
-        q = """\
-            MATCH (a:Neuron)-[:Contains]->(:SynapseSet)-[:Contains]->(s:Synapse)
-            WHERE a.type='%s' AND s.type='post' AND s.`LO(R)`
-            RETURN DISTINCT s.location.x as x, s.location.y as y, s.location.z as z
-            """ % landmarkname
+    # visualize this
+    if showModel:
+        if landmark is None:
+            landmark = pd.read_csv(landmarkpath)
+        visualize.plotquadricandscatter(pca, modelcoeff, landmark)
 
-        # run the query
-        landmark = c.fetch_custom(q)
-        landmark.to_csv('./data/landmark/'+landmarkname+'.csv')
+    return pca, modelcoeff, landmarkname
 
+# Run PCA on x/y/z of the landmark synapses and fit a quadric surface to them
+def fitlobulamodel(landmark):
     # Now run PCA on x/y/z in the "landmark"
     # Also convert 8 nm px to microns unit
     X = landmark["x"].to_numpy().flatten()*8/1000
@@ -216,13 +583,96 @@ def loadlobulamodel(**kwargs):
     # fitting
     modelcoeff, r, rank, s = np.linalg.lstsq(A,PC3,rcond=None)
 
-
-    # show goodness of fit
+    # goodness of fit
     r2 = 1 - r / np.sum(PC3**2)
-    print('R2 of the lobula model was: ',r2)
-
-    # visualize this
-    if showModel:
-        visualize.plotquadricandscatter(pca, modelcoeff, landmark)
-
-    return pca, modelcoeff, landmarkname
+    return pca, modelcoeff, r2
+
+# Same fit as fitlobulamodel, reading the synapses from the file chunkSize
+# rows at a time. The first pass accumulates the mean and scatter matrix of
+# x/y/z (PCA of 3 coordinates is the eigendecomposition of their 3x3
+# covariance), the second one the normal equations of the quadric model
+def fitlobulamodelstreaming(path,chunkSize):
+    print('Fitting the lobula model to',path,'in chunks of',chunkSize,'synapses...')
+    # 1st pass: mean and scatter matrix (combined across chunks as in Chan et al.)
+    n = 0
+    mean = np.zeros(3)
+    scatter = np.zeros((3,3))
+    for chunk in pd.read_csv(path, usecols=['x','y','z'], chunksize=chunkSize):
+        XYZ = chunk[['x','y','z']].to_numpy(dtype=np.float64)*8/1000
+        n_b = XYZ.shape[0]
+        mean_b = XYZ.mean(axis=0)
+        centered = XYZ-mean_b
+        delta = mean_b-mean
+        scatter += centered.T @ centered + np.outer(delta,delta)*n*n_b/(n+n_b)
+        mean += delta*n_b/(n+n_b)
+        n += n_b
+
+    # principal axes, with the sign convention of sklearn (largest element of
+    # each axis positive)
+    eigval, eigvec = np.linalg.eigh(scatter)
+    order = np.argsort(eigval)[::-1]
+    eigval = np.maximum(eigval[order], 0)
+    components = eigvec[:,order].T
+    components *= np.sign(components[np.arange(3),np.argmax(np.abs(components),axis=1)])[:,None]
+    explained_variance = eigval/(n-1)
+    pca = makepca(components, mean, explained_variance, explained_variance/np.sum(explained_variance),
+                  np.sqrt(eigval), 0.0, n)
+
+    # 2nd pass: normal equations (A'A c = A'b) of the quadric model
+    AtA = np.zeros((6,6))
+    Atb = np.zeros(6)
+    btb = 0.0
+    for chunk in pd.read_csv(path, usecols=['x','y','z'], chunksize=chunkSize):
+        PCs = pca.transform(chunk[['x','y','z']].to_numpy(dtype=np.float64)*8/1000)
+        A = np.array([PCs[:,0]*0+1, PCs[:,0], PCs[:,1], PCs[:,0]**2, PCs[:,1]**2, PCs[:,0]*PCs[:,1]]).T
+        AtA += A.T @ A
+        Atb += A.T @ PCs[:,2]
+        btb += PCs[:,2] @ PCs[:,2]
+    modelcoeff = np.linalg.solve(AtA, Atb)
+
+    # goodness of fit (residual sum of squares from the normal equations)
+    r = btb - 2*modelcoeff @ Atb + modelcoeff @ AtA @ modelcoeff
+    r2 = 1 - np.array([r]) / btb
+    return pca, modelcoeff, r2
+
+# Short hash of the landmark synapse file (changes whenever the synapses do)
+def landmarkhash(path):
+    sha = hashlib.sha1()
+    with open(path,'rb') as f:
+        for block in iter(lambda: f.read(1<<20), b''):
+            sha.update(block)
+    return sha.hexdigest()[:12]
+
+# Save the fitted PCA (components, mean, variances) and quadric model
+def savelobulamodel(path,pca,modelcoeff,r2,datahash):
+    tmpfile = path+'.tmp.npz'
+    np.savez(tmpfile, components=pca.components_, mean=pca.mean_,
+             explained_variance=pca.explained_variance_,
+             explained_variance_ratio=pca.explained_variance_ratio_,
+             singular_values=pca.singular_values_, noise_variance=pca.noise_variance_,
+             n_samples=pca.n_samples_, modelcoeff=modelcoeff, r2=r2, landmarkhash=datahash)
+    os.replace(tmpfile, path)
+
+# Load a model saved by savelobulamodel, rebuilding the fitted PCA object
+def readlobulamodel(path):
+    with np.load(path) as saved:
+        pca = makepca(saved['components'], saved['mean'], saved['explained_variance'],
+                      saved['explained_variance_ratio'], saved['singular_values'],
+                      float(saved['noise_variance']), int(saved['n_samples']))
+        modelcoeff = saved['modelcoeff']
+        r2 = saved['r2']
+    return pca, modelcoeff, r2
+
+# Fitted PCA object made from its components, mean and variances
+def makepca(components,mean,explained_variance,explained_variance_ratio,singular_values,noise_variance,n_samples):
+    pca = PCA(n_components=components.shape[0])
+    pca.components_ = components
+    pca.mean_ = mean
+    pca.explained_variance_ = explained_variance
+    pca.explained_variance_ratio_ = explained_variance_ratio
+    pca.singular_values_ = singular_values
+    pca.noise_variance_ = noise_variance
+    pca.n_samples_ = n_samples
+    pca.n_components_ = components.shape[0]
+    pca.n_features_in_ = components.shape[1]
+    return pca
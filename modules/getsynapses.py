@@ -5,52 +5,109 @@
  morphological metrics
 
  Because synapses belong to each cell and does not depend on which cell you are
- analyzing (e.g. different synapse count UB/LBs) let's have one big folder that
- stores all the synapse csv
+ analyzing (e.g. different synapse count UB/LBs) let's have one big store that
+ keeps synapses of all the cells (see synapsestore.py)
 
 """
 
 ## Packages
-from neuprint import Client
 import pandas as pd
 import numpy as np
 import os
-import glob
+import modules.asyncfetch as asyncfetch
+import modules.instrument as instrument
+import modules.neuprintclient as neuprintclient
+import modules.synapsestore as synapsestore
 
 
-# This will go through the "synapselist" folder and download synapse if necessary
+# This will look into the synapse store and download synapses if necessary
+# Returns a dataframe with x/y/z columns that is a view into the store
 def getsynapses(bodyid,synapseType):
 
-    # refer to different directory depending on which synapse type you are using
-    if synapseType=='pre':
-        synapseDir = '.\\data\\synapselist\\'
-    else:
-        synapseDir = '.\\data\\postsynapselist\\'
-
     # just making explicit what is being called...
-    print('Running getsynapses...')
+    instrument.log('Running getsynapses...')
 
     # First, check if synapses of this neuron has been already saved
-    thisSynapseFile = glob.glob(synapseDir+str(bodyid)+'.csv')
-
-    # if it does not exist, download
-    if not thisSynapseFile:
-        print('Downloading the '+synapseType+'synapses of cell#'+str(bodyid))
-        # First, connect to the neuPrint server
-        f = open("authtoken","r")
-        tokenstr = f.read()
-        c = Client('neuprint.janelia.org', dataset='hemibrain:v1.2.1', token=tokenstr)
-        c.fetch_version()
-        # Prepare query
-        q = """\
-            MATCH (a:Neuron)-[:Contains]->(:SynapseSet)-[:Contains]->(s:Synapse)
-            WHERE a.bodyId=%s AND s.type = '%s' AND s.`LO(R)`
-            RETURN DISTINCT s.location.x as x, s.location.y as y, s.location.z as z
-            """ % (bodyid,synapseType)
-        df = c.fetch_custom(q)
-        # save it
-        df.to_csv(synapseDir+str(bodyid)+'.csv')
+    xyz = synapsestore.getsynapsearray(bodyid,synapseType)
+
+    # if it does not exist, download it through the bulk path (cells of a
+    # list should be loaded with getsynapses_bulk, which adds one segment to
+    # the store for many cells instead of one per cell)
+    if xyz is None:
+        downloadsynapses([bodyid],synapseType)
+        xyz = synapsestore.getsynapsearray(bodyid,synapseType)
+    else:
+        instrument.cachehit('synapses')
+    return synapsedataframe(xyz)
+
+# Bulk version of getsynapses: given the whole list of bodyIds, download the
+# cells missing from the synapse store (see downloadsynapses). Returns a list
+# of synapse dataframes in the order of the bodyIds provided
+def getsynapses_bulk(bodyids,synapseType,**kwargs):
+    downloadsynapses(bodyids,synapseType,**kwargs)
+    # collect the synapses in the requested order
+    synapselist = [synapsedataframe(synapsestore.getsynapsearray(bodyid,synapseType)) for bodyid in bodyids]
+    return synapselist
+
+# Check which cells are missing from the synapse store in one pass, and
+# download only those, many cells per query, into the store
+@instrument.timed('getsynapses')
+def downloadsynapses(bodyids,synapseType,**kwargs):
+    # number of bodyIds sent to the server in one query
+    if 'chunkSize' in kwargs:
+        chunkSize = kwargs.get('chunkSize')
+    else:
+        chunkSize = 200
+
+    # number of queries kept in flight at the same time
+    if 'n_concurrent' in kwargs:
+        n_concurrent = kwargs.get('n_concurrent')
     else:
-        # load it otherwise
-        df = pd.read_csv(synapseDir+str(bodyid)+'.csv')
-    return df
+        n_concurrent = 1
+
+    # just making explicit what is being called...
+    print('Running downloadsynapses...')
+
+    # First, check which cells have been already saved (in one pass)
+    missing = [bodyid for bodyid, saved in zip(bodyids, synapsestore.hassynapses(bodyids,synapseType)) if not saved]
+    # don't download the same cell twice
+    missing = list(dict.fromkeys(missing))
+    instrument.cachehit('synapses', len(set(bodyids))-len(missing))
+    instrument.cachemiss('synapses', len(missing))
+
+    # download the missing cells chunk by chunk, and add each chunk to the store
+    # (so an interrupted download resumes with the cells still missing)
+    if missing:
+        n_saved = len(set(bodyids))-len(missing)
+        if n_saved:
+            print(n_saved,'of',len(set(bodyids)),'cells are already in the synapse store and skipped')
+        print('Downloading the '+synapseType+'synapses of',len(missing),'cells')
+        chunks = [missing[start:start+chunkSize] for start in range(0,len(missing),chunkSize)]
+        queries = []
+        for thisChunk in chunks:
+            q = """\
+                UNWIND [%s] AS thisId
+                MATCH (a:Neuron)-[:Contains]->(:SynapseSet)-[:Contains]->(s:Synapse)
+                WHERE a.bodyId=thisId AND s.type = '%s' AND s.`LO(R)`
+                RETURN DISTINCT a.bodyId as bodyId, s.location.x as x, s.location.y as y, s.location.z as z
+                """ % (','.join(str(bodyid) for bodyid in thisChunk),synapseType)
+            queries.append(q)
+
+        progress = instrument.Progress('Synapses', len(missing))
+        def savechunk(ii,df):
+            synapsestore.addsynapses(df['bodyId'].to_numpy(), df[['x','y','z']].to_numpy(), synapseType, chunks[ii])
+            progress.update(len(chunks[ii]))
+
+        if n_concurrent>1:
+            # keep several chunks in flight; each chunk is saved as soon as it arrives
+            print('Fetching',len(queries),'chunks of cells with',n_concurrent,'concurrent queries...')
+            asyncfetch.fetchall(queries, n_concurrent=n_concurrent, callback=savechunk)
+        else:
+            # First, connect to the neuPrint server
+            c = neuprintclient.getclient()
+            for ii in range(len(queries)):
+                savechunk(ii, c.fetch_custom(queries[ii]))
+
+# Wrap (N, 3) coordinates as a dataframe with x/y/z columns without copying
+def synapsedataframe(xyz):
+    return pd.DataFrame(xyz, columns=['x','y','z'], copy=False)
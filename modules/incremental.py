@@ -0,0 +1,88 @@
+"""
+
+ Incremental updates of per-cell matrices (connectivity, depth, spread)
+
+ When the bodyId list changes (e.g. ub/lb is widened), most of the cells are
+ often already in a matrix saved earlier. findbase() looks through the cache
+ manifest for the saved matrix that shares the most cells with the new list,
+ so that only the new cells need to be fetched and calculated. mergerows()
+ then puts reused and new rows together in the order of the new bodyId list
+
+ Cells of the reused matrix that are not in the new list are not removed from
+ it (the old matrix stays valid for its own list); they are recorded in a
+ tombstone file next to the new matrix instead
+
+"""
+## Packages
+import os
+import numpy as np
+import pandas as pd
+import modules.artifactcache as artifactcache
+import modules.instrument as instrument
+import modules.matrixfile as matrixfile
+import modules.neuprintclient as neuprintclient
+
+
+# Saved matrix of the given kind that shares the most cells with bodyids
+# Entries must have the same values as match for all the keys in match, and
+# the entry made with params itself (which is being recalculated) is skipped
+# Returns (path, bodyIds in it) or (None, None)
+def findbase(kind,bodyids,params,match=None):
+    if match is None:
+        match = {}
+    skip = artifactcache.makekey(kind, params)
+    manifest = artifactcache.loadmanifest()
+    best, bestids, bestoverlap = None, None, 0
+    for key, entry in manifest.items():
+        if key == skip or entry['kind'] != kind or entry['dataset'] != neuprintclient.settings['dataset']:
+            continue
+        if any(artifactcache.normalize(entry['params'].get(k)) != artifactcache.normalize(v) for k, v in match.items()):
+            continue
+        if not os.path.exists(entry['path']):
+            continue
+        ids = matrixfile.readbodyids(entry['path'])
+        overlap = np.count_nonzero(np.isin(bodyids, ids))
+        if overlap > bestoverlap:
+            best, bestids, bestoverlap = entry['path'], ids, overlap
+    if best is not None:
+        print('Reusing',bestoverlap,'of',len(bodyids),'cells from',best)
+        instrument.count('reusedCells.'+kind, bestoverlap)
+    return best, bestids
+
+
+# Data columns (after bodyId) of a saved matrix, indexed by bodyId
+def readrows(path):
+    table = matrixfile.readmatrix(path)
+    data = table.iloc[:,table.columns.get_loc('bodyId')+1:]
+    data.index = table['bodyId'].to_numpy()
+    return data
+
+
+# Put rows of several tables (indexed by bodyId) together in the order of
+# bodyidlist, taking the union of their columns (missing entries are fill)
+# With dropEmpty, columns that are zero for every cell are removed, as they
+# would not be there if the matrix was made from scratch
+def mergerows(tables,bodyidlist,fill=0,dropEmpty=False):
+    tables = [table for table in tables if len(table)]
+    columns = pd.Index([])
+    for table in tables:
+        columns = columns.append(table.columns.difference(columns, sort=False))
+    merged = pd.concat([table.reindex(columns=columns, fill_value=fill) for table in tables])
+    merged = merged[~merged.index.duplicated()].reindex(bodyidlist['bodyId'].to_numpy())
+    if merged.isna().to_numpy().any():
+        raise ValueError('Some cells are missing from the merged matrix')
+    if dropEmpty:
+        merged = merged.loc[:,(merged!=0).any(axis=0)]
+    merged.index = bodyidlist.index
+    return pd.concat([bodyidlist, merged], axis=1)
+
+
+# Record cells of the reused matrix that dropped out of the new list
+def writetombstones(path,dropped,source):
+    folder, filename = os.path.split(path)
+    tombstonefile = os.path.join(folder,'tombstone_'+os.path.splitext(filename)[0]+'.csv')
+    if len(dropped):
+        pd.DataFrame({'bodyId': dropped, 'source': source}).to_csv(tombstonefile)
+        print(len(dropped),'cells of',source,'are not in the new list (see',tombstonefile+')')
+    elif os.path.exists(tombstonefile):
+        os.remove(tombstonefile)
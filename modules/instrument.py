@@ -0,0 +1,332 @@
+"""
+
+ Instrumentation: where does the time of a run go?
+
+ - span(name) (a context manager) or @timed(name) (a decorator) records the
+   wall time of a stage, the RSS at its start and end, its peak RSS, and how
+   much each counter grew during it. Spans can be nested (names are joined
+   with '/')
+ - count(name, n) increments a counter, e.g. the number of Cypher queries and
+   the bytes received (counted by modules/neuprintclient.py), or the cache hits
+   and misses of each kind of data (cachehit/cachemiss)
+ - Progress prints the throughput and ETA of long loops every few seconds
+ - writereport() saves everything as a json run report, plus a csv file with
+   one row per span
+
+ configure(report=<folder>) makes the report be written when the process
+ exits, also when it fails. With quiet=1, progress lines and per-cell
+ messages (see log()) are not printed
+
+ Counters are those of the calling process: work done in worker processes only
+ shows up in the time of the span and in the peak RSS of the children
+
+"""
+## Packages
+import atexit
+import contextlib
+import csv
+import functools
+import json
+import os
+import platform
+import sys
+import threading
+import time
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+# default settings
+settings = {
+    'report': None,          # folder of the run reports (None: no report)
+    'quiet': 0,              # do not print progress lines and per-cell messages
+    'progressInterval': 10,  # seconds between progress lines of a loop
+    'sampleInterval': 0.05,  # seconds between RSS samples while spans are open
+}
+
+# shared state
+_lock = threading.Lock()
+_local = threading.local()
+_counters = {}
+_spans = []  # finished spans
+_open = []   # spans being measured (their peak RSS is updated by the sampler)
+_loops = []  # finished Progress loops
+_sampler = None
+_started = time.time()
+_t0 = time.perf_counter()
+_registered = False
+
+
+def configure(**kwargs):
+    global _registered
+    for key in kwargs:
+        if key not in settings:
+            raise KeyError('Unknown instrumentation setting: '+key)
+    settings.update(kwargs)
+    if settings['report'] and not _registered:
+        atexit.register(writereport)
+        _registered = True
+
+
+# Forget everything recorded so far (e.g. between benchmark runs)
+def reset():
+    global _started, _t0
+    with _lock:
+        _counters.clear()
+        _spans.clear()
+        _loops.clear()
+        _started = time.time()
+        _t0 = time.perf_counter()
+
+
+def count(name,n=1):
+    # plain python numbers, so that the report can be saved as json (counts
+    # often come from numpy, e.g. np.count_nonzero)
+    if hasattr(n, 'item'):
+        n = n.item()
+    with _lock:
+        _counters[name] = _counters.get(name,0)+n
+
+
+def cachehit(kind,n=1):
+    count('cache.'+kind+'.hit', n)
+
+
+def cachemiss(kind,n=1):
+    count('cache.'+kind+'.miss', n)
+
+
+# print unless in the quiet mode (for messages repeated for every cell/chunk)
+def log(*args):
+    if not settings['quiet']:
+        print(*args)
+
+
+## Memory
+
+# Current resident set size in bytes (None where it cannot be read)
+def currentrss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+# Peak RSS in bytes of this process, or of the largest of its finished
+# children (children=True)
+def peakrss(children=False):
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # ru_maxrss is in bytes on macOS, in kilobytes elsewhere
+    return usage.ru_maxrss if sys.platform=='darwin' else usage.ru_maxrss*1024
+
+
+# Sample the RSS while spans are open, so that each span gets its own peak
+# (the peak of the process as a whole can not be reset)
+def startsampler():
+    global _sampler
+    with _lock:
+        if _sampler is not None and _sampler.is_alive():
+            return
+        _sampler = threading.Thread(target=samplerss, daemon=True)
+        _sampler.start()
+
+
+def samplerss():
+    while True:
+        rss = currentrss()
+        with _lock:
+            if not _open or rss is None:
+                return
+            for record in _open:
+                record['peak'] = max(record['peak'], rss)
+        time.sleep(settings['sampleInterval'])
+
+
+def megabytes(nbytes):
+    return None if nbytes is None else round(nbytes/1e6, 1)
+
+
+## Spans
+
+@contextlib.contextmanager
+def span(name):
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    stack.append(name)
+    rss = currentrss()
+    record = {'name': '/'.join(stack), 'rssStart': rss, 'peak': rss if rss is not None else 0}
+    with _lock:
+        before = dict(_counters)
+        _open.append(record)
+    startsampler()
+    start = time.perf_counter()
+    status = 'failed'
+    try:
+        yield
+        status = 'ok'
+    finally:
+        seconds = time.perf_counter()-start
+        rss = currentrss()
+        with _lock:
+            _open.remove(record)
+            delta = {key: value-before.get(key,0) for key, value in _counters.items() if value != before.get(key,0)}
+        stack.pop()
+        if rss is None:
+            # no sampling possible, fall back to the peak of the whole process
+            peak = peakrss()
+        else:
+            peak = max(record['peak'], rss)
+        row = {'name': record['name'],
+               'start': round(start-_t0, 3),
+               'seconds': round(seconds, 3),
+               'status': status,
+               'rssStartMB': megabytes(record['rssStart']),
+               'rssEndMB': megabytes(rss),
+               'peakRssMB': megabytes(peak),
+               'childrenPeakRssMB': megabytes(peakrss(children=True)),
+               'counters': delta}
+        with _lock:
+            _spans.append(row)
+        log('['+record['name']+'] '+status+' in '+formatseconds(seconds)+
+            ('' if peak is None else ', peak RSS '+str(megabytes(peak))+' MB'))
+
+
+# Decorator running the whole function in a span
+def timed(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+## Loops
+
+# Throughput and ETA of a loop over total items (cells, chunks, ...)
+# Call update(n) when n more items are done; a line is printed at most every
+# progressInterval seconds and when the loop is done. Safe to update from
+# several threads (e.g. callbacks of concurrent queries)
+class Progress:
+    def __init__(self, label, total, unit='cells'):
+        self.label = label
+        self.total = total
+        self.unit = unit
+        self.done = 0
+        self.start = time.perf_counter()
+        self.lastprint = None
+        self.finished = False
+        self.lock = threading.Lock()
+
+    def update(self, n=1):
+        with self.lock:
+            self.done += n
+            now = time.perf_counter()
+            if self.done >= self.total:
+                self.finish()
+            elif self.lastprint is None or now-self.lastprint >= settings['progressInterval']:
+                self.lastprint = now
+                log(self.line(now))
+
+    def line(self, now):
+        elapsed = max(now-self.start, 1e-9)
+        rate = self.done/elapsed
+        text = self.label+': '+str(self.done)+'/'+str(self.total)+' '+self.unit+' (%.1f/s' % rate
+        if self.done < self.total:
+            text += ', ETA '+(formatseconds((self.total-self.done)/rate) if rate > 0 else '?')
+        else:
+            text += ', took '+formatseconds(elapsed)
+        return text+')'
+
+    # record the loop in the report (called by update when all items are done)
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        now = time.perf_counter()
+        seconds = now-self.start
+        log(self.line(now))
+        with _lock:
+            _loops.append({'label': self.label, 'unit': self.unit, 'total': self.total, 'done': self.done,
+                           'seconds': round(seconds, 3),
+                           'perSecond': round(self.done/seconds, 3) if seconds > 0 else None})
+
+
+def formatseconds(seconds):
+    if seconds < 60:
+        return '%.1f s' % seconds
+    seconds = int(round(seconds))
+    if seconds < 3600:
+        return '%d:%02d' % (seconds//60, seconds%60)
+    return '%d:%02d:%02d' % (seconds//3600, seconds//60%60, seconds%60)
+
+
+## Report
+
+# Everything recorded so far as a dict
+def summary():
+    with _lock:
+        counters = {key: round(value, 3) if isinstance(value, float) else value for key, value in _counters.items()}
+        spans = list(_spans)
+        loops = list(_loops)
+    # hit rate of each kind of cached data
+    cache = {}
+    for key, value in counters.items():
+        if key.startswith('cache.') and key.count('.') == 2:
+            _, kind, outcome = key.split('.')
+            cache.setdefault(kind, {'hit': 0, 'miss': 0})
+            if outcome in ('hit','miss'):
+                cache[kind][outcome] = value
+    for kind, stats in cache.items():
+        total = stats['hit']+stats['miss']
+        stats['hitRate'] = round(stats['hit']/total, 4) if total else None
+    return {'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(_started)),
+            'argv': sys.argv,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'wallSeconds': round(time.perf_counter()-_t0, 3),
+            'peakRssMB': megabytes(peakrss()),
+            'childrenPeakRssMB': megabytes(peakrss(children=True)),
+            'counters': counters,
+            'cache': cache,
+            'spans': spans,
+            'loops': loops}
+
+
+# Save the run report as json (and the spans as csv next to it)
+# By default the report goes to the report folder, named after the script and
+# the time the run started
+def writereport(path=None):
+    if path is None:
+        if not settings['report']:
+            return None
+        script = os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'run'
+        path = os.path.join(settings['report'],
+                            script+'_'+time.strftime('%Y%m%d-%H%M%S', time.localtime(_started))+'.json')
+    report = summary()
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
+    columns = ['name','start','seconds','status','rssStartMB','rssEndMB','peakRssMB','childrenPeakRssMB',
+               'queries','bytesReceived','cacheHits','cacheMisses']
+    with open(os.path.splitext(path)[0]+'.csv', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        for row in report['spans']:
+            counters = row['counters']
+            out = {key: row[key] for key in columns[:8]}
+            out['queries'] = counters.get('queries', 0)
+            out['bytesReceived'] = counters.get('bytesReceived', 0)
+            out['cacheHits'] = sum(v for k, v in counters.items() if k.startswith('cache.') and k.endswith('.hit'))
+            out['cacheMisses'] = sum(v for k, v in counters.items() if k.startswith('cache.') and k.endswith('.miss'))
+            writer.writerow(out)
+    print('Saved the run report to',path)
+    return path
@@ -0,0 +1,188 @@
+"""
+
+ Binary files of the per-cell matrices (connectivity, depth, spread)
+
+ Matrices can be saved as csv (as before) or in a compact binary format, as
+ <name>.npz holding
+ - bodyId          : int64 bodyIds of the rows
+ - columns         : names of the data columns (e.g. downstream types)
+ - lead_<i>        : columns before bodyId (lead_names gives their names)
+ - data/indices/indptr/shape : a sparse CSR matrix (connectivity), or
+ - values          : a dense matrix (uint16/uint32 for counts such as depth
+                     histograms, float32 for others such as spread)
+ and <name>.json, a sidecar with the parameters the matrix was made from, the
+ dataset, its shape and dtype
+
+ readmatrix() returns the same DataFrame (leading columns, bodyId, data
+ columns) for both formats, so code finding the data columns with
+ columns.get_loc('bodyId')+1 works on either. readheader()/readchunks() read
+ the header and chunks of rows without building a DataFrame
+
+"""
+## Packages
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+from scipy import sparse
+import modules.neuprintclient as neuprintclient
+
+formatVersion = 1
+
+
+# Path of a matrix in the given format ('csv' or 'npz')
+def matrixpath(path,matrixFormat):
+    return os.path.splitext(path)[0]+'.'+matrixFormat
+
+
+def sidecarpath(path):
+    return os.path.splitext(path)[0]+'.json'
+
+
+# Smallest dtype holding the values exactly: unsigned integers for counts,
+# float32 otherwise
+def compactdtype(values):
+    values = np.asarray(values)
+    if values.size == 0:
+        return np.dtype(np.uint16)
+    if values.dtype.kind in 'iub' or (np.all(np.isfinite(values)) and np.all(values == np.round(values))):
+        if np.min(values) >= 0:
+            top = np.max(values)
+            for dtype in (np.uint16, np.uint32):
+                if top <= np.iinfo(dtype).max:
+                    return np.dtype(dtype)
+            return np.dtype(np.uint64)
+    return np.dtype(np.float32)
+
+
+# Save a matrix DataFrame (columns before bodyId, bodyId, data columns)
+# With matrixFormat='csv' this is df.to_csv(path); with 'npz', the binary
+# format described above (path gets the .npz extension). Returns the path
+def savematrix(df,path,**kwargs):
+    if 'matrixFormat' in kwargs:
+        matrixFormat = kwargs.get('matrixFormat')
+    else:
+        matrixFormat = 'csv'
+    # store the data as a sparse matrix (for connectivity)
+    if 'sparse' in kwargs:
+        sparseFlag = kwargs.get('sparse')
+    else:
+        sparseFlag = 0
+    # dtype of the data ('auto': see compactdtype)
+    if 'dtype' in kwargs:
+        dtype = kwargs.get('dtype')
+    else:
+        dtype = 'auto'
+    # kind and parameters of the matrix, saved in the sidecar
+    if 'kind' in kwargs:
+        kind = kwargs.get('kind')
+    else:
+        kind = None
+    if 'params' in kwargs:
+        params = kwargs.get('params')
+    else:
+        params = None
+
+    path = matrixpath(path, matrixFormat)
+    if matrixFormat == 'csv':
+        df.to_csv(path)
+        return path
+    if matrixFormat != 'npz':
+        raise ValueError('Unknown matrix format: '+str(matrixFormat))
+
+    datastart = df.columns.get_loc('bodyId')+1
+    values = df.iloc[:,datastart:].to_numpy()
+    dtype = compactdtype(values) if dtype == 'auto' else np.dtype(dtype)
+    arrays = {'bodyId': df['bodyId'].to_numpy(dtype=np.int64),
+              'columns': np.array([str(column) for column in df.columns[datastart:]]),
+              'lead_names': np.array([str(column) for column in df.columns[:datastart-1]])}
+    for ii in range(datastart-1):
+        lead = df.iloc[:,ii].to_numpy()
+        arrays['lead_'+str(ii)] = lead.astype(str) if lead.dtype == object else lead
+    if sparseFlag:
+        mat = sparse.csr_matrix(values.astype(dtype))
+        arrays.update({'data': mat.data, 'indices': mat.indices, 'indptr': mat.indptr,
+                       'shape': np.array(mat.shape, dtype=np.int64)})
+    else:
+        arrays['values'] = np.ascontiguousarray(values.astype(dtype))
+
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    # written under a temporary name and renamed, the sidecar last
+    with open(path+'.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(path+'.tmp', path)
+    sidecar = {'format': formatVersion, 'kind': kind, 'params': params,
+               'dataset': neuprintclient.settings['dataset'],
+               'shape': [len(df), len(df.columns)-datastart], 'dtype': dtype.name, 'sparse': bool(sparseFlag),
+               'created': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    with open(sidecarpath(path)+'.tmp', 'w') as f:
+        json.dump(sidecar, f, indent=1, default=str)
+    os.replace(sidecarpath(path)+'.tmp', sidecarpath(path))
+    return path
+
+
+# Arrays of a binary matrix file (loaded at once; they are compact)
+def loadarrays(path):
+    with np.load(path) as saved:
+        return {key: saved[key] for key in saved.files}
+
+
+# Data of a binary matrix file as a dense array (rows start:stop)
+def densevalues(arrays,start=0,stop=None):
+    if 'values' in arrays:
+        return arrays['values'][start:stop]
+    mat = sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=tuple(arrays['shape']))
+    return mat[start:stop].toarray()
+
+
+# Read a saved matrix (csv or npz) as a DataFrame
+def readmatrix(path):
+    if not path.endswith('.npz'):
+        return pd.read_csv(path)
+    arrays = loadarrays(path)
+    values = densevalues(arrays)
+    # counts come back as int64, as read from csv (unsigned values wrap around
+    # when subtracted)
+    if values.dtype.kind == 'u':
+        values = values.astype(np.int64)
+    table = pd.DataFrame(values, columns=pd.Index(arrays['columns'], dtype=object))
+    lead = {str(name): arrays['lead_'+str(ii)] for ii, name in enumerate(arrays['lead_names'])}
+    lead['bodyId'] = arrays['bodyId']
+    return pd.concat([pd.DataFrame(lead), table], axis=1)
+
+
+# bodyIds of the rows of a saved matrix
+def readbodyids(path):
+    if not path.endswith('.npz'):
+        return pd.read_csv(path, usecols=['bodyId'])['bodyId'].to_numpy()
+    with np.load(path) as saved:
+        return saved['bodyId']
+
+
+# Header of a saved matrix: all the column names, the position of the first
+# data column (after bodyId) and the number of rows
+def readheader(path):
+    if not path.endswith('.npz'):
+        header = pd.read_csv(path, nrows=0).columns
+        with open(path) as f:
+            n_row = sum(1 for line in f)-1
+    else:
+        with np.load(path) as saved:
+            header = pd.Index(list(saved['lead_names'])+['bodyId']+list(saved['columns']), dtype=object)
+            n_row = len(saved['bodyId'])
+    return header, header.get_loc('bodyId')+1, n_row
+
+
+# Iterate over chunks of rows of a saved matrix as (bodyIds, float64 values)
+def readchunks(path,chunkSize):
+    if not path.endswith('.npz'):
+        for chunk in pd.read_csv(path, chunksize=chunkSize):
+            datastart = chunk.columns.get_loc('bodyId')+1
+            yield chunk['bodyId'].to_numpy(), chunk.iloc[:,datastart:].to_numpy(dtype=np.float64)
+        return
+    arrays = loadarrays(path)
+    for start in range(0, len(arrays['bodyId']), chunkSize):
+        yield arrays['bodyId'][start:start+chunkSize], densevalues(arrays, start, start+chunkSize).astype(np.float64)
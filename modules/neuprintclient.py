@@ -0,0 +1,162 @@
+"""
+
+ Shared neuPrint client
+
+ All the modules get their neuPrint client from here, so that connecting to the
+ server (reading the auth token, selecting the dataset, checking the version) is
+ done once per process instead of once per query.
+
+ - Every thread gets its own Client, but all of them share one pooled HTTP
+   adapter, so connections are reused across the whole process
+ - Requests failing with connection errors or transient 5xx responses are
+   retried with exponential backoff
+ - The rate of requests sent to the server is capped by a rate limiter shared
+   by all threads
+ - Queries, their time, rows and the bytes received are counted (see
+   modules/instrument.py)
+
+ Call configure() before the first query to change any of the settings below,
+ or setclient() to answer all the queries with a stand-in client
+
+"""
+## Packages
+from neuprint import Client
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import threading
+import time
+import modules.instrument as instrument
+
+# default settings
+settings = {
+    'server': 'neuprint.janelia.org',
+    'dataset': 'hemibrain:v1.2.1',
+    'tokenfile': 'authtoken',
+    'maxRetries': 5,            # retries per request before giving up
+    'backoffFactor': 0.5,       # wait backoffFactor*2^(n-1) seconds before the nth retry
+    'maxRequestsPerSecond': 10, # 0 or None disables rate limiting
+    'poolSize': 16,             # number of connections kept alive in the pool
+}
+
+# shared state
+_lock = threading.Lock()
+_adapter = None
+_local = threading.local()
+_generation = 0 # incremented by configure() to invalidate clients already made
+_override = None # client used by every thread instead of connecting (see setclient)
+
+
+# Simple token bucket rate limiter that can be shared across threads
+class RateLimiter:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    # block until we are allowed to send one more request
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now-self.last)*self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1-self.tokens)/self.rate
+            time.sleep(wait)
+
+
+# HTTP adapter that goes through the rate limiter before sending anything
+class RateLimitedAdapter(HTTPAdapter):
+    def __init__(self, ratelimiter, **kwargs):
+        self.ratelimiter = ratelimiter
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.ratelimiter.acquire()
+        response = super().send(request, **kwargs)
+        if not kwargs.get('stream'):
+            instrument.count('bytesReceived', len(response.content))
+        return response
+
+
+# Client counting the queries it runs; everything else is passed through to the
+# neuPrint (or stand-in) client
+class CountingClient:
+    def __init__(self, client):
+        self.client = client
+
+    def fetch_custom(self, q, *args, **kwargs):
+        start = time.perf_counter()
+        df = self.client.fetch_custom(q, *args, **kwargs)
+        instrument.count('queries')
+        instrument.count('querySeconds', time.perf_counter()-start)
+        instrument.count('queryRows', len(df))
+        return df
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+# change settings (e.g. configure(maxRequestsPerSecond=5)); clients created
+# after this call use the new settings
+def configure(**kwargs):
+    global _adapter, _generation
+    with _lock:
+        for key in kwargs:
+            if key not in settings:
+                raise KeyError('Unknown neuPrint client setting: '+key)
+        settings.update(kwargs)
+        _adapter = None
+        _generation += 1
+
+
+def getadapter():
+    global _adapter
+    with _lock:
+        if _adapter is None:
+            # Cypher queries only read the database, so retrying POST is safe
+            retries = Retry(total=settings['maxRetries'],
+                            backoff_factor=settings['backoffFactor'],
+                            status_forcelist=(500, 502, 503, 504),
+                            allowed_methods=None)
+            _adapter = RateLimitedAdapter(RateLimiter(settings['maxRequestsPerSecond']),
+                                          max_retries=retries,
+                                          pool_connections=settings['poolSize'],
+                                          pool_maxsize=settings['poolSize'])
+        return _adapter
+
+
+def readtoken():
+    f = open(settings['tokenfile'],"r")
+    tokenstr = f.read().strip()
+    f.close()
+    return tokenstr
+
+
+# Use the given client object (e.g. synthetic.MockClient) for every query in
+# this process instead of connecting to the server. setclient(None) undoes this
+def setclient(client):
+    global _override
+    _override = None if client is None else CountingClient(client)
+
+
+# Return the neuPrint client of the calling thread (connect if necessary)
+def getclient():
+    if _override is not None:
+        return _override
+    c = getattr(_local, 'client', None)
+    if c is None or _local.generation != _generation:
+        adapter = getadapter()
+        c = Client(settings['server'], dataset=settings['dataset'], token=readtoken())
+        c.session.mount('https://', adapter)
+        c.fetch_version()
+        c = CountingClient(c)
+        _local.client = c
+        _local.generation = _generation
+    return c
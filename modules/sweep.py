@@ -0,0 +1,178 @@
+"""
+
+ Parameter sweep over data_weight and n_cluster
+
+ For each weight triple (connectivity/depth/spread), the weighted feature
+ matrix is built once and Ward linkage is computed once, then the tree is cut
+ at every requested number of clusters with fcluster. Weight triples are
+ processed in parallel worker processes, which read the normalized feature
+ blocks from shared memory instead of getting their own pickled copies
+
+ The result is one table with a row per (weights, k), holding quality metrics
+ of the clustering and the cluster label of every cell
+
+"""
+## Packages
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+import scipy.cluster.hierarchy as sch
+from sklearn.metrics import silhouette_score, calinski_harabasz_score, davies_bouldin_score
+import modules.approxward as approxward
+import modules.instrument as instrument
+import modules.utility as utility
+
+blocknames = ('con','dep','spr')
+
+
+# Normalize each feature matrix by its total dispersion (as in lobulaclustering.py)
+def normalizeblocks(mat_con,mat_dep,mat_spr):
+    blocks = []
+    for mat in (mat_con,mat_dep,mat_spr):
+        mat = np.asarray(mat, dtype=np.float64)
+        blocks.append(mat/np.sum(np.var(mat,axis=0)))
+    return blocks
+
+
+# Weight triples can be given as tuples or as strings like '5/3/1' (config.ini)
+def parseweights(weightlist):
+    if isinstance(weightlist, str):
+        weightlist = [weightlist]
+    out = []
+    for weights in weightlist:
+        if isinstance(weights, str):
+            weights = [float(w) for w in weights.split('/')]
+        if len(weights)!=3:
+            raise ValueError('Weights should have 3 elements (con/dep/spr): '+str(weights))
+        out.append(tuple(weights))
+    return out
+
+
+# Cluster the cells at every combination of weights and k, return a table
+# with one row per (weights, k)
+@instrument.timed('sweep')
+def runsweep(mat_con,mat_dep,mat_spr,weightlist,klist,**kwargs):
+    if 'n_workers' in kwargs:
+        n_workers = kwargs.get('n_workers')
+    else:
+        n_workers = 1
+    # silhouette needs all pairwise distances, so it is calculated on a
+    # random subset of cells above this size (0: all cells)
+    if 'silhouetteSample' in kwargs:
+        silhouetteSample = kwargs.get('silhouetteSample')
+    else:
+        silhouetteSample = 5000
+    # 'exact' (sch.linkage) or 'approximate' (see modules/approxward.py)
+    if 'method' in kwargs:
+        method = kwargs.get('method')
+    else:
+        method = 'exact'
+    if 'n_micro' in kwargs:
+        n_micro = kwargs.get('n_micro')
+    else:
+        n_micro = 2000
+    options = {'silhouetteSample': silhouetteSample, 'method': method, 'n_micro': n_micro}
+
+    weightlist = parseweights(weightlist)
+    klist = sorted(int(k) for k in np.atleast_1d(klist))
+    blocks = normalizeblocks(mat_con,mat_dep,mat_spr)
+    print('Sweeping',len(weightlist),'weight triples x',len(klist),'cluster numbers over',
+          blocks[0].shape[0],'cells...')
+
+    if n_workers>1 and len(weightlist)>1:
+        # copy the blocks into shared memory once, workers attach to them
+        shms = []
+        specs = []
+        try:
+            for block in blocks:
+                shm = shared_memory.SharedMemory(create=True, size=max(block.nbytes,1))
+                np.ndarray(block.shape, dtype=block.dtype, buffer=shm.buf)[:] = block
+                shms.append(shm)
+                specs.append((shm.name, block.shape, block.dtype.str))
+            with ProcessPoolExecutor(max_workers=min(n_workers,len(weightlist)), initializer=initsweepworker,
+                                     initargs=(specs, klist, options)) as executor:
+                results = list(executor.map(sweepweights, weightlist))
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+    else:
+        _worker['blocks'] = blocks
+        _worker['klist'] = klist
+        _worker['options'] = options
+        try:
+            results = [sweepweights(weights) for weights in weightlist]
+        finally:
+            _worker.clear()
+
+    return pd.DataFrame([row for result in results for row in result])
+
+
+# feature blocks and sweep parameters shared by all the tasks of a worker process
+_worker = {}
+
+def initsweepworker(specs,klist,options):
+    # keep references to the shared memory so the buffers stay valid
+    _worker['shms'] = [shared_memory.SharedMemory(name=name) for name, _, _ in specs]
+    _worker['blocks'] = [np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+                         for shm, (_, shape, dtype) in zip(_worker['shms'], specs)]
+    _worker['klist'] = klist
+    _worker['options'] = options
+
+# Linkage for one weight triple, cut at every k
+def sweepweights(weights):
+    blocks = _worker['blocks']
+    options = _worker['options']
+    mat_all = np.concatenate([block*w for block, w in zip(blocks,weights)],axis=1)
+    if options['method']=='approximate':
+        linkage, assignment = approxward.approxlinkage(mat_all, n_micro=options['n_micro'])
+    else:
+        linkage = sch.linkage(mat_all, method='ward', metric='euclidean')
+    rows = []
+    for k in _worker['klist']:
+        if options['method']=='approximate':
+            clabel = approxward.approxfcluster(linkage, assignment, k)
+        else:
+            clabel = sch.fcluster(linkage, k, criterion='maxclust')
+        row = {'w_'+name: w for name, w in zip(blocknames,weights)}
+        row['k'] = k
+        row.update(clustermetrics(mat_all, clabel, options['silhouetteSample']))
+        row['clabel'] = clabel
+        rows.append(row)
+    return rows
+
+
+# Quality metrics of one clustering (calculated on the weighted feature matrix)
+def clustermetrics(mat_all,clabel,silhouetteSample):
+    sizes = np.bincount(clabel)[1:]
+    sizes = sizes[sizes>0]
+    metrics = {'n_found': len(sizes), 'minsize': sizes.min(), 'maxsize': sizes.max()}
+    if 1 < len(sizes) < len(clabel):
+        if silhouetteSample and len(clabel)>silhouetteSample:
+            metrics['silhouette'] = silhouette_score(mat_all, clabel, sample_size=silhouetteSample, random_state=0)
+        else:
+            metrics['silhouette'] = silhouette_score(mat_all, clabel)
+        metrics['calinski_harabasz'] = calinski_harabasz_score(mat_all, clabel)
+        metrics['davies_bouldin'] = davies_bouldin_score(mat_all, clabel)
+    else:
+        metrics['silhouette'] = np.nan
+        metrics['calinski_harabasz'] = np.nan
+        metrics['davies_bouldin'] = np.nan
+    # within cluster sum of squares
+    stats = utility.groupstats(mat_all, clabel)
+    metrics['wcss'] = np.sum(stats['std']**2*stats['counts'][:,None])
+    return metrics
+
+
+# Save the sweep table as two csv files: metrics per (weights, k), and labels
+# of every cell (one column per (weights, k))
+def savesweep(results,bodyids,filename):
+    metrics = results.drop(columns='clabel')
+    metrics.to_csv(filename+'_metrics.csv')
+    labels = {'bodyId': np.asarray(bodyids)}
+    for _, row in results.iterrows():
+        column = 'w'+'-'.join('%g' % row['w_'+name] for name in blocknames)+'_k'+str(row['k'])
+        labels[column] = row['clabel']
+    pd.DataFrame(labels).to_csv(filename+'_labels.csv')
+    print('Saved the sweep to',filename+'_metrics.csv','and',filename+'_labels.csv')
@@ -0,0 +1,238 @@
+"""
+
+ Consolidated binary store of synapse coordinates
+
+ Instead of one csv per cell (and per synapse type), synapses of all the cells
+ are kept under data/synapsestore (see modules/datadir.py) as a few binary numpy files
+
+ - xyz_<segment>.npy  : (N, 3) int32 voxel coordinates (8 nm px)
+ - type_<segment>.npy : (N,) int8 synapse type (0: pre, 1: post)
+ - index.npz          : bodyId, synapse type, segment, start and stop row of
+                        every cell saved, so that synapses of a cell are a
+                        contiguous slice of one segment
+
+ Segment files are opened as memory maps, so synapses of a cell are served as
+ a view into the file without copying. Each batch of newly downloaded cells is
+ added as a new segment; compact() merges them into one.
+
+ The first time the store is opened, synapses already saved as csv files under
+ data/synapselist and data/postsynapselist are migrated into it.
+
+"""
+## Packages
+import pandas as pd
+import numpy as np
+import os
+import glob
+import threading
+import modules.datadir as datadir
+
+synapseTypes = ('pre','post')
+legacyDirs = {'pre': 'synapselist', 'post': 'postsynapselist'}
+
+# in-memory copy of the index and opened segments, and the folder they are from
+_lock = threading.RLock()
+_index = None
+_lookup = None
+_segments = {}
+_dir = None
+
+
+# the store lives in the data folder (see modules/datadir.py)
+def storedir():
+    return datadir.datapath('synapsestore')
+
+
+def typecode(synapseType):
+    if synapseType=='pre':
+        return 0
+    else:
+        return 1
+
+
+def emptyindex():
+    return {'bodyId': np.empty(0,dtype=np.int64),
+            'type': np.empty(0,dtype=np.int8),
+            'segment': np.empty(0,dtype=np.int32),
+            'start': np.empty(0,dtype=np.int64),
+            'stop': np.empty(0,dtype=np.int64)}
+
+
+# Load the index (migrating the csv cache the first time)
+def openstore():
+    global _index, _lookup, _dir
+    with _lock:
+        if _index is not None and _dir != storedir():
+            # the data folder changed (e.g. to that of the synthetic dataset)
+            closestore()
+        if _index is None:
+            _dir = storedir()
+            indexfile = os.path.join(storedir(),'index.npz')
+            if os.path.exists(indexfile):
+                with np.load(indexfile) as saved:
+                    _index = {key: saved[key] for key in saved.files}
+            else:
+                _index = emptyindex()
+            _lookup = {(int(t),int(b)): ii for ii,(t,b) in enumerate(zip(_index['type'],_index['bodyId']))}
+            if not os.path.exists(indexfile):
+                migratecsvcache()
+    return _index
+
+
+# Forget the index and segments loaded in memory (e.g. after the store was
+# changed by another process, or after changing the working directory)
+def closestore():
+    global _index, _lookup
+    with _lock:
+        _index = None
+        _lookup = None
+        _segments.clear()
+
+
+def saveindex():
+    os.makedirs(storedir(), exist_ok=True)
+    tmpfile = os.path.join(storedir(),'index.tmp.npz')
+    np.savez(tmpfile, **_index)
+    os.replace(tmpfile, os.path.join(storedir(),'index.npz'))
+
+
+def getsegment(segment):
+    with _lock:
+        if segment not in _segments:
+            xyz = np.load(os.path.join(storedir(),'xyz_'+str(segment)+'.npy'), mmap_mode='r')
+            types = np.load(os.path.join(storedir(),'type_'+str(segment)+'.npy'), mmap_mode='r')
+            _segments[segment] = (xyz, types)
+        return _segments[segment]
+
+
+# Return a boolean array telling which of the bodyIds are in the store
+def hassynapses(bodyids,synapseType):
+    openstore()
+    code = typecode(synapseType)
+    return np.array([(code,int(bodyid)) in _lookup for bodyid in bodyids], dtype=bool)
+
+
+# Return synapses of a cell as a (N, 3) int32 view into the store (no copy)
+# or None if the cell has not been saved
+def getsynapsearray(bodyid,synapseType):
+    openstore()
+    ii = _lookup.get((typecode(synapseType),int(bodyid)))
+    if ii is None:
+        return None
+    xyz, _ = getsegment(int(_index['segment'][ii]))
+    return xyz[_index['start'][ii]:_index['stop'][ii]]
+
+
+# Add synapses of a batch of cells as a new segment
+# rowids: bodyId of each synapse, xyz: (N, 3) coordinates,
+# bodyids: all the cells in this batch (cells without synapses are stored as
+# empty slices so we don't ask the server about them again)
+def addsynapses(rowids,xyz,synapseType,bodyids):
+    global _index
+    openstore()
+    rowids = np.asarray(rowids, dtype=np.int64)
+    xyz = np.asarray(xyz).reshape(-1,3)
+    bodyids = pd.unique(np.asarray(bodyids, dtype=np.int64))
+    code = typecode(synapseType)
+
+    # make synapses of each cell contiguous, in the order of bodyids
+    rank = pd.Index(bodyids).get_indexer(rowids)
+    if np.any(rank<0):
+        raise ValueError('Synapses of cells not listed in bodyids were provided')
+    order = np.argsort(rank, kind='stable')
+    counts = np.bincount(rank, minlength=len(bodyids))
+    stops = np.cumsum(counts)
+    starts = stops - counts
+
+    with _lock:
+        os.makedirs(storedir(), exist_ok=True)
+        if len(_index['segment']):
+            segment = int(np.max(_index['segment']))+1
+        else:
+            segment = 0
+        # segments are written under a temporary name and renamed, and the
+        # index is saved last, so an interrupted download loses nothing but the
+        # batch in progress
+        savesegment(os.path.join(storedir(),'xyz_'+str(segment)+'.npy'), xyz[order].astype(np.int32))
+        savesegment(os.path.join(storedir(),'type_'+str(segment)+'.npy'), np.full(len(rowids),code,dtype=np.int8))
+
+        # register new cells, and point cells saved before to the new segment
+        keep = np.array([(code,int(bodyid)) not in _lookup for bodyid in bodyids], dtype=bool)
+        for bodyid, start, stop in zip(bodyids[~keep], starts[~keep], stops[~keep]):
+            ii = _lookup[(code,int(bodyid))]
+            _index['segment'][ii] = segment
+            _index['start'][ii] = start
+            _index['stop'][ii] = stop
+        new = {'bodyId': bodyids[keep],
+               'type': np.full(np.sum(keep),code,dtype=np.int8),
+               'segment': np.full(np.sum(keep),segment,dtype=np.int32),
+               'start': starts[keep],
+               'stop': stops[keep]}
+        n_old = len(_index['bodyId'])
+        _index = {key: np.concatenate((_index[key], new[key])) for key in _index}
+        for jj, bodyid in enumerate(new['bodyId']):
+            _lookup[(code,int(bodyid))] = n_old+jj
+        saveindex()
+
+
+def savesegment(path,array):
+    with open(path+'.tmp', 'wb') as f:
+        np.save(f, array)
+    os.replace(path+'.tmp', path)
+
+
+# One-time migration of the per-cell csv files into the store
+def migratecsvcache():
+    for synapseType in synapseTypes:
+        filelist = glob.glob(datadir.datapath(legacyDirs[synapseType],'*.csv'))
+        bodyids = []
+        rowids = []
+        xyzlist = []
+        for file in filelist:
+            _, name = os.path.split(file)
+            if not name[:-4].isdigit():
+                continue
+            df = pd.read_csv(file)
+            bodyids.append(int(name[:-4]))
+            rowids.append(np.full(len(df),int(name[:-4]),dtype=np.int64))
+            xyzlist.append(df[['x','y','z']].to_numpy())
+        if bodyids:
+            print('Migrating',len(bodyids),synapseType+'synapse csv files into the synapse store...')
+            addsynapses(np.concatenate(rowids), np.concatenate(xyzlist), synapseType, bodyids)
+
+
+# Merge all the segments into one (e.g. after many small downloads)
+def compact():
+    global _index
+    openstore()
+    with _lock:
+        if len(np.unique(_index['segment']))<=1:
+            return
+        oldsegments = np.unique(_index['segment'])
+        xyzlist = []
+        typelist = []
+        starts = np.zeros(len(_index['bodyId']),dtype=np.int64)
+        stops = np.zeros(len(_index['bodyId']),dtype=np.int64)
+        n = 0
+        for ii in range(len(_index['bodyId'])):
+            xyz, types = getsegment(int(_index['segment'][ii]))
+            start, stop = _index['start'][ii], _index['stop'][ii]
+            xyzlist.append(xyz[start:stop])
+            typelist.append(types[start:stop])
+            starts[ii] = n
+            n += stop-start
+            stops[ii] = n
+        segment = int(np.max(oldsegments))+1
+        # the merged segment is complete on disk before the index points to it,
+        # and old segments are removed only after that
+        savesegment(os.path.join(storedir(),'xyz_'+str(segment)+'.npy'), np.concatenate(xyzlist).reshape(-1,3).astype(np.int32))
+        savesegment(os.path.join(storedir(),'type_'+str(segment)+'.npy'), np.concatenate(typelist).astype(np.int8))
+        _index['segment'][:] = segment
+        _index['start'] = starts
+        _index['stop'] = stops
+        saveindex()
+        # remove old segments
+        _segments.clear()
+        for old in oldsegments:
+            os.remove(os.path.join(storedir(),'xyz_'+str(old)+'.npy'))
+            os.remove(os.path.join(storedir(),'type_'+str(old)+'.npy'))
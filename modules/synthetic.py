@@ -0,0 +1,294 @@
+"""
+
+ Synthetic lobula dataset and a local stand-in for the neuPrint server
+
+ makehemibrain() generates a toy version of the part of the hemibrain we use
+ - a landmark cell type (e.g. LT1) whose postsynapses cover a thin, curved
+   layer of the lobula
+ - un-labeled lobula fragments whose synapses sit around one or two layers,
+   with a configurable range of synapse counts. Each fragment belongs to a
+   hidden class that sets its depth profile, spread and downstream partners,
+   so that clustering has something to find
+ - labeled downstream neurons (LC/LPLCs and a few other types) as well as
+   un-labeled partners, connected to the fragments with synaptic weights
+ - a few cells of each LC/LPLC type with postsynapses in their own layers, for
+   morphology_validation.py
+
+ MockClient answers the Cypher queries issued by the modules in this folder
+ from such a dataset, and usesyntheticdata() makes every module use it, so the
+ whole pipeline can run without a token or network access. Everything it
+ saves goes to ./data/synthetic instead of ./data (see modules/datadir.py), so
+ cached data of the real dataset are never overwritten (makedatadirs() creates
+ the folders needed)
+
+"""
+## Packages
+import pandas as pd
+import numpy as np
+import os
+import re
+import modules.datadir as datadir
+import modules.neuprintclient as neuprintclient
+
+# labeled downstream types (the LC/LPLCs used in the analysis plus some others)
+LCtypes = ('LC4','LC6','LC9','LC10','LC11','LC12','LC13','LC14','LC15',
+           'LC16','LC17','LC18','LC20','LC21','LC22','LC24','LC25','LC26',
+           'LPLC1','LPLC2','LPLC4')
+othertypes = ('Li01','Li02','Li03','Li04','Li05','LT11','LT12','MeLo1','MeLo2',
+              'Tm20','Tm5c','TmY5a','LLPC1','LPLC3','LC27','LC28')
+
+
+# Generate a synthetic lobula dataset
+# Returns a dict with
+# - neurons  : bodyId, type (None for un-labeled), pre, post, inLO (all synapses in LO(R))
+# - synapses : bodyId, xyz (int32 voxel coordinates) and type (0: pre, 1: post)
+#              arrays, sorted by (bodyId, type)
+# - edges    : pre, post (bodyIds), weight
+# - fragmentclass : hidden class of each fragment (indexed by bodyId)
+def makehemibrain(**kwargs):
+    # number of un-labeled lobula fragments
+    if 'n_cells' in kwargs:
+        n_cells = kwargs.get('n_cells')
+    else:
+        n_cells = 10000
+    # range of the total number of synapses (pre+post) of fragments
+    if 'synapseRange' in kwargs:
+        synapseRange = kwargs.get('synapseRange')
+    else:
+        synapseRange = (50,500)
+    # number of hidden classes of fragments
+    if 'n_classes' in kwargs:
+        n_classes = kwargs.get('n_classes')
+    else:
+        n_classes = 40
+    # landmark cell type and its number of postsynapses
+    if 'landmarkname' in kwargs:
+        landmarkname = kwargs.get('landmarkname')
+    else:
+        landmarkname = 'LT1'
+    if 'n_landmark' in kwargs:
+        n_landmark = kwargs.get('n_landmark')
+    else:
+        n_landmark = 20000
+    # number of cells of each labeled downstream type
+    if 'n_pertype' in kwargs:
+        n_pertype = kwargs.get('n_pertype')
+    else:
+        n_pertype = 5
+    if 'seed' in kwargs:
+        seed = kwargs.get('seed')
+    else:
+        seed = 0
+
+    rng = np.random.default_rng(seed)
+
+    # Geometry of the lobula: a curved slab in its own (u, v, depth) frame (in
+    # microns), rotated and shifted into the hemibrain space
+    curvature = np.array([0.004, 0.006, 0.001]) # u^2, v^2, uv
+    extent = np.array([60.0, 40.0])
+    rotation, _ = np.linalg.qr(rng.normal(size=(3,3)))
+    # PCA reports axes with their largest element positive; orient the depth
+    # axis the same way so that depth of the landmark's PC3 increases with d
+    if rotation[np.argmax(np.abs(rotation[:,2])),2]<0:
+        rotation[:,2] = -rotation[:,2]
+    center = np.array([20000.0, 25000.0, 30000.0])*8/1000
+
+    def tovoxel(u,v,d):
+        w = curvature[0]*u**2 + curvature[1]*v**2 + curvature[2]*u*v + d
+        xyz = np.stack((u,v,w),axis=1) @ rotation.T + center
+        return np.round(xyz*1000/8).astype(np.int32)
+
+    types = list(LCtypes)+list(othertypes)
+    bodyidlist = []
+    typelist = []
+    synlist = []
+    nextid = 100000001
+
+    # landmark: postsynapses in a thin layer at depth 0
+    u = rng.uniform(-extent[0],extent[0],n_landmark)
+    v = rng.uniform(-extent[1],extent[1],n_landmark)
+    d = rng.normal(0,1.0,n_landmark)
+    landmarkids = nextid + rng.integers(0,3,n_landmark)
+    nextid += 3
+    for bodyid in np.unique(landmarkids):
+        bodyidlist.append(bodyid)
+        typelist.append(landmarkname)
+    synlist.append((landmarkids, tovoxel(u,v,d), np.ones(n_landmark,dtype=np.int8)))
+
+    # labeled downstream cells, with postsynapses around a type-specific layer
+    typeids = {}
+    typedepth = rng.uniform(-10,45,len(types))
+    for tt, thistype in enumerate(types):
+        ids = np.arange(nextid,nextid+n_pertype)
+        nextid += n_pertype
+        typeids[thistype] = ids
+        bodyidlist.extend(ids)
+        typelist.extend([thistype]*n_pertype)
+        n_syn = rng.integers(200,600,n_pertype)
+        rowids = np.repeat(ids,n_syn)
+        u = rng.normal(0,extent[0]/3,len(rowids)).clip(-extent[0],extent[0])
+        v = rng.normal(0,extent[1]/3,len(rowids)).clip(-extent[1],extent[1])
+        d = rng.normal(typedepth[tt],3.0,len(rowids))
+        synlist.append((rowids, tovoxel(u,v,d), np.ones(len(rowids),dtype=np.int8)))
+
+    # un-labeled downstream partners
+    n_untyped = max(10,n_cells//20)
+    untypedids = np.arange(nextid,nextid+n_untyped)
+    nextid += n_untyped
+    bodyidlist.extend(untypedids)
+    typelist.extend([None]*n_untyped)
+
+    # hidden classes of fragments: depth profile (one or two layers),
+    # spread, and preference for downstream types
+    classdepth = rng.uniform(-15,45,(n_classes,2))
+    classbilayer = rng.random(n_classes)<0.3
+    classspread = rng.uniform(1.0,8.0,(n_classes,2))
+    classpref = rng.dirichlet(np.full(len(types),0.2),n_classes)
+
+    # fragments
+    fragmentids = np.arange(nextid,nextid+n_cells)
+    nextid += n_cells
+    fragmentclass = rng.integers(0,n_classes,n_cells)
+    n_total = rng.integers(synapseRange[0],synapseRange[1],n_cells)
+    n_pre = rng.binomial(n_total,0.5)
+    n_post = n_total - n_pre
+    bodyidlist.extend(fragmentids)
+    typelist.extend([None]*n_cells)
+    cellu = rng.uniform(-extent[0]*0.8,extent[0]*0.8,n_cells)
+    cellv = rng.uniform(-extent[1]*0.8,extent[1]*0.8,n_cells)
+    for thistype, n_syn in ((0,n_pre),(1,n_post)):
+        rowids = np.repeat(fragmentids,n_syn)
+        rowclass = np.repeat(fragmentclass,n_syn)
+        u = np.repeat(cellu,n_syn) + rng.normal(size=len(rowids))*classspread[rowclass,0]
+        v = np.repeat(cellv,n_syn) + rng.normal(size=len(rowids))*classspread[rowclass,1]
+        layer = np.where(classbilayer[rowclass], rng.integers(0,2,len(rowids)), 0)
+        d = classdepth[rowclass,layer] + rng.normal(0,1.5,len(rowids))
+        synlist.append((rowids, tovoxel(u,v,d), np.full(len(rowids),thistype,dtype=np.int8)))
+
+    # connectivity from fragments to typed and untyped partners
+    n_partner = rng.integers(3,15,n_cells)
+    prerows = np.repeat(np.arange(n_cells),n_partner)
+    prefcum = np.cumsum(classpref[fragmentclass[prerows]],axis=1)
+    partnertype = (prefcum < rng.random(len(prerows))[:,None]).sum(axis=1).clip(0,len(types)-1)
+    typedpartner = np.array([typeids[types[tt]] for tt in range(len(types))])[partnertype,rng.integers(0,n_pertype,len(prerows))]
+    untyped = rng.random(len(prerows))<0.3
+    partner = np.where(untyped, rng.choice(untypedids,len(prerows)), typedpartner)
+    weight = rng.integers(1,12,len(prerows))
+    edges = pd.DataFrame({'pre': fragmentids[prerows], 'post': partner, 'weight': weight})
+    # one connection per pair of cells
+    edges = edges.groupby(['pre','post'],as_index=False)['weight'].sum()
+
+    # put synapses together, sorted by (bodyId, type)
+    rowids = np.concatenate([syn[0] for syn in synlist])
+    xyz = np.concatenate([syn[1] for syn in synlist])
+    syntype = np.concatenate([syn[2] for syn in synlist])
+    order = np.lexsort((syntype,rowids))
+    synapses = {'bodyId': rowids[order], 'xyz': xyz[order], 'type': syntype[order]}
+
+    # neuron table with synapse counts
+    neurons = pd.DataFrame({'bodyId': np.asarray(bodyidlist,dtype=np.int64), 'type': typelist})
+    counts = pd.crosstab(synapses['bodyId'], synapses['type']).reindex(columns=[0,1], fill_value=0)
+    neurons['pre'] = counts[0].reindex(neurons['bodyId'], fill_value=0).to_numpy()
+    neurons['post'] = counts[1].reindex(neurons['bodyId'], fill_value=0).to_numpy()
+    neurons['inLO'] = True
+
+    return {'neurons': neurons, 'synapses': synapses, 'edges': edges,
+            'fragmentclass': pd.Series(fragmentclass, index=fragmentids)}
+
+
+# Stand-in for neuprint.Client that answers the queries issued by the modules
+class MockClient:
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.neurons = dataset['neurons'].set_index('bodyId', drop=False)
+        synapses = dataset['synapses']
+        self.synbodyid = synapses['bodyId']
+        self.synkey = synapses['bodyId']*2 + synapses['type']
+        self.xyz = synapses['xyz']
+        edges = dataset['edges'].sort_values('pre', kind='stable')
+        self.edgepre = edges['pre'].to_numpy()
+        self.edgepost = edges['post'].to_numpy()
+        self.edgeweight = edges['weight'].to_numpy()
+        self.edgetype = self.neurons['type'].reindex(self.edgepost).to_numpy()
+
+    def fetch_version(self):
+        return 'synthetic'
+
+    def fetch_custom(self, q):
+        q = ' '.join(q.split())
+        if 'a.type IS NULL' in q:
+            m = re.search(r'a\.pre\+a\.post<(\S+) AND a\.pre\+a\.post>(\S+)', q)
+            ub, lb = float(m.group(1)), float(m.group(2))
+            n = self.neurons
+            total = n['pre']+n['post']
+            sel = n['type'].isna() & n['inLO'] & (total<ub) & (total>lb) & (total>0)
+            return pd.DataFrame({'bodyId': n.loc[sel,'bodyId'].to_numpy()})
+        if 'ConnectsTo' in q:
+            if 'UNWIND' in q:
+                bodyids = self.parseids(q)
+                df = self.edgesof(bodyids)
+                df = df[df['type'].notna()]
+                return df.groupby(['bodyId','type'],as_index=False,sort=False)['w'].sum()
+            m = re.search(r'a\.bodyId=(\d+)', q)
+            df = self.edgesof([int(m.group(1))])
+            return pd.DataFrame({'bodyId': df['partner'], 'type': df['type'], 'w': df['w']})
+        if 'Synapse' in q:
+            synapseType = re.search(r"s\.type ?= ?'(\w+)'", q).group(1)
+            if 'UNWIND' in q:
+                bodyids = self.parseids(q)
+                rows, rowids = self.synapsesof(bodyids, synapseType)
+                df = pd.DataFrame(self.xyz[rows], columns=['x','y','z'])
+                df.insert(0,'bodyId',rowids)
+                return df
+            m = re.search(r"a\.bodyId=(\d+)", q)
+            if m:
+                rows, _ = self.synapsesof([int(m.group(1))], synapseType)
+                return pd.DataFrame(self.xyz[rows], columns=['x','y','z'])
+            celltype = re.search(r"a\.type ?= ?'([^']+)'", q).group(1)
+            bodyids = self.neurons.loc[self.neurons['type']==celltype,'bodyId'].to_numpy()
+            rows, rowids = self.synapsesof(bodyids, synapseType)
+            if 'RETURN DISTINCT a.bodyId' in q:
+                return pd.DataFrame({'bodyId': np.unique(rowids)})
+            return pd.DataFrame(self.xyz[rows], columns=['x','y','z'])
+        raise NotImplementedError('MockClient does not understand this query: '+q)
+
+    def parseids(self, q):
+        idstr = re.search(r'UNWIND \[([^\]]*)\]', q).group(1)
+        return [int(bodyid) for bodyid in idstr.split(',') if bodyid.strip()]
+
+    # rows of the synapse arrays belonging to the bodyIds (in that order)
+    def synapsesof(self, bodyids, synapseType):
+        code = 0 if synapseType=='pre' else 1
+        keys = np.asarray(bodyids,dtype=np.int64)*2+code
+        starts = np.searchsorted(self.synkey, keys, side='left')
+        stops = np.searchsorted(self.synkey, keys, side='right')
+        rows = np.concatenate([np.arange(start,stop) for start,stop in zip(starts,stops)]+[np.zeros(0,dtype=np.int64)])
+        return rows, self.synbodyid[rows]
+
+    # outgoing connections of the bodyIds
+    def edgesof(self, bodyids):
+        bodyids = np.asarray(bodyids,dtype=np.int64)
+        starts = np.searchsorted(self.edgepre, bodyids, side='left')
+        stops = np.searchsorted(self.edgepre, bodyids, side='right')
+        rows = np.concatenate([np.arange(start,stop) for start,stop in zip(starts,stops)]+[np.zeros(0,dtype=np.int64)])
+        return pd.DataFrame({'bodyId': self.edgepre[rows], 'partner': self.edgepost[rows],
+                             'type': self.edgetype[rows], 'w': self.edgeweight[rows]})
+
+
+# Generate a synthetic dataset and make all the modules query it instead of
+# the neuPrint server (kwargs are passed to makehemibrain)
+def usesyntheticdata(**kwargs):
+    print('Using a synthetic dataset instead of neuPrint')
+    dataset = makehemibrain(**kwargs)
+    neuprintclient.setclient(MockClient(dataset))
+    # keep cached artifacts and saved data apart from those of the real dataset
+    neuprintclient.configure(dataset='synthetic')
+    datadir.configure(root=os.path.join('.','data','synthetic'))
+    return dataset
+
+
+# Create the data folders the modules save into (under the data root)
+def makedatadirs():
+    for folder in ('bodyidlist','connectivity','depth','landmark','postsynapselist',
+                   'result','spread','synapselist','synapsestore'):
+        os.makedirs(datadir.datapath(folder), exist_ok=True)
@@ -6,45 +6,51 @@
 import numpy as np
 import pandas as pd
 from sklearn.decomposition import PCA
+import modules.depthengine as depthengine
 
 # Given pca fit to a landmark, quadric model, and a dataframe with (native) 
 # x/y/z synapse locations in it, calculate (for each synapse) lobula layer depth 
 # as deviation from predicted PC3 position 
+# (the calculation is done in chunks by modules/depthengine.py; use it
+# directly for raw coordinate arrays or float32)
 def calcrawdepth(pca,coeff,df):
-    # First, flatten the input and convert its unit to microns
-    X = df["x"].to_numpy().flatten()*8/1000
-    Y = df["y"].to_numpy().flatten()*8/1000
-    Z = df["z"].to_numpy().flatten()*8/1000
-    XYZ = np.array([X,Y,Z]).T
-    
-    # apply PCA
-    PCs = pca.transform(XYZ)
-    
-    # flatten PCs again
-    PC1 = PCs[:,0].flatten()
-    PC2 = PCs[:,1].flatten()
-    PC3 = PCs[:,2].flatten()
+    return depthengine.calcdepth(df[['x','y','z']].to_numpy(), pca, coeff)
 
-    # construct predictors
-    A = np.array([PC1*0+1, PC1, PC2, PC1**2, PC2**2, PC1*PC2]).T
-    
-    # apply the model to predict PC3
-    predPC3 = np.dot(A,coeff)
-    rawdepth = PC3 - predPC3
-    
-    return rawdepth, PCs
+# Per-cluster statistics of the rows of mat, all clusters at once
+# Rows are sorted by label once (stable, so rows keep their order within each
+# cluster) and reduced with np.add.reduceat. Returns a dict with
+# - labels: unique labels (sorted), counts: number of rows with each label
+# - sum, mean, std (np.std, ddof=0), sem (std/sqrt(count)): one row per label
+# - order: the sorting index of the rows, starts: first sorted row of each label
+def groupstats(mat,label):
+    mat = np.asarray(mat)
+    if mat.ndim == 1:
+        mat = mat[:,None]
+    label = np.asarray(label)
+    order = np.argsort(label, kind='stable')
+    sortedlabel = label[order]
+    isstart = np.ones(len(sortedlabel), dtype=bool)
+    isstart[1:] = sortedlabel[1:] != sortedlabel[:-1]
+    starts = np.flatnonzero(isstart)
+    counts = np.diff(np.append(starts, len(sortedlabel)))
+    sortedmat = mat[order].astype(np.float64)
+    total = np.add.reduceat(sortedmat, starts, axis=0) if len(starts) else np.zeros((0,mat.shape[1]))
+    mean = total/counts[:,None]
+    # second pass for the variance (more accurate than the sum of squares)
+    groupind = np.repeat(np.arange(len(starts)), counts)
+    sqdev = (sortedmat-mean[groupind])**2
+    var = np.add.reduceat(sqdev, starts, axis=0)/counts[:,None] if len(starts) else np.zeros((0,mat.shape[1]))
+    std = np.sqrt(var)
+    return {'labels': sortedlabel[starts], 'counts': counts, 'sum': total, 'mean': mean,
+            'std': std, 'sem': std/np.sqrt(counts)[:,None], 'order': order, 'starts': starts}
 
 def sortmatrixbylabel(mat,label):
     # Sort along dimension 0 (sorting rows)
-    # prepare empty 2d array
-    sortedmat = np.empty((0,mat.shape[1]))
-    sortedlabel= []
-    # go through all the labels and sort
-    for thisLabel in np.unique(label):
-        thismat = mat[label==thisLabel,:]
-        sortedmat = np.concatenate((sortedmat,thismat),axis=0)
-        sortedlabel = np.append(sortedlabel,label[label==thisLabel])
-    return sortedmat, sortedlabel        
+    # a stable sort keeps the original order of rows within each label
+    order = np.argsort(np.asarray(label), kind='stable')
+    sortedmat = np.asarray(mat, dtype=np.float64)[order]
+    sortedlabel = np.asarray(label, dtype=np.float64)[order]
+    return sortedmat, sortedlabel
 
 # given a feature matrix, label for features, and cluster vector, report the
 # name of the most prominent N features
@@ -53,9 +59,13 @@ def reporttargetpercluster(mat,col_label,cluster,**kwargs):
         n_show = kwargs.get('n_show')
     else:
         n_show = 5
-        
-    for this_cluster in np.unique(cluster):
-        this_sum = np.mean(mat[cluster==this_cluster,:], axis=0)
+
+    # per-cluster means calculated beforehand (e.g. by features.groupsums)
+    if 'stats' in kwargs:
+        stats = kwargs.get('stats')
+    else:
+        stats = groupstats(mat, cluster)
+    for this_cluster, this_sum in zip(stats['labels'], stats['mean']):
         important_target_ind = np.argsort(-this_sum)[:n_show]
         
         # show results
@@ -4,15 +4,26 @@
 
 """
 ## Packages
+import hashlib
+import os
+import warnings
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 import umap
 from mpl_toolkits.mplot3d import Axes3D
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, TruncatedSVD
+from sklearn.neighbors import NearestNeighbors
 ## my modules
 import modules.utility as utility
+import modules.artifactcache as artifactcache
+import modules.datadir as datadir
+import modules.instrument as instrument
+
+# above this number of points, render='auto' bins points into an image instead
+# of drawing each of them
+rasterThreshold = 100000
 
 
 # Show quadric surface and scatter
@@ -27,6 +38,10 @@ def plotquadricandscatter(pca,coeff,df,**kwargs):
        F = kwargs.get("fraction")
    else:
        F = 0.1
+   # with render='raster' ('auto' and many synapses), all the synapses are
+   # binned into images instead (see rasterscatter)
+   if userasterize(kwargs, len(PCs)):
+       return plotquadricraster(PCs, rawdepth, coeff, **kwargs)
    showind = np.random.rand(len(PCs))<F
 
    # Find ranges of PC1 and PC2 for mesh thing
@@ -51,6 +66,25 @@ def plotquadricandscatter(pca,coeff,df,**kwargs):
    ax.set_title('Quadric model')
 
 
+# Rasterized version of plotquadricandscatter: mean depth of synapses seen
+# from the top (PC1/PC2), and all the synapses seen from the side (PC1/PC3)
+# with the quadric model along PC2=0
+def plotquadricraster(PCs,rawdepth,coeff,**kwargs):
+   fig, ax = plt.subplots(1,2)
+   kwargs.setdefault('cmapname', 'viridis')
+   rasterscatter(ax[0], PCs[:,0], PCs[:,1], values=rawdepth, **kwargs)
+   ax[0].set_xlabel('PC1 (um)')
+   ax[0].set_ylabel('PC2 (um)')
+   ax[0].set_title('Mean depth of synapses')
+   rasterscatter(ax[1], PCs[:,0], PCs[:,2], **kwargs)
+   PC1 = np.linspace(np.min(PCs[:,0]), np.max(PCs[:,0]), 200)
+   ax[1].plot(PC1, coeff[0]+coeff[1]*PC1+coeff[3]*PC1**2, 'm-')
+   ax[1].set_xlabel('PC1 (um)')
+   ax[1].set_ylabel('PC3 (um)')
+   ax[1].set_title('Quadric model')
+   return fig, ax
+
+
 # Given a feature matrix (e.g. connectivity) and a label vector (e.g. clusters)
 # sort the matrix and visualize, with cluster boundary as dotted line
 # assume the specific structure where 1st dimensions are different samples and
@@ -63,8 +97,8 @@ def showsortedmatrix(mat,label,**kwargs):
     fig, ax, im = showmatrix(sortedmat.T, **kwargs)
     # add border lines
     mat_height = sortedmat.shape[1]
-    for thisLabel in np.unique(sortedlabel):
-        lastind = np.max(np.where(sortedlabel==thisLabel))
+    # last index of each label in the sorted matrix
+    for lastind in np.cumsum(utility.groupstats(np.zeros(len(sortedlabel)),sortedlabel)['counts'])-1:
         plt.plot([lastind-0.5,lastind-0.5],[-0.5,mat_height],'w--')
 
     # show row labels (optional)
@@ -116,26 +150,125 @@ def showsortedUMAPscatter(mat,label,**kwargs):
     else:
         n_components = 5
 
-    # do PCA
-    reducer = umap.UMAP(n_components = n_components,random_state=1)
-    embedding = reducer.fit_transform(mat)
-    fig, ax = showsortedscatter(embedding,label,n_show = n_components)
+    # do UMAP (or load the saved embedding)
+    kwargs = {key: value for key, value in kwargs.items() if key not in ('n_components','n_show')}
+    embedding = umapembedding(mat, n_components=n_components, **kwargs)
+    fig, ax = showsortedscatter(embedding,label,n_show = n_components, **kwargs)
     return fig, ax
 
 
 
-def showUMAPscatter2D(mat,label):
+# UMAP embedding of the rows of mat
+# The embedding is saved under data/umap, keyed by a hash of mat and the UMAP
+# parameters, so replotting (e.g. with different clusters) does not refit it.
+# Optionally, mat is first reduced to preReduce dimensions (PCA, or truncated
+# SVD with preReduceMethod='svd'), and the kNN graph is computed (and saved)
+# separately from UMAP with precomputedKNN=1, so it is reused when only
+# UMAP parameters such as min_dist change
+@instrument.timed('umap')
+def umapembedding(mat,**kwargs):
+    n_components = kwargs.get('n_components', 2)
+    random_state = kwargs.get('random_state', 1)
+    n_neighbors = kwargs.get('n_neighbors', 15)
+    min_dist = kwargs.get('min_dist', 0.1)
+    preReduce = kwargs.get('preReduce', 0)
+    preReduceMethod = kwargs.get('preReduceMethod', 'pca')
+    precomputedKNN = kwargs.get('precomputedKNN', 0)
+    umapCache = kwargs.get('umapCache', 1)
+
+    params = {'matrixhash': matrixhash(mat), 'n_components': n_components, 'random_state': random_state,
+              'n_neighbors': n_neighbors, 'min_dist': min_dist,
+              'preReduce': preReduce, 'preReduceMethod': preReduceMethod if preReduce else ''}
+    if umapCache:
+        path = artifactcache.lookup('umap', params)
+        if path:
+            return np.load(path)
+
+    X = np.asarray(mat)
+    if preReduce and preReduce < X.shape[1]:
+        print('Reducing',X.shape[1],'features to',preReduce,'before UMAP...')
+        if preReduceMethod == 'svd':
+            X = TruncatedSVD(n_components=preReduce, random_state=0).fit_transform(X)
+        else:
+            X = PCA(n_components=preReduce, random_state=0).fit_transform(X)
+
+    precomputed = (None, None, None)
+    if precomputedKNN:
+        knnparams = {key: params[key] for key in ('matrixhash','n_neighbors','random_state','preReduce','preReduceMethod')}
+        knnpath = artifactcache.lookup('umapknn', knnparams) if umapCache else None
+        if knnpath:
+            with np.load(knnpath) as saved:
+                precomputed = (saved['indices'], saved['dists'])
+        else:
+            precomputed = knngraph(X, n_neighbors, random_state)
+            if umapCache:
+                # named after the whole key, so graphs of other parameters are kept apart
+                knnpath = savearray(datadir.datapath('umap',artifactcache.makekey('umapknn', knnparams)+'.npz'),
+                                    indices=precomputed[0], dists=precomputed[1])
+                artifactcache.register('umapknn', knnparams, knnpath)
+
+    print('Fitting UMAP to',X.shape[0],'samples...')
+    reducer = umap.UMAP(n_components=n_components, random_state=random_state, n_neighbors=n_neighbors,
+                        min_dist=min_dist, precomputed_knn=precomputed)
+    with warnings.catch_warnings():
+        # the saved kNN graph has no search index, which only matters for transform()
+        warnings.filterwarnings('ignore', message='precomputed_knn')
+        embedding = reducer.fit_transform(X)
+
+    if umapCache:
+        path = datadir.datapath('umap',artifactcache.makekey('umap', params)+'.npy')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.save(path, embedding)
+        artifactcache.register('umap', params, path)
+    return embedding
+
+
+# kNN graph (indices and distances, each sample being its own first neighbor)
+# in the form UMAP takes as precomputed_knn. Small data get the exact graph,
+# as in UMAP itself, larger ones the approximate one of UMAP (NN-descent)
+def knngraph(X,n_neighbors,random_state):
+    print('Calculating the kNN graph of',X.shape[0],'samples...')
+    if X.shape[0] < 4096:
+        nn = NearestNeighbors(n_neighbors=min(n_neighbors,X.shape[0])).fit(X)
+        dists, indices = nn.kneighbors(X)
+    else:
+        indices, dists, _ = umap.umap_.nearest_neighbors(X, n_neighbors, 'euclidean', {}, False,
+                                                        np.random.RandomState(random_state))
+    return indices, dists.astype(np.float32)
+
+
+# Short hash of the contents (and shape/dtype) of a matrix
+def matrixhash(mat):
+    mat = np.ascontiguousarray(mat)
+    sha = hashlib.sha1(str((mat.shape, mat.dtype.str)).encode())
+    flat = mat.reshape(-1)
+    step = max(1, (1<<24)//max(mat.itemsize,1))
+    for start in range(0, len(flat), step):
+        sha.update(flat[start:start+step].tobytes())
+    return sha.hexdigest()[:16]
+
+
+def savearray(path,**arrays):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez(path, **arrays)
+    return path
+
+
+def showUMAPscatter2D(mat,label,**kwargs):
     # adjust dot size according to the number of samples
     dot_size = np.minimum(np.ceil(5000/mat.shape[0]),10)
 
     n_cat = len(np.unique(label))
-    # do PCA
-    reducer = umap.UMAP(n_components = 2,random_state=1)
-    embedding = reducer.fit_transform(mat)
+    # do UMAP (or load the saved embedding)
+    embedding = umapembedding(mat, n_components=2, **kwargs)
 
     cmap = cm.get_cmap('gist_ncar')
 
     fig, ax = plt.subplots()
+    if userasterize(kwargs, mat.shape[0]):
+        rasterscatter(ax, embedding[:,0], embedding[:,1], label=label, **kwargs)
+        ax.legend(handles=labelhandles(label), ncol=4)
+        return fig, ax
     kk = 0
     for ll in np.unique(label):
         ax.scatter(embedding[label==ll,0],embedding[label==ll,1],
@@ -162,11 +295,13 @@ def showsortedscatter(mat,label,**kwargs):
             n_show = 5
         col_to_show = range(n_show)
 
-    # prepare color vector (assume labels to be integers)
-    cmap = cm.get_cmap('gist_ncar')
+    # one color per label, the same in the scatters, images and legend
+    label = np.asarray(label)
+    uniquelabel = np.unique(label)
+    colors = labelcolors(uniquelabel)
 
     # get the number of cluster
-    n_cluster = len(np.unique(label))
+    n_cluster = len(uniquelabel)
 
     # do visualization
     fig = plt.figure()
@@ -185,13 +320,16 @@ def showsortedscatter(mat,label,**kwargs):
             if ii == 0:
                 ax.set_xlabel('Column #'+str(colj))
                 ax.xaxis.set_label_position('top')
-            for kk in np.unique(label):
-                ax.scatter(mat[label==kk,jj],mat[label==kk,ii],s=0.5,c=np.array([cmap(kk/(n_cluster+1))]))
+            if userasterize(kwargs, mat.shape[0]):
+                rasterscatter(ax, mat[:,colj], mat[:,coli], label=label, **kwargs)
+                continue
+            for kk, ll in enumerate(uniquelabel):
+                ax.scatter(mat[label==ll,colj],mat[label==ll,coli],s=0.5,c=colors[[kk]])
 
     # create legend (in a separate dedicated plot on the lower left corner)
     ax = fig.add_subplot(n_show,n_show,n_show*(n_show-1)+1)
-    for kk in np.unique(label):
-        sc = ax.scatter(kk,1,c=np.array([cmap(kk/(n_cluster+1))]))
+    for kk, ll in enumerate(uniquelabel):
+        sc = ax.scatter(ll,1,c=colors[[kk]])
     ax.set_yticks([])
     ax.set_xticks(range(1,n_cluster+1))
     ax.set_title('Clusters')
@@ -210,15 +348,15 @@ def plotmeanbycluster(mat,label,**kwargs):
     else:
         x = np.arange(mat.shape[1])
 
-    uniquelabel = np.unique(label)
+    stats = utility.groupstats(mat,label)
+    uniquelabel = stats['labels']
     n_cluster = len(uniquelabel)
     cmap = cm.get_cmap('gist_ncar')
     fig, ax = plt.subplots()
     for ii in range(n_cluster):
         thislabel = uniquelabel[ii]
-        thisN = sum(label==thislabel)
-        thismean = np.mean(mat[label==thislabel,:],axis=0)
-        thissem = np.std(mat[label==thislabel,:],axis=0)/np.sqrt(thisN)
+        thismean = stats['mean'][ii]
+        thissem = stats['sem'][ii]
         thiscol = cmap(ii/(n_cluster+1))
         ax.plot(x,thismean,color=thiscol,label=thislabel)
         ax.fill_between(x,thismean-thissem,thismean+thissem,color=thiscol,alpha=0.2)
@@ -227,17 +365,12 @@ def plotmeanbycluster(mat,label,**kwargs):
 
 def meanscatterwitherror(mat,label,**kwargs):
     n_feature = mat.shape[1]
-    uniquelabel = np.unique(label)
+    # calculate mean/sem of all the clusters at once
+    stats = utility.groupstats(mat,label)
+    uniquelabel = stats['labels']
     n_cluster = len(uniquelabel)
-    # prepare mean/sem matrix
-    mean_mat = np.empty([0,n_feature])
-    sem_mat  = np.empty([0,n_feature])
-    # calculate mean/sem
-    for ll in uniquelabel:
-        this_mean = np.reshape(np.mean(mat[label==ll,:],axis=0),[1,n_feature])
-        this_sem  = np.reshape(np.std(mat[label==ll,:],axis=0),[1,n_feature])/np.sqrt(np.sum(label==ll))
-        mean_mat = np.concatenate((mean_mat,this_mean),axis=0)
-        sem_mat  = np.concatenate((sem_mat,this_sem),axis=0)
+    mean_mat = stats['mean']
+    sem_mat  = stats['sem']
 
     fig, ax = plt.subplots(1,n_feature-1)
     cmap = cm.get_cmap('gist_ncar')
@@ -279,3 +412,103 @@ def showsortedpiechart(x, **kwargs):
     shortlabel.append('other')
     ax.pie(x_plot,labels=shortlabel)
     return ax
+
+
+# Whether to draw points as an image: render='scatter', 'raster', or 'auto'
+# (raster above rasterThreshold points)
+def userasterize(kwargs,n_point):
+    render = kwargs.get('render', 'auto')
+    if render == 'auto':
+        return n_point > rasterThreshold
+    return render == 'raster'
+
+
+# Colors of labels (sorted unique labels), the same as the ones used by the
+# scatter plots: the k-th label gets cmap(k/(n+1)) whatever its value
+def labelcolors(uniquelabel,**kwargs):
+    cmap = cm.get_cmap(kwargs.get('cmapname', 'gist_ncar'))
+    n_cat = len(uniquelabel)
+    return np.array([cmap(kk/(n_cat+1)) for kk in range(n_cat)])
+
+
+# Legend entries for labels drawn with rasterscatter
+def labelhandles(label):
+    uniquelabel = np.unique(label)
+    colors = labelcolors(uniquelabel)
+    return [plt.Line2D([], [], marker='o', linestyle='none', color=colors[kk], label=str(ll))
+            for kk, ll in enumerate(uniquelabel)]
+
+
+# Draw points (x, y) as one image instead of one marker per point
+# Points are binned into resolution x resolution pixels
+# - with label: each label gets its own density image in the color of the label
+#   (see labelcolors), and the images are composited into one, the largest
+#   labels at the bottom, so pixels show the colors of clusters and never a
+#   blend matching none of them
+# - with values: each pixel gets the color of the mean value of its points
+# - otherwise: a single color
+# with an opacity growing with the log of the number of points. Nothing is
+# subsampled and the result does not depend on the order of points
+def rasterscatter(ax,x,y,**kwargs):
+    if 'resolution' in kwargs:
+        resolution = kwargs.get('resolution')
+    else:
+        resolution = 400
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if 'extent' in kwargs:
+        extent = kwargs.get('extent')
+    else:
+        extent = dataextent(x, y)
+
+    x0, x1, y0, y1 = extent
+    ix = np.clip(((x-x0)/(x1-x0)*resolution).astype(np.int64), 0, resolution-1)
+    iy = np.clip(((y-y0)/(y1-y0)*resolution).astype(np.int64), 0, resolution-1)
+    pixel = iy*resolution+ix
+    count = np.bincount(pixel, minlength=resolution*resolution).astype(np.float64)
+    filled = count>0
+
+    image = np.zeros((resolution*resolution,4))
+    if 'label' in kwargs:
+        label = np.asarray(kwargs.get('label'))
+        uniquelabel, labelind = np.unique(label, return_inverse=True)
+        colors = labelcolors(uniquelabel, **kwargs)
+        # pixels of the points sorted by label, so that each label is a slice
+        order = np.argsort(labelind, kind='stable')
+        bounds = np.searchsorted(labelind[order], np.arange(len(uniquelabel)+1))
+        layers = [np.bincount(pixel[order[bounds[kk]:bounds[kk+1]]], minlength=len(count))
+                  for kk in range(len(uniquelabel))]
+        top = np.log1p(np.max(count))
+        # alpha compositing of the layers with premultiplied colors
+        for kk in np.argsort([-(bounds[kk+1]-bounds[kk]) for kk in range(len(uniquelabel))], kind='stable'):
+            alpha = np.where(layers[kk]>0, 0.3+0.7*np.log1p(layers[kk])/top, 0.0)
+            image[:,:3] = colors[kk,:3]*alpha[:,None]+image[:,:3]*(1-alpha[:,None])
+            image[:,3] = alpha+image[:,3]*(1-alpha)
+        image[filled,:3] /= image[filled,3:]
+        image = np.clip(image, 0, 1)
+    elif 'values' in kwargs:
+        # color of the mean value in each pixel
+        values = np.asarray(kwargs.get('values'), dtype=np.float64)
+        meanvalue = np.bincount(pixel, weights=values, minlength=len(count))[filled]/count[filled]
+        lo, hi = np.min(meanvalue), np.max(meanvalue)
+        cmap = cm.get_cmap(kwargs.get('cmapname', 'viridis'))
+        image[filled,:3] = cmap((meanvalue-lo)/max(hi-lo,1e-12))[:,:3]
+    else:
+        image[filled,:3] = (0.2,0.2,0.6)
+    if 'label' not in kwargs:
+        # opacity: log of the density, so that single points are still visible
+        image[filled,3] = 0.3+0.7*np.log1p(count[filled])/np.log1p(np.max(count))
+
+    im = ax.imshow(image.reshape(resolution,resolution,4), extent=extent, origin='lower',
+                   aspect='auto', interpolation='nearest')
+    return im
+
+
+# Range of the data with a small margin, as (xmin, xmax, ymin, ymax)
+def dataextent(x,y):
+    extent = []
+    for v in (x, y):
+        lo, hi = (np.min(v), np.max(v)) if len(v) else (0.0, 1.0)
+        margin = max(hi-lo, 1e-12)*0.02
+        extent += [lo-margin, hi+margin]
+    return extent
@@ -0,0 +1,58 @@
+"""
+
+ Parameter sweep script
+
+ Clusters the cells with every combination of the data weights and numbers of
+ clusters listed in the [sweep] section of config.ini, and saves quality
+ metrics and cluster labels of each combination under data/result
+
+ The connectivity and morphology matrices are loaded (or created) in the same
+ way as in lobulaclustering.py
+
+"""
+# Packages
+import os
+
+# Our own modules
+import modules.getmorphology as getmorphology
+import modules.getconnectivity as getconnectivity
+import modules.sweep as sweep
+import modules.config as config
+import modules.datadir as datadir
+
+# everything runs under the guard: worker processes of the sweep import this
+# script again where they are spawned (macOS/Windows), and must not configure
+# the modules (or generate the synthetic dataset) once more
+if __name__ == '__main__':
+    print('Running parametersweep.py...')
+
+    ## 0. Analysis parameters
+    cfg = config.loadconfig()
+    config.applyconfig(cfg)
+    weightlist = cfg['sweep']['data_weights']
+    klist = cfg['sweep']['n_clusters']
+    n_workers = cfg['sweep'].get('n_workers', 1)
+    method = cfg['sweep'].get('method', 'exact')
+    n_micro = cfg['clustering'].get('n_micro', 2000)
+
+    ## 1. data preparation
+    connectivity, con_fn = getconnectivity.getconnectivity(**config.datakwargs(cfg))
+    depth, spread, dep_fn = getmorphology.getmorphology(**config.datakwargs(cfg))
+
+    # Check connectivity and morphology are based on the same bodyidlist
+    if os.path.splitext(con_fn[con_fn.find('bodyidlist'):])[0] != os.path.splitext(dep_fn[dep_fn.find('bodyidlist'):])[0]:
+        print('Connectivity and morphology matrices are based on different sets of cells. Aborting')
+    else:
+        mat_con = connectivity.iloc[:,connectivity.columns.get_loc("bodyId")+1:].to_numpy()
+        mat_dep = depth.iloc[:,depth.columns.get_loc("bodyId")+1:].to_numpy()
+        mat_spr = spread.iloc[:,spread.columns.get_loc("bodyId")+1:].to_numpy()
+
+        ## 2. sweep
+        results = sweep.runsweep(mat_con, mat_dep, mat_spr, weightlist, klist, n_workers=n_workers,
+                                  method=method, n_micro=n_micro)
+        print(results.drop(columns='clabel').to_string())
+
+        ## 3. save
+        os.makedirs(datadir.datapath('result'), exist_ok=True)
+        outfn = datadir.datapath('result','sweep'+os.path.splitext(dep_fn)[0][5:])
+        sweep.savesweep(results, depth.bodyId, outfn)